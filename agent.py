@@ -1,17 +1,81 @@
+import time
+STARTUP_TIME = time.perf_counter()  # 用于--profile-startup统计模块导入耗时
+import importlib
+import importlib.util
 import json
+import logging
 import os
-import requests
 import subprocess
 import re
 import platform
 import datetime  # 保留基础datetime模块
-from pydantic import BaseModel
 import sys
 import io
 import contextlib
+import gzip
+import hashlib
+import signal
+import queue
+import random
+import shlex
+import secrets
+import sqlite3
+import tempfile
+import heapq
+import math
+from collections import Counter
+from collections import OrderedDict
+from collections import deque
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from urllib.parse import urlsplit
+try:
+    import orjson  # 可选：安装后用于更快的JSON序列化
+except ImportError:
+    orjson = None
 
-# 定义配置模型
-class Config(BaseModel):
+# 历史记录文件（history.hty为旧版本的纯文本格式，首次启动时导入）
+HISTORY_DB_FILE = "history.db"
+LEGACY_HISTORY_FILE = "history.hty"
+
+# 配置项按类型分组（配置校验与config命令共用）
+LOGGER_VALUES = ["all", "format", "lite", "None"]
+TERMINAL_MODE_VALUES = ["session", "oneshot"]
+TOKENIZER_VALUES = ["estimate", "tiktoken"]
+SAVED_HISTORY_SELECT_VALUES = ["relevant", "recent"]
+COMPLETION_CACHE_VALUES = ["off", "on", "record", "replay"]
+BOOL_CONFIG_KEYS = ["send_history", "save_history", "send_saved_history", "http_keep_alive", "http_warmup", "stream",
+                    "tool_sequential", "python_kernel", "mcp_cache", "mcp_plugin_entry_points",
+                    "completion_cache_replay_fallback"]
+STR_CONFIG_KEYS = ["api_url", "api_key", "model", "user_name", "ai_name", "prompt_file", "log_file", "mcp_plugin_dir",
+                   "trace_file", "metrics_dump_file", "completion_cache_file", "history_spill_dir"]
+CHOICE_CONFIG_KEYS = {
+    "logger": LOGGER_VALUES,
+    "terminal_mode": TERMINAL_MODE_VALUES,
+    "context_tokenizer": TOKENIZER_VALUES,
+    "saved_history_select": SAVED_HISTORY_SELECT_VALUES,
+    "completion_cache": COMPLETION_CACHE_VALUES
+}  # 取值受限的字符串
+INT_CONFIG_KEYS = ["http_pool_size", "http_gzip_min_bytes", "tool_workers", "max_agent_steps", "turn_token_budget",
+                   "terminal_output_head", "terminal_output_tail", "python_output_head", "python_output_tail",
+                   "context_token_budget", "context_summary_chars", "saved_history_turns", "saved_history_top_k",
+                   "mcp_cache_max_bytes", "log_file_max_bytes", "log_file_backups", "api_retries",
+                   "completion_cache_max_bytes", "history_memory_limit"]
+FLOAT_CONFIG_KEYS = ["http_connect_timeout", "http_read_timeout", "turn_time_budget", "python_timeout",
+                     "terminal_timeout", "mcp_cache_ttl", "metrics_dump_interval", "api_retry_base_delay",
+                     "api_retry_max_delay", "api_hedge_after", "completion_cache_ttl"]
+LIST_CONFIG_KEYS = ["python_preload_modules", "mcp_cache_readonly_commands", "api_fallbacks"]  # 字符串列表
+
+# 这些状态码表示服务端暂时不可用，可以稍后重试
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429, 500, 502, 503, 504}
+
+DEFAULT_READONLY_COMMANDS = [
+    "ls", "cat", "head", "tail", "wc", "pwd", "grep", "find", "stat", "file", "du", "df",
+    "uname", "whoami", "hostname", "which", "echo", "tree", "dir", "type"
+]
+
+# 定义配置模型（字段及默认值由类注解声明）
+class Config:
     api_url: str = "https://api.example.com/v1/chat/completions"
     api_key: str = "your_api_key_here"
     model: str = "default_model"
@@ -21,13 +85,124 @@ class Config(BaseModel):
     send_history: bool = False
     save_history: bool = False
     send_saved_history: bool = False
+    history_memory_limit: int = 67108864  # 本次会话的对话历史在内存中占用的上限（字节），超出时较早的内容转存到临时文件，0表示不限制
+    history_spill_dir: str = ""  # 对话历史转存文件所在的目录，为空时使用系统临时目录
     logger: str = "None"  # 可选值：all/format/lite/None
+    log_file: str = ""  # JSONL日志文件路径，为空时不写日志文件
+    log_file_max_bytes: int = 10485760  # 日志文件轮转大小
+    log_file_backups: int = 3  # 保留的轮转日志文件个数
+    trace_file: str = ""  # Chrome trace格式的性能追踪文件路径，为空时不追踪
+    metrics_dump_file: str = ""  # 定时写入运行指标的JSON文件路径，为空时不写入
+    metrics_dump_interval: float = 60.0  # 写入运行指标的间隔（秒）
+    http_pool_size: int = 10  # 连接池大小
+    http_keep_alive: bool = True  # 是否保持长连接
+    http_connect_timeout: float = 10.0  # 建立连接超时（秒）
+    http_read_timeout: float = 300.0  # 读取响应超时（秒），<=0表示不限制
+    http_gzip_min_bytes: int = 0  # 请求体达到该字节数时gzip压缩，0表示不压缩
+    http_warmup: bool = True  # 启动时是否在后台预先建立到api_url的连接
+    api_retries: int = 2  # 每个API地址请求失败后的重试次数
+    api_retry_base_delay: float = 0.5  # 第一次重试前的最长等待（秒），之后每次翻倍并随机抖动
+    api_retry_max_delay: float = 20.0  # 单次重试等待的上限（秒），也限制Retry-After
+    api_fallbacks: list[str] = []  # 备用API，格式为 地址 或 地址|模型 或 地址|模型|密钥
+    api_hedge_after: float = 0.0  # 超过该秒数仍未收到响应时向第一个备用API发送相同请求，0表示不启用
+    completion_cache: str = "off"  # 可选值：off/on（缓存相同请求的回复）/record（记录所有回复）/replay（只回放记录的回复）
+    completion_cache_file: str = "completion_cache.db"  # 回复缓存文件
+    completion_cache_max_bytes: int = 104857600  # 回复缓存的总大小上限，0表示不限制
+    completion_cache_ttl: float = 86400.0  # 缓存回复的有效期（秒），0表示不过期
+    completion_cache_replay_fallback: bool = False  # replay模式下请求不在记录中时，是否按记录顺序使用下一条回复（默认视为错误）
+    stream: bool = False  # 是否使用流式（SSE）输出
+    tool_workers: int = 4  # 并发执行MCP请求/终端命令的线程数
+    tool_sequential: bool = False  # 是否强制按顺序执行所有MCP请求和终端命令
+    max_agent_steps: int = 8  # 每轮对话最多请求API的次数
+    turn_token_budget: int = 0  # 每轮对话的token预算，0表示不限制
+    turn_time_budget: float = 0.0  # 每轮对话的时间预算（秒），0表示不限制
+    python_kernel: bool = True  # 是否在独立的持久Python内核进程中执行Python代码
+    python_preload_modules: list[str] = []  # Python内核启动时预先导入的模块
+    python_timeout: float = 0.0  # 单次Python代码执行超时（秒），0表示不限制
+    terminal_mode: str = "session"  # 可选值：session（持久shell会话）/oneshot（每条命令启动新进程）
+    terminal_timeout: float = 0.0  # 单条终端命令超时（秒），0表示不限制
+    terminal_output_head: int = 16384  # 终端命令输出保留开头的字节数
+    terminal_output_tail: int = 16384  # 终端命令输出保留末尾的字节数
+    python_output_head: int = 16384  # Python代码输出保留开头的字节数
+    python_output_tail: int = 16384  # Python代码输出保留末尾的字节数
+    context_token_budget: int = 32000  # 每次请求的上下文token预算，0表示不限制
+    context_summary_chars: int = 200  # 超出预算的旧对话压缩为摘要时保留的字符数，0表示直接丢弃
+    context_tokenizer: str = "estimate"  # 可选值：estimate（本地估算）/tiktoken（需安装tiktoken）
+    saved_history_turns: int = 50  # 发送已保存历史时最多读取的轮数（recent模式）
+    saved_history_select: str = "relevant"  # 可选值：relevant（检索与问题相关的历史）/recent（最近的历史）
+    saved_history_top_k: int = 5  # relevant模式下最多发送的历史轮数
+    mcp_cache: bool = True  # 是否缓存幂等MCP方法的结果
+    mcp_cache_max_bytes: int = 4194304  # MCP结果缓存的总大小上限
+    mcp_cache_ttl: float = 30.0  # 只读终端命令结果的缓存时间（秒）
+    mcp_cache_readonly_commands: list[str] = DEFAULT_READONLY_COMMANDS  # 可以缓存结果的只读命令
+    mcp_plugin_dir: str = "mcp_modules"  # MCP插件模块目录，为空时不加载目录中的插件
+    mcp_plugin_entry_points: bool = True  # 是否加载通过agentcli.mcp_modules入口点安装的插件
+
+    def __init__(self, **values):
+        for key in self.__annotations__:
+            value = values.get(key, getattr(type(self), key))
+            # 列表默认值是类属性，复制一份避免多个实例共享
+            setattr(self, key, list(value) if isinstance(value, list) else value)
+
+    def model_dump(self):
+        """返回所有配置项的字典"""
+        return {key: (list(value) if isinstance(value, list) else value)
+                for key, value in ((key, getattr(self, key)) for key in self.__annotations__)}
+
+    @classmethod
+    def build_validated(cls, data):
+        """用pydantic按字段注解对配置做完整校验后构造实例（只在需要修复配置时使用，首次调用时才导入pydantic）"""
+        model = cls.__dict__.get("pydantic_model")
+        if model is None:
+            from pydantic import create_model
+            model = create_model(
+                "ConfigModel",
+                **{key: (field_type, getattr(cls, key)) for key, field_type in cls.__annotations__.items()}
+            )
+            cls.pydantic_model = model
+        return cls(**model(**data).model_dump())
 
     def save_to_file(self, file_path="config.json"):
         """保存配置文件"""
         with open(file_path, "w", encoding="utf-8") as f:
             json.dump(self.model_dump(), f, indent=4, ensure_ascii=False)
 
+    @classmethod
+    def validate_item(cls, key, value):
+        """
+        校验单个配置项
+        :return: (转换后的值, None)，不合法时返回(None, 错误原因)
+        """
+        if key in CHOICE_CONFIG_KEYS:
+            # 校验取值范围（如logger的all/format/lite/None）
+            valid_values = CHOICE_CONFIG_KEYS[key]
+            if value not in valid_values:
+                return None, f"取值不在允许范围内（{', '.join(valid_values)}）"
+        elif key in BOOL_CONFIG_KEYS:
+            # 校验布尔类型配置
+            if not isinstance(value, bool):
+                return None, "类型错误，必须是布尔值（True/False）"
+        elif key in STR_CONFIG_KEYS:
+            # 校验字符串类型配置
+            if not isinstance(value, str):
+                return None, "类型错误，必须是字符串"
+        elif key in INT_CONFIG_KEYS:
+            # 校验非负整数配置（bool是int的子类，需要单独排除）
+            if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+                return None, "类型错误，必须是非负整数"
+        elif key in FLOAT_CONFIG_KEYS:
+            # 校验数值配置（整数会被转换为浮点数）
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                return None, "类型错误，必须是数字"
+            value = float(value)
+        elif key in LIST_CONFIG_KEYS:
+            # 校验字符串列表配置
+            if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+                return None, "类型错误，必须是字符串列表"
+        elif key not in cls.__annotations__:
+            return None, "未知配置项"
+        return value, None
+
     @classmethod
     def load_and_validate(cls, file_path="config.json"):
         """
@@ -79,68 +254,82 @@ class Config(BaseModel):
         for key, default_value in default_dict.items():
             # 获取用户配置值（不存在则用默认值）
             user_value = loaded_data.get(key, default_value)
-            
-            # 校验并修复配置项
-            if key == "logger":
-                # 校验logger取值范围（包含lite选项）
-                valid_logger_values = ["all", "format", "lite", "None"]
-                if user_value not in valid_logger_values:
-                    config_errors.append({
-                        "item": key,
-                        "original_value": user_value,
-                        "error_reason": f"取值不在允许范围内（{', '.join(valid_logger_values)}）",
-                        "fixed_value": default_value
-                    })
-                    validated_data[key] = default_value
-                else:
-                    validated_data[key] = user_value
-            
-            elif key in ["send_history", "save_history", "send_saved_history"]:
-                # 校验布尔类型配置
-                if not isinstance(user_value, bool):
-                    config_errors.append({
-                        "item": key,
-                        "original_value": user_value,
-                        "error_reason": "类型错误，必须是布尔值（True/False）",
-                        "fixed_value": default_value
-                    })
-                    validated_data[key] = default_value
-                else:
-                    validated_data[key] = user_value
-            
-            elif key in ["api_url", "api_key", "model", "user_name", "ai_name", "prompt_file"]:
-                # 校验字符串类型配置
-                if not isinstance(user_value, str):
-                    config_errors.append({
-                        "item": key,
-                        "original_value": user_value,
-                        "error_reason": "类型错误，必须是字符串",
-                        "fixed_value": default_value
-                    })
-                    validated_data[key] = default_value
-                else:
-                    validated_data[key] = user_value
-            
-            else:
-                # 未知配置项：使用默认值
-                validated_data[key] = default_value
-
-        # 步骤4：保存修复后的配置（仅当有错误时）
-        if config_errors and any(err.get("item") for err in config_errors):
-            try:
-                fixed_config = cls(**validated_data)
-                fixed_config.save_to_file(file_path)
-            except Exception as e:
+            value, error_reason = cls.validate_item(key, user_value)
+            if error_reason:
                 config_errors.append({
-                    "type": "save_error",
-                    "message": f"保存修复后的配置失败：{str(e)}"
+                    "item": key,
+                    "original_value": user_value,
+                    "error_reason": error_reason,
+                    "fixed_value": default_value
                 })
-                return default_config, config_errors
+                validated_data[key] = default_value
+            else:
+                validated_data[key] = value
+
+        # 步骤4：配置文件无需修复时直接构造实例（快速路径，不导入pydantic）
+        if not any(err.get("item") for err in config_errors):
+            return cls(**validated_data), config_errors
+
+        # 步骤5：保存修复后的配置
+        try:
+            fixed_config = cls.build_validated(validated_data)
+            fixed_config.save_to_file(file_path)
+        except Exception as e:
+            config_errors.append({
+                "type": "save_error",
+                "message": f"保存修复后的配置失败：{str(e)}"
+            })
+            return default_config, config_errors
 
-        # 步骤5：返回修复后的配置和错误信息
-        return cls(**validated_data), config_errors
+        # 步骤6：返回修复后的配置和错误信息
+        return fixed_config, config_errors
 
 # ===================== 工具函数 =====================
+def estimate_tokens(text):
+    """粗略估算文本的token数：中日韩字符按1个token计，其余按4个字符1个token计"""
+    if not text:
+        return 0
+    cjk_count = sum(1 for ch in text if "\u2e80" <= ch <= "\u9fff" or "\uac00" <= ch <= "\ud7af")
+    return cjk_count + (len(text) - cjk_count + 3) // 4
+
+def json_default(value):
+    """JSON序列化的兜底转换：MCP消息对象转为字典，其余不支持的类型转为字符串"""
+    to_dict = getattr(value, "to_dict", None)
+    return to_dict() if to_dict is not None else str(value)
+
+def dumps_json(data, as_bytes=False):
+    """紧凑格式的JSON序列化（保留非ASCII字符），安装了orjson时优先使用orjson"""
+    if orjson is not None:
+        try:
+            encoded = orjson.dumps(data, default=json_default)
+            return encoded if as_bytes else encoded.decode("utf-8")
+        except orjson.JSONEncodeError:
+            pass  # orjson不支持的数据（如超过64位的整数）交给标准库处理
+    text = json.dumps(data, ensure_ascii=False, separators=(',', ':'), default=json_default)
+    return text.encode("utf-8") if as_bytes else text
+
+def parse_retry_after(value):
+    """解析Retry-After响应头（秒数或HTTP日期），返回需要等待的秒数，无法解析时返回None"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    from email.utils import parsedate_to_datetime
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at is None:
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+def close_hedged_response(future):
+    """对冲请求中未被采用的一方完成后关闭响应，把连接归还连接池"""
+    response, _ = future.result()
+    if response is not None:
+        response.close()
+
 def format_json_for_log(json_data, prefix="[日志] "):
     """格式化JSON数据用于日志输出"""
     if isinstance(json_data, str):
@@ -150,25 +339,2528 @@ def format_json_for_log(json_data, prefix="[日志] "):
         lines = []
         for key, value in json_data.items():
             if isinstance(value, dict):
-                value_str = json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+                value_str = dumps_json(value)
                 lines.append(f'"{key}":{value_str}')
             else:
-                value_str = json.dumps(value, ensure_ascii=False)
+                value_str = json.dumps(value, ensure_ascii=False, default=json_default)
                 lines.append(f'"{key}":{value_str}')
         
         formatted_lines = [f"{prefix}{line}" for line in lines]
         return "\n".join(formatted_lines)
-    return f"{prefix}{json.dumps(json_data, ensure_ascii=False, separators=(',', ':'))}"
+    return f"{prefix}{dumps_json(json_data)}"
+
+class BoundedOutput:
+    """
+    有界的输出缓冲：只保留开头head_bytes字节和末尾tail_bytes字节（环形缓冲），
+    同时统计总字节数和行数，无论输出多大内存占用都是固定的
+    """
+
+    def __init__(self, head_bytes, tail_bytes):
+        self.head_bytes = head_bytes
+        self.tail_bytes = tail_bytes
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total_bytes = 0
+        self.newlines = 0
+        self.ends_with_newline = True
+
+    def write(self, data):
+        if not data:
+            return
+        self.total_bytes += len(data)
+        self.newlines += data.count(b"\n")
+        self.ends_with_newline = data.endswith(b"\n")
+        room = self.head_bytes - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+        if data and self.tail_bytes > 0:
+            self.tail += data
+            # 超过两倍容量时再裁剪，均摊O(1)
+            if len(self.tail) > 2 * self.tail_bytes:
+                del self.tail[:-self.tail_bytes]
+
+    @property
+    def truncated(self):
+        return self.total_bytes > len(self.head) + min(len(self.tail), self.tail_bytes)
+
+    @property
+    def total_lines(self):
+        if self.total_bytes == 0:
+            return 0
+        return self.newlines + (0 if self.ends_with_newline else 1)
+
+    def getvalue(self):
+        """返回保留的内容，被省略的部分用截断标记代替"""
+        tail = bytes(self.tail[-self.tail_bytes:]) if self.tail_bytes > 0 else b""
+        if not self.truncated:
+            return (bytes(self.head) + tail).decode("utf-8", errors="ignore")
+        omitted = self.total_bytes - len(self.head) - len(tail)
+        return (
+            self.head.decode("utf-8", errors="ignore")
+            + f"\n...[输出过长，已省略中间{omitted}字节，共{self.total_bytes}字节/{self.total_lines}行]...\n"
+            + tail.decode("utf-8", errors="ignore")
+        )
+
+    def stats(self):
+        """输出统计和截断限制，写入MCP响应的result中"""
+        return {
+            "total_bytes": self.total_bytes,
+            "total_lines": self.total_lines,
+            "head_bytes": self.head_bytes,
+            "tail_bytes": self.tail_bytes
+        }
+
+
+class BoundedTextWriter(io.TextIOBase):
+    """把文本写入BoundedOutput，用于重定向Python代码的stdout"""
+
+    def __init__(self, output):
+        self.output = output
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self.output.write(text.encode("utf-8", errors="replace"))
+        return len(text)
+
+
+def collect_truncation(outputs):
+    """汇总被截断的输出：{名称: 统计信息}，没有截断时返回None"""
+    truncation = {name: output.stats() for name, output in outputs.items() if output.truncated}
+    return truncation or None
+
+
+def drain_stream(stream, output):
+    """把子进程的输出流持续读入BoundedOutput，直到EOF"""
+    try:
+        while True:
+            chunk = os.read(stream.fileno(), 65536)
+            if not chunk:
+                break
+            output.write(chunk)
+    except OSError:
+        pass
+
+
+class McpScanner:
+    """
+    MCP请求块（;;{...};;）的增量扫描器：
+    跟踪JSON字符串（包括转义）和括号嵌套，字符串中的"};;"不会把请求截断；
+    候选块在字符串外遇到";"、右括号后面不是";;"、闭合后不是合法的JSON或者到文本结束仍未闭合时放弃，
+    从它的"{"之后重新扫描（例如不成对的引号会把后面真正的块吞进候选块），结果与在每个";;{"处尝试解析JSON相同；
+    文本可以分段喂入，普通字符用正则整段跳过，除被放弃的候选块外每个字符只检查一次
+    """
+
+    OUTSIDE, OBJECT, CLOSING = 0, 1, 2
+    # 候选块中字符串外需要处理的字符
+    OBJECT_SPECIAL = re.compile(r'["{}\[\];]')
+    # 字符串内容（含转义）一直到结束的引号或本段末尾的"\"之前
+    STRING_BODY = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL)
+
+    def __init__(self):
+        self.state = self.OUTSIDE
+        self.offset = 0  # 已喂入文本的总长度
+        self.semicolons = 0  # 块外末尾连续的";"个数（最多记2个），可能和下一段组成块的开头
+        self.block_start = None  # 当前候选块（";;"）在全文中的位置
+        self.parts = []  # 当前候选块已接收的JSON文本
+        self.json_from = 0  # 正在扫描的文本中属于当前候选块JSON文本的起点
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.closing = 0  # 右括号之后已匹配的";"个数
+
+    @classmethod
+    def find_all(cls, text):
+        """返回完整文本中所有MCP块的JSON字符串"""
+        scanner = cls()
+        blocks = scanner.feed(text) + scanner.finish()
+        return [mcp_str for _, _, mcp_str in blocks]
+
+    @property
+    def pending_start(self):
+        """尚未闭合的候选块在全文中的起点，没有时返回None"""
+        return None if self.state == self.OUTSIDE else self.block_start
+
+    def open_block(self, start):
+        self.state = self.OBJECT
+        self.block_start = start
+        self.parts = []
+        self.depth = 1
+        self.in_string = False
+        self.escape = False
+        self.semicolons = 0
+
+    def reset_block(self, semicolons):
+        self.state = self.OUTSIDE
+        self.block_start = None
+        self.parts = []
+        self.semicolons = semicolons
+
+    def abandon_block(self, received=""):
+        """
+        放弃当前的候选块
+        :param received: 本段中属于候选块、还没有加入parts的文本
+        :return: (重新扫描的起点, 文本)，即候选块"{"之后已接收的全部文本
+        """
+        if self.state == self.CLOSING:
+            received = ";" * self.closing
+        text = ("".join(self.parts) + received)[1:]
+        start = self.block_start + 3
+        self.reset_block(0)
+        return start, text
+
+    def feed(self, chunk):
+        """
+        喂入一段文本
+        :return: 本段中完成的块 [(起点, 终点, JSON字符串), ...]，位置是在全文中的下标（终点不含）
+        """
+        blocks = []
+        self.scan(chunk, self.offset, blocks)
+        self.offset += len(chunk)
+        return blocks
+
+    def finish(self):
+        """
+        文本结束：未闭合的候选块不是MCP块，从它的"{"之后重新扫描
+        :return: 因此找到的块，格式同feed
+        """
+        blocks = []
+        while self.state != self.OUTSIDE:
+            start, text = self.abandon_block()
+            self.scan(text, start, blocks)
+        self.semicolons = 0
+        return blocks
+
+    def scan(self, chunk, base, blocks):
+        """扫描从全文位置base开始的一段文本，完成的块追加到blocks"""
+        # 待扫描的 (文本, 起点, 文本在全文中的位置)：放弃候选块时先重新扫描它的内容，再继续当前文本
+        pending = [(chunk, 0, base)]
+        while pending:
+            chunk, i, base = pending.pop()
+            if self.scan_text(chunk, i, base, blocks, pending):
+                continue
+            if self.state == self.OBJECT:
+                self.parts.append(chunk[self.json_from:])
+
+    def scan_text(self, chunk, i, base, blocks, pending):
+        """
+        从chunk[i]开始扫描
+        :return: 是否因放弃候选块而中断（此时重新扫描的文本和剩余的文本已加入pending）
+        """
+        n = len(chunk)
+        self.json_from = i
+        while i < n:
+            if self.state == self.OUTSIDE:
+                if self.semicolons:
+                    c = chunk[i]
+                    if c == "{" and self.semicolons == 2:
+                        self.open_block(base + i - 2)
+                        self.json_from = i
+                        i += 1
+                        continue
+                    self.semicolons = 2 if c == ";" else 0
+                    if c == ";":
+                        i += 1
+                        continue
+                start = chunk.find(";;{", i)
+                if start == -1:
+                    end = n
+                    while end > i and end > n - 2 and chunk[end - 1] == ";":
+                        end -= 1
+                    self.semicolons = n - end
+                    break
+                self.open_block(base + start)
+                self.json_from = start + 2
+                i = start + 3
+
+            elif self.state == self.OBJECT:
+                if self.in_string:
+                    if self.escape:
+                        self.escape = False
+                        i += 1
+                        continue
+                    i = self.STRING_BODY.match(chunk, i).end()
+                    if i == n:
+                        break
+                    if chunk[i] == '"':
+                        self.in_string = False
+                    else:
+                        # 本段以"\"结尾，转义的字符在下一段
+                        self.escape = True
+                    i += 1
+                    continue
+                match = self.OBJECT_SPECIAL.search(chunk, i)
+                if match is None:
+                    break
+                i = match.end()
+                c = match.group()
+                if c == '"':
+                    self.in_string = True
+                elif c == "{" or c == "[":
+                    self.depth += 1
+                elif c == "}" or c == "]":
+                    self.depth -= 1
+                    if self.depth == 0:
+                        self.parts.append(chunk[self.json_from:i])
+                        self.state = self.CLOSING
+                        self.closing = 0
+                else:
+                    # 字符串外的";"：这不是JSON，重新扫描候选块的内容后从这个";"继续
+                    self.backtrack(chunk, i - 1, base, pending)
+                    return True
+
+            else:
+                if chunk[i] != ";":
+                    # 右括号后面不是";;"：不是MCP块，重新扫描候选块的内容后从当前字符继续
+                    self.backtrack(chunk, i, base, pending)
+                    return True
+                i += 1
+                self.closing += 1
+                if self.closing == 2:
+                    mcp_str = "".join(self.parts)
+                    if not self.is_json(mcp_str):
+                        self.backtrack(chunk, i, base, pending)
+                        return True
+                    blocks.append((self.block_start, base + i, mcp_str))
+                    self.reset_block(0)
+        return False
+
+    def backtrack(self, chunk, position, base, pending):
+        """放弃当前的候选块：先重新扫描它的内容，再从chunk[position]继续"""
+        start, text = self.abandon_block(chunk[self.json_from:position])
+        pending.append((chunk, position, base))
+        pending.append((text, 0, start))
+
+    @staticmethod
+    def is_json(text):
+        try:
+            json.loads(text)
+        except ValueError:
+            return False
+        return True
+
+
+class StreamRenderer:
+    """流式输出渲染器：边接收边打印AI回复，隐藏回复中的MCP请求块"""
+
+    def __init__(self, ai_name, output=None, before_write=None):
+        self.ai_name = ai_name
+        # 提前保存输出流，避免Python模块重定向stdout时把AI回复吞掉
+        self.output = output or sys.stdout
+        self.before_write = before_write  # 输出前调用（用于先写出已记录的日志）
+        self.scanner = McpScanner()
+        self.chunks = []  # 收到的全部文本，结束时才拼接
+        self.unprinted = deque()  # 还没有输出完的文本段：[(在全文中的起点, 文本), ...]
+        self.blocks = deque()  # 已完整、还没有跳过的MCP块：[(起点, 终点), ...]
+        self.length = 0
+        self.printed_pos = 0
+        self.started = False
+
+    @property
+    def text(self):
+        return "".join(self.chunks)
+
+    def feed(self, chunk):
+        """追加一段文本，返回本次新出现的完整MCP块（JSON字符串列表）"""
+        self.chunks.append(chunk)
+        self.unprinted.append((self.length, chunk))
+        self.length += len(chunk)
+        new_blocks = []
+        for start, end, mcp_str in self.scanner.feed(chunk):
+            self.blocks.append((start, end))
+            new_blocks.append(mcp_str)
+        self.render(final=False)
+        return new_blocks
+
+    def finish(self):
+        """流结束：输出剩余内容（未闭合的候选块按普通文本输出，其中的MCP块仍然隐藏）"""
+        for start, end, _ in self.scanner.finish():
+            self.blocks.append((start, end))
+        self.render(final=True)
+        if self.started:
+            self.output.write("\n")
+            self.output.flush()
+
+    def render(self, final):
+        """输出所有已确定不属于MCP块的文本（流结束时未闭合的候选块按普通文本输出）"""
+        if final:
+            safe_end = self.length
+        else:
+            pending_start = self.scanner.pending_start
+            # 末尾的";"可能是下一个块的开头，先保留
+            safe_end = pending_start if pending_start is not None else self.length - self.scanner.semicolons
+        while self.printed_pos < safe_end:
+            if self.blocks and self.blocks[0][0] < safe_end:
+                start, end = self.blocks.popleft()
+                self.write(self.slice(self.printed_pos, start))
+                self.printed_pos = end
+            else:
+                self.write(self.slice(self.printed_pos, safe_end))
+                self.printed_pos = safe_end
+        while self.unprinted and self.unprinted[0][0] + len(self.unprinted[0][1]) <= self.printed_pos:
+            self.unprinted.popleft()
+
+    def slice(self, start, end):
+        """取全文中[start, end)的文本（只会落在还没有输出的文本段中）"""
+        parts = []
+        for base, chunk in self.unprinted:
+            if base >= end:
+                break
+            if base + len(chunk) > start:
+                parts.append(chunk[max(0, start - base):end - base])
+        return "".join(parts)
+
+    def write(self, text):
+        if not self.started:
+            # 回复开头（或MCP块之间）的空白不单独输出
+            text = text.lstrip()
+        if not text:
+            return
+        if self.before_write is not None:
+            self.before_write()
+        if not self.started:
+            self.output.write(f"{self.ai_name}: ")
+            self.started = True
+        self.output.write(text)
+        self.output.flush()
+
+# ===================== 日志 =====================
+# 各日志事件在哪些logger模式下显示到控制台（日志文件记录所有事件）
+LOG_EVENT_MODES = {
+    "ai_message": ("all", "format"),
+    "context": ("all", "format"),
+    "mcp_request": ("all", "format"),
+    "mcp_response": ("all", "format"),
+    "terminal_command": ("all", "format", "lite"),
+    "terminal_result": ("all", "format", "lite"),
+    "terminal_error": ("all", "format", "lite"),
+    "python_command": ("all", "format", "lite"),
+    "python_script": ("all", "format", "lite"),
+    "python_result": ("all", "format", "lite"),
+    "python_error": ("all", "format", "lite"),
+    "mcp_plugin": ("all", "format"),
+    "mcp_plugin_error": ("all", "format", "lite"),
+    "api_retry": ("all", "format", "lite"),
+    "api_hedge": ("all", "format"),
+    "cache_replay_fallback": ("all", "format", "lite"),
+    "cache_write_error": ("all", "format", "lite")
+}
+
+class ConsoleLogRenderer(logging.Formatter):
+    """控制台渲染器：在后台写入线程中按记录产生时的logger模式（all/format/lite）把结构化日志渲染为文本"""
+
+    def format(self, record):
+        render = getattr(self, f"render_{record.event}")
+        return "\n".join(render(record.mode, **record.fields))
+
+    def render_ai_message(self, mode, name, message):
+        if isinstance(message, str) and message.startswith(";;") and message.endswith(";;"):
+            try:
+                json_data = json.loads(message[2:-2])
+            except json.JSONDecodeError:
+                return [f"[日志] {name}: {message}"]
+            if mode == "all":
+                return [f"[日志] {name}: {json.dumps(json_data, ensure_ascii=False, separators=(',', ':'))}"]
+            return [f"[日志] {name}:", format_json_for_log(json_data, "  ")]
+        return [f"[日志] {name}: {message}"]
+
+    def render_context(self, mode, report):
+        if mode == "all":
+            return [f"[日志] 上下文: {json.dumps(report, ensure_ascii=False, separators=(',', ':'))}"]
+        return ["[日志] 上下文:", format_json_for_log(report, "  ")]
+
+    def render_mcp_request(self, mode, request):
+        if mode == "all":
+            return [f"[日志] mcp请求:\n{dumps_json(request)}"]
+        return ["[日志] mcp请求:", format_json_for_log(request, "  ")]
+
+    def render_mcp_response(self, mode, response):
+        if mode == "all":
+            return [f"[日志] mcp返回:\n{response.serialize()[2:-2]}"]
+        return ["[日志] mcp返回:", format_json_for_log(response.to_dict(), "  ")]
+
+    def render_terminal_command(self, mode, command):
+        return [f"[system@terminal:run] 执行终端命令: {command}"]
+
+    def render_terminal_result(self, mode, output, error):
+        if mode == "all":
+            lines = []
+            if output:
+                lines.append(f"[system@terminal:run] 命令输出: {output}")
+            if error:
+                lines.append(f"[system@terminal:run] 命令错误: {error}")
+            return lines
+        if mode == "format":
+            lines = ["[system@terminal:run] 终端命令执行结果:"]
+            if output:
+                lines.append(f"  输出: {output}")
+            if error:
+                lines.append(f"  错误: {error}")
+            return lines
+        # lite模式只显示简洁的执行结果
+        if error:
+            return [f"[system@terminal:run] 执行结果: 错误: {error}"]
+        return [f"[system@terminal:run] 执行结果: {output or '命令执行成功（无输出）'}"]
+
+    def render_terminal_error(self, mode, error):
+        if mode == "lite":
+            return [f"[system@terminal:run] 执行结果: 错误: {error}"]
+        return [f"[system@terminal:run] 终端命令执行错误: {error}"]
+
+    def render_python_command(self, mode, command):
+        return [f"[python@run:execute] 执行Python命令: {command}"]
+
+    def render_python_script(self, mode, lines):
+        if mode == "lite":
+            return [f"[python@run:execute] 执行Python脚本（共{len(lines)}行）"]
+        return ["[python@run:execute] 执行Python脚本:", "  脚本内容:"] + [f"    {i}: {line}" for i, line in enumerate(lines, 1)]
+
+    def render_python_result(self, mode, kind, result):
+        if mode == "all":
+            return [f"[python@run:execute] Python{kind}执行结果: {result if result else '无输出'}"]
+        if mode == "format":
+            return [f"[python@run:execute] Python{kind}执行结果:", f"  输出: {result if result else '无输出'}"]
+        # lite模式只显示简洁的执行结果
+        return [f"[python@run:execute] 执行结果: {result if result else '执行成功（无输出）'}"]
+
+    def render_python_error(self, mode, kind, error):
+        if mode == "lite":
+            return [f"[python@run:execute] 执行结果: 错误: {error}"]
+        return [f"[python@run:execute] Python{kind}执行错误: {error}"]
+
+    def render_mcp_plugin(self, mode, name, path):
+        return [f"[mcp@plugin:load] 已注册插件模块 {name}（{path}）"]
+
+    def render_mcp_plugin_error(self, mode, name, path, error):
+        return [f"[mcp@plugin:load] 插件 {name} 加载失败（{path}）: {error}"]
+
+    def render_api_retry(self, mode, url, error, delay, next_url):
+        if next_url != url:
+            return [f"[api] 请求 {url} 失败（{error}），改用 {next_url}"]
+        return [f"[api] 请求 {url} 失败（{error}），{delay:.1f}秒后重试"]
+
+    def render_api_hedge(self, mode, url, hedge_url, after):
+        return [f"[api] {url} 超过{after}秒未响应，同时向 {hedge_url} 发送请求"]
+
+    def render_cache_replay_fallback(self, mode, seq, model):
+        return [f"[缓存] 回放记录中没有与本次请求相同的记录，按记录顺序使用第{seq}条回复（模型 {model}），回复可能对应不同的问题"]
+
+    def render_cache_write_error(self, mode, error):
+        return [f"[缓存] 回复已收到，但写入回复缓存失败: {error}"]
+
+class JsonLinesLogFormatter(logging.Formatter):
+    """日志文件格式：每条记录一行JSON"""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "event": record.event
+        }
+        entry.update(record.fields)
+        return dumps_json(entry)
+
+class LogQueueHandler(logging.Handler):
+    """把记录原样放入队列，格式化全部留给后台写入线程"""
+
+    def __init__(self, log_queue):
+        super().__init__()
+        self.queue = log_queue
+
+    def emit(self, record):
+        self.queue.put(record)
+
+class LogWriter(threading.Thread):
+    """后台写入线程：把队列中的日志记录交给各个handler处理，并响应flush请求"""
+
+    def __init__(self, log_queue, handlers):
+        super().__init__(name="log-writer", daemon=True)
+        self.queue = log_queue
+        self.handlers = handlers
+        self.pending = 0
+        self.pending_lock = threading.Lock()
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            flushed = getattr(record, "flushed", None)
+            if flushed is not None:
+                flushed.set()
+                continue
+            try:
+                for handler in self.handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+            finally:
+                with self.pending_lock:
+                    self.pending -= 1
+
+    def stop(self):
+        """写出队列中剩余的记录后结束线程"""
+        self.queue.put(None)
+        self.join()
+
+class AgentLog:
+    """
+    结构化日志：调用方只在事件需要记录时才构造记录，渲染和写入都由后台线程完成；
+    控制台按logger模式渲染，log_file不为空时同时以JSONL格式写入按大小轮转的日志文件
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.logger = logging.Logger("agentcli")
+        self.logger.propagate = False
+        self.writer = None  # 后台写入线程在第一条记录产生时才启动
+        self.start_lock = threading.Lock()
+        handlers = []
+        # 提前绑定输出流，避免Python模块重定向stdout时把日志写进执行结果
+        console = logging.StreamHandler(sys.stdout)
+        console.setFormatter(ConsoleLogRenderer())
+        console.addFilter(lambda record: record.mode in LOG_EVENT_MODES[record.event])
+        handlers.append(console)
+        self.file_enabled = bool(config.log_file)
+        if self.file_enabled:
+            from logging.handlers import RotatingFileHandler
+            log_file = RotatingFileHandler(
+                config.log_file,
+                maxBytes=config.log_file_max_bytes,
+                backupCount=config.log_file_backups,
+                encoding="utf-8",
+                delay=True
+            )
+            log_file.setFormatter(JsonLinesLogFormatter())
+            handlers.append(log_file)
+        self.queue = queue.SimpleQueue()
+        self.logger.addHandler(LogQueueHandler(self.queue))
+        self.handlers = handlers
+
+    def enabled(self, event):
+        """事件是否需要记录（用于在构造开销较大的字段前判断）"""
+        return self.file_enabled or self.config.logger in LOG_EVENT_MODES[event]
+
+    def emit(self, event, level=logging.INFO, **fields):
+        """记录一个日志事件，字段原样交给后台线程渲染"""
+        mode = self.config.logger
+        if not self.file_enabled and mode not in LOG_EVENT_MODES[event]:
+            return
+        if self.writer is None:
+            self.start()
+        record = self.logger.makeRecord(
+            self.logger.name, level, "agent", 0, event, None, None,
+            extra={"event": event, "mode": mode, "fields": fields}
+        )
+        with self.writer.pending_lock:
+            self.writer.pending += 1
+        self.logger.handle(record)
+
+    def error(self, event, **fields):
+        self.emit(event, logging.ERROR, **fields)
+
+    def start(self):
+        with self.start_lock:
+            if self.writer is None:
+                writer = LogWriter(self.queue, self.handlers)
+                writer.start()
+                self.writer = writer
+
+    def flush(self, timeout=5.0):
+        """等待已记录的日志全部写出，在打印AI回复或等待输入之前调用，保证输出顺序"""
+        writer = self.writer
+        if writer is None or writer.pending <= 0:
+            return
+        record = logging.makeLogRecord({"flushed": threading.Event()})
+        self.queue.put(record)
+        record.flushed.wait(timeout)
+
+    def close(self):
+        """写出剩余日志并停止后台线程"""
+        if self.writer is not None:
+            self.writer.stop()
+            self.writer = None
+        for handler in self.handlers:
+            handler.close()
+
+# ===================== 性能追踪 =====================
+class TraceSpan:
+    """一个计时区间，退出时记录为Chrome trace的完整事件（ph为X）"""
+
+    __slots__ = ("tracer", "name", "args", "start")
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter()
+        if exc_type is not None:
+            self.args["error"] = f"{exc_type.__name__}: {exc_value}"
+        self.tracer.record(self.name, self.start, end, self.args)
+        return False
+
+class Tracer:
+    """
+    轻量的耗时追踪：各阶段用span()包裹，事件以Chrome trace格式追加写入trace_file，
+    可以在chrome://tracing或Perfetto中按线程查看火焰图；
+    未启用时span()直接返回共享的空上下文管理器，几乎没有开销
+    """
+
+    NULL_SPAN = contextlib.nullcontext()
+
+    def __init__(self, trace_file=""):
+        self.trace_file = trace_file
+        self.enabled = bool(trace_file)
+        self.pid = os.getpid()
+        self.events = []
+        self.thread_names = {}
+        self.lock = threading.Lock()
+        self.file = None
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return self.NULL_SPAN
+        return TraceSpan(self, name, args)
+
+    def record(self, name, start, end, args):
+        thread = threading.current_thread()
+        event = {
+            "name": name,
+            "cat": "agent",
+            "ph": "X",
+            # 时间戳单位为微秒
+            "ts": round(start * 1e6, 3),
+            "dur": round((end - start) * 1e6, 3),
+            "pid": self.pid,
+            "tid": thread.ident
+        }
+        if args:
+            event["args"] = args
+        with self.lock:
+            if thread.ident not in self.thread_names:
+                # 元数据事件：在查看器中显示线程名
+                self.thread_names[thread.ident] = thread.name
+                self.events.append({"name": "thread_name", "ph": "M", "pid": self.pid, "tid": thread.ident,
+                                    "args": {"name": thread.name}})
+            self.events.append(event)
+
+    def flush(self):
+        """把已记录的事件追加写入文件（JSON数组格式，末尾的]可以省略，因此可以一直追加）"""
+        if not self.enabled:
+            return
+        with self.lock:
+            events, self.events = self.events, []
+            if not events:
+                return
+            try:
+                if self.file is None:
+                    self.file = open(self.trace_file, "w", encoding="utf-8")
+                    self.file.write("[\n")
+                self.file.write("".join(f"{dumps_json(event)},\n" for event in events))
+                self.file.flush()
+            except OSError:
+                # 追踪文件写入失败不影响对话
+                self.enabled = False
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+# ===================== 运行指标 =====================
+class Histogram:
+    """
+    固定内存的直方图：按对数划分桶（每翻一倍分为8个桶，相对误差约4%），
+    记录任意多个值占用的内存不变，分位数由所在桶的中点估算
+    """
+
+    __slots__ = ("count", "total", "min", "max", "buckets")
+
+    BUCKETS_PER_DOUBLING = 8
+    LOWEST = 0.001  # 小于该值的都计入第0个桶
+    BUCKET_COUNT = 8 * 50  # 覆盖0.001到约1e12
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * self.BUCKET_COUNT
+
+    def bucket_of(self, value):
+        if value <= self.LOWEST:
+            return 0
+        index = int(math.log2(value / self.LOWEST) * self.BUCKETS_PER_DOUBLING) + 1
+        return min(index, self.BUCKET_COUNT - 1)
+
+    def bucket_middle(self, index):
+        if index == 0:
+            return self.LOWEST
+        low = self.LOWEST * 2 ** ((index - 1) / self.BUCKETS_PER_DOUBLING)
+        high = self.LOWEST * 2 ** (index / self.BUCKETS_PER_DOUBLING)
+        return math.sqrt(low * high)
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.buckets[self.bucket_of(value)] += 1
+
+    def percentile(self, fraction):
+        if not self.count:
+            return 0.0
+        rank = max(1, math.ceil(fraction * self.count))
+        seen = 0
+        for index, bucket in enumerate(self.buckets):
+            seen += bucket
+            if seen >= rank:
+                # 估算值不超出实际记录到的范围
+                return min(max(self.bucket_middle(index), self.min), self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "total": round(self.total, 3),
+            "mean": round(self.total / self.count, 3) if self.count else 0.0,
+            "min": round(self.min or 0.0, 3),
+            "p50": round(self.percentile(0.5), 3),
+            "p90": round(self.percentile(0.9), 3),
+            "p99": round(self.percentile(0.99), 3),
+            "max": round(self.max or 0.0, 3)
+        }
+
+
+class MetricsRegistry:
+    """
+    本次运行的性能指标：直方图记录耗时、大小、token数的分布，计数器记录累计次数；
+    名称中的[]部分为标签（如mcp.latency_ms[system.terminal.run]）
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.histograms = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "uptime_seconds": round(time.time() - self.started_at, 1),
+                "counters": dict(sorted(self.counters.items())),
+                "histograms": {name: histogram.summary() for name, histogram in sorted(self.histograms.items())}
+            }
+
+
+def format_metrics(snapshot):
+    """把指标快照格式化为;;stats命令显示的表格"""
+    lines = [f"📊 运行指标（已运行{snapshot['uptime_seconds']}秒）"]
+    histograms = snapshot["histograms"]
+    if histograms:
+        width = max(len(name) for name in histograms)
+        lines.append(f"   {'指标':<{width - 2}} {'次数':>6} {'p50':>10} {'p90':>10} {'p99':>10} {'最大':>8} {'总计':>10}")
+        for name, item in histograms.items():
+            lines.append(
+                f"   {name:<{width}} {item['count']:>8} {item['p50']:>10.2f} {item['p90']:>10.2f} "
+                f"{item['p99']:>10.2f} {item['max']:>10.2f} {item['total']:>12.2f}"
+            )
+    else:
+        lines.append("   暂无数据")
+    sections = (
+        ("计数", snapshot["counters"]),
+        ("MCP结果缓存", snapshot.get("mcp_cache") or {}),
+        ("对话历史", snapshot.get("chat_history") or {}),
+        ("回复缓存", snapshot.get("completion_cache") or {})
+    )
+    for title, values in sections:
+        if values:
+            lines.append(f"   {title}：" + "，".join(f"{key}={value}" for key, value in values.items()))
+    return "\n".join(lines)
+
+
+class MetricsDumper(threading.Thread):
+    """每隔interval秒把指标快照写入文件（先写临时文件再替换，读取方不会看到写了一半的内容）"""
+
+    def __init__(self, snapshot, path, interval):
+        super().__init__(name="metrics-dumper", daemon=True)
+        self.snapshot = snapshot
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.dump()
+
+    def dump(self):
+        temp_path = f"{self.path}.tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                f.write(dumps_json(self.snapshot()))
+            os.replace(temp_path, self.path)
+        except OSError:
+            pass
+
+    def stop(self):
+        """停止定时写入，并写入最后一次快照"""
+        self.stopped.set()
+        self.dump()
+
+# ===================== MCP消息 =====================
+class McpRequest:
+    """已解析的MCP请求"""
+
+    __slots__ = ("id", "module", "method", "func", "full_method", "params")
+
+    def __init__(self, req_id, module, full_method, params):
+        self.id = req_id
+        self.module = module
+        self.full_method = full_method
+        method_parts = full_method.split(".")
+        self.method = method_parts[0]
+        self.func = method_parts[1] if len(method_parts) > 1 else ""
+        self.params = params
+
+    @classmethod
+    def parse(cls, mcp_json):
+        """从AI回复中的请求JSON解析，格式错误时抛出ValueError"""
+        if not isinstance(mcp_json, dict):
+            raise ValueError("请求必须是JSON对象")
+        full_method = mcp_json.get("method", "")
+        params = mcp_json.get("params", {})
+        if not isinstance(full_method, str):
+            raise ValueError("method必须是字符串")
+        if not isinstance(params, dict):
+            raise ValueError("params必须是JSON对象")
+        return cls(mcp_json.get("id", ""), mcp_json.get("module", ""), full_method, params)
+
+    @property
+    def info(self):
+        """响应中回显的请求信息"""
+        return {"module": self.module, "method": self.full_method, "params": self.params}
+
+class McpResponse:
+    """
+    MCP响应：在分发、缓存和日志中以对象形式传递，
+    只在发送给API时序列化一次（结果会被保留，之后的日志和历史记录直接复用）
+    """
+
+    __slots__ = ("id", "info", "result", "error", "text")
+
+    # 序列化结果固定以此开头，紧接着是请求id
+    TEXT_PREFIX = ';;{"mcp":"response","id":'
+
+    def __init__(self, req_id, info, result=None, error=None):
+        self.id = req_id
+        self.info = info
+        self.result = result
+        self.error = error
+        self.text = None
+
+    @classmethod
+    def success(cls, req_id, info, result):
+        return cls(req_id, info, result=result)
+
+    @classmethod
+    def failure(cls, req_id, info, error_code, error_msg):
+        return cls(req_id, info, error={"code": error_code, "message": error_msg})
+
+    @property
+    def is_error(self):
+        return self.error is not None
+
+    def to_dict(self):
+        response = {"mcp": "response", "id": self.id, "info": self.info}
+        if self.error is None:
+            response["result"] = self.result
+        else:
+            response["error"] = self.error
+        return response
+
+    def serialize(self):
+        """序列化为;;json;;格式的字符串"""
+        if self.text is None:
+            self.text = f";;{dumps_json(self.to_dict())};;"
+        return self.text
+
+    def with_id(self, req_id):
+        """复用本响应的结果生成另一个请求的响应，已序列化时只替换id部分"""
+        response = McpResponse(req_id, self.info, self.result, self.error)
+        if self.text is not None:
+            old_id_end = len(self.TEXT_PREFIX) + len(dumps_json(self.id))
+            response.text = self.TEXT_PREFIX + dumps_json(req_id) + self.text[old_id_end:]
+        return response
+
+    def __str__(self):
+        return self.serialize()
+
+# ===================== MCP模块注册表 =====================
+class McpMethod:
+    """
+    一个MCP方法的注册信息
+    :param handler: 处理函数，接收McpRequest，返回McpResponse
+    :param title: 在system提示词中的标题，为None时不单独列出
+    :param examples: [(说明或None, 示例参数), ...]
+    :param notes: 补充说明列表，或返回说明列表的函数（内容随配置变化时使用）
+    :param cache: 结果缓存策略 session/readonly/never
+    :param side_effects: 执行后是否可能改变文件或工作目录
+    :param parallel: 是否可以和其他MCP请求并发执行
+    """
+
+    __slots__ = ("module", "name", "handler", "title", "examples", "notes", "cache", "side_effects", "parallel")
+
+    def __init__(self, name, handler, title=None, examples=(), notes=(), cache="never", side_effects=True,
+                 parallel=True):
+        self.module = None  # 注册时填入
+        self.name = name
+        self.handler = handler
+        self.title = title
+        self.examples = examples
+        self.notes = notes
+        self.cache = cache
+        self.side_effects = side_effects
+        self.parallel = parallel
+
+class McpModule:
+    """MCP模块：方法未知和执行失败时使用的错误码"""
+
+    __slots__ = ("name", "unknown_code", "failure_code", "failure_message")
+
+    def __init__(self, name, unknown_code, failure_code, failure_message):
+        self.name = name
+        self.unknown_code = unknown_code
+        self.failure_code = failure_code
+        self.failure_message = failure_message
+
+class McpRegistry:
+    """
+    MCP方法注册表：以(模块, "method.func")为键直接查找处理函数，
+    system提示词中的协议说明也由注册信息生成；每次注册变化时version加一
+    """
+
+    def __init__(self):
+        self.modules = {}
+        self.methods = {}  # (模块, "method.func") -> McpMethod，按注册顺序排列
+        self.version = 0
+
+    def add_module(self, module):
+        self.modules[module.name] = module
+        self.version += 1
+
+    def register(self, module_name, method):
+        method.module = module_name
+        self.methods[(module_name, method.name)] = method
+        self.version += 1
+
+    def remove_module(self, module_name):
+        self.modules.pop(module_name, None)
+        for key in [key for key in self.methods if key[0] == module_name]:
+            del self.methods[key]
+        self.version += 1
+
+    def lookup(self, module_name, method_name):
+        return self.methods.get((module_name, method_name))
+
+    def method_names(self, module_name):
+        return [name for module, name in self.methods if module == module_name]
+
+    def policy(self, module_name, method_name):
+        """结果缓存策略，未注册的方法不缓存并按有副作用处理"""
+        method = self.methods.get((module_name, method_name))
+        if method is None:
+            return {"cache": "never", "side_effects": True}
+        return {"cache": method.cache, "side_effects": method.side_effects}
+
+    @staticmethod
+    def format_request(request_id, module_name, method_name, params):
+        request = {"mcp": "request", "id": request_id, "module": module_name, "method": method_name, "params": params}
+        return f";;{dumps_json(request)};;"
+
+    def render_prompt(self):
+        """按注册顺序生成system提示词中的MCP方法说明"""
+        lines = []
+        number = 0
+        example_id = 0
+        for method in self.methods.values():
+            if method.title is None:
+                continue
+            number += 1
+            examples = []
+            for label, params in method.examples:
+                example_id += 1
+                examples.append((label, self.format_request(f"{example_id:03d}", method.module, method.name, params)))
+            if len(examples) == 1 and examples[0][0] is None:
+                lines.append(f"{number}. {method.title}：{examples[0][1]}")
+            else:
+                lines.append(f"{number}. {method.title}：")
+                lines.extend(f"- {label}：{example}" if label else f"- {example}" for label, example in examples)
+            notes = method.notes() if callable(method.notes) else method.notes
+            lines.extend(f"- {note}" for note in notes)
+        return lines
+
+class McpPlugin:
+    """
+    插件模块：注册信息从源码中的MCP_MODULE字面量读取（不执行插件代码），
+    插件代码在其方法第一次被调用时才导入
+    """
+
+    def __init__(self, name, path, import_name=None):
+        self.name = name
+        self.path = path
+        self.import_name = import_name  # 通过entry point安装的插件按包名导入
+        self.module = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if self.module is None:
+                if self.import_name:
+                    self.module = importlib.import_module(self.import_name)
+                else:
+                    spec = importlib.util.spec_from_file_location(f"mcp_modules.{self.name}", self.path)
+                    module = importlib.util.module_from_spec(spec)
+                    spec.loader.exec_module(module)
+                    self.module = module
+            return self.module
+
+    def make_handler(self, function_name):
+        def handler(parsed):
+            function = getattr(self.load(), function_name)
+            return McpResponse.success(parsed.id, parsed.info, function(parsed.params))
+        return handler
+
+def read_plugin_manifest(path):
+    """用AST读取插件源码中的MCP_MODULE字典，不导入插件"""
+    import ast
+    with open(path, "r", encoding="utf-8") as f:
+        tree = ast.parse(f.read(), filename=path)
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(
+            isinstance(target, ast.Name) and target.id == "MCP_MODULE" for target in node.targets
+        ):
+            manifest = ast.literal_eval(node.value)
+            if not isinstance(manifest, dict) or not isinstance(manifest.get("methods"), dict):
+                raise ValueError("MCP_MODULE必须是包含methods字典的字典")
+            return manifest
+    raise ValueError("未找到MCP_MODULE声明")
+
+def find_mcp_plugins(plugin_dir, entry_point_group=None):
+    """
+    查找插件：plugin_dir下的.py文件和包（含__init__.py的目录），以及指定entry point组中的模块
+    :return: [(模块名, 源文件路径, 导入名或None), ...]
+    """
+    found = []
+    if plugin_dir and os.path.isdir(plugin_dir):
+        for entry in sorted(os.scandir(plugin_dir), key=lambda item: item.name):
+            if entry.name.startswith(("_", ".")):
+                continue
+            if entry.is_file() and entry.name.endswith(".py"):
+                found.append((entry.name[:-3], entry.path, None))
+            elif entry.is_dir() and os.path.isfile(os.path.join(entry.path, "__init__.py")):
+                found.append((entry.name, os.path.join(entry.path, "__init__.py"), None))
+    if entry_point_group:
+        import importlib.metadata
+        try:
+            all_entry_points = importlib.metadata.entry_points()
+            if hasattr(all_entry_points, "select"):
+                group = all_entry_points.select(group=entry_point_group)
+            else:
+                group = all_entry_points.get(entry_point_group, [])
+        except Exception:
+            group = []
+        for entry_point in group:
+            import_name = entry_point.value.split(":")[0].strip()
+            try:
+                spec = importlib.util.find_spec(import_name)
+            except (ImportError, ValueError):
+                spec = None
+            if spec is not None and spec.origin and spec.origin.endswith(".py"):
+                found.append((entry_point.name, spec.origin, import_name))
+    return found
+
+def load_mcp_plugin(registry, name, path, import_name=None):
+    """读取插件的注册信息并注册其方法（插件代码不会被导入）"""
+    manifest = read_plugin_manifest(path)
+    name = manifest.get("name", name)
+    if name in registry.modules:
+        raise ValueError(f"模块名{name}已被占用")
+    plugin = McpPlugin(name, path, import_name)
+    registry.add_module(McpModule(
+        name,
+        manifest.get("unknown_code", 3001),
+        manifest.get("failure_code", 3002),
+        manifest.get("failure_message", f"{name}模块执行失败")
+    ))
+    for method_name, schema in manifest["methods"].items():
+        params = schema.get("params", {})
+        notes = [f"参数：{'，'.join(f'{key}（{value}）' for key, value in params.items())}"] if params else []
+        if schema.get("description"):
+            notes.insert(0, schema["description"])
+        registry.register(name, McpMethod(
+            method_name,
+            plugin.make_handler(schema.get("handler", method_name.replace(".", "_"))),
+            title=schema.get("title", f"{name}模块 {method_name}"),
+            examples=[(None, schema.get("example", {key: "" for key in params}))],
+            notes=notes,
+            cache="session" if schema.get("cache") == "session" else "never",
+            side_effects=bool(schema.get("side_effects", True)),
+            parallel=bool(schema.get("parallel", True))
+        ))
+    return name
+
+# ===================== MCP结果缓存 =====================
+class McpResultCache:
+    """
+    幂等MCP方法的结果缓存：按模块、方法和规范化后的参数为键，
+    按注册表中各方法的缓存策略决定是否缓存及有效期，LRU淘汰并限制总大小
+    缓存策略：session（整个会话内有效）/ readonly（仅缓存只读命令，按TTL过期）/ never（不缓存）
+    """
+
+    # 出现这些字符的命令可能写文件、串联其他命令或执行子命令，不视为只读
+    UNSAFE_SHELL_CHARS = set(";&|<>`$\n")
+    # 允许列表中的命令带上这些选项时会删除/写入文件、执行其他命令或一直运行，不视为只读：
+    # (以这些前缀开头的参数, 组合短选项中出现即不安全的字母)
+    UNSAFE_COMMAND_OPTIONS = {
+        "find": (("-delete", "-exec", "-ok", "-fprint", "-fls"), ""),
+        "tail": (("--follow",), "fF"),
+        "tree": (("-o",), "o"),
+    }
+    # 带参数时会修改系统状态的命令：只有不带参数或只带这些选项时才视为只读（如hostname NAME会修改主机名）
+    READONLY_COMMAND_ARGS = {
+        "hostname": {"-s", "--short", "-f", "--fqdn", "--long", "-d", "--domain", "-i", "--ip-address",
+                     "-I", "--all-ip-addresses", "-A", "--all-fqdns", "-a", "--alias"},
+    }
+
+    def __init__(self, registry, max_bytes, readonly_ttl, readonly_commands):
+        self.registry = registry
+        self.max_bytes = max_bytes
+        self.readonly_ttl = readonly_ttl
+        self.readonly_commands = set(readonly_commands)
+        self.entries = OrderedDict()  # 键 -> (过期时间或None, 缓存策略, McpResponse)
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def policy_of(self, parsed):
+        return self.registry.policy(parsed.module, parsed.full_method)
+
+    def is_readonly_terminal(self, params):
+        """terminal.run中的每条命令都以允许列表中的命令开头，且不含重定向、管道等"""
+        commands = [value for key, value in params.items() if key != "sequential"]
+        if not commands:
+            return False
+        for command in commands:
+            if not isinstance(command, str) or not command.strip():
+                return False
+            if self.UNSAFE_SHELL_CHARS.intersection(command):
+                return False
+            try:
+                words = shlex.split(command)
+            except ValueError:
+                return False
+            if not words or words[0] not in self.readonly_commands:
+                return False
+            if self.has_unsafe_options(words[0], words[1:]):
+                return False
+        return True
+
+    def has_unsafe_options(self, name, args):
+        allowed_args = self.READONLY_COMMAND_ARGS.get(name)
+        if allowed_args is not None:
+            return any(arg not in allowed_args for arg in args)
+        prefixes, short_letters = self.UNSAFE_COMMAND_OPTIONS.get(name, ((), ""))
+        for arg in args:
+            if arg.startswith(prefixes):
+                return True
+            if short_letters and arg.startswith("-") and not arg.startswith("--") and \
+                    any(letter in short_letters for letter in arg[1:]):
+                return True
+        return False
+
+    def make_key(self, parsed):
+        """返回缓存键，不可缓存的请求返回None"""
+        policy = self.policy_of(parsed)["cache"]
+        if policy == "never":
+            return None
+        if policy == "readonly" and not self.is_readonly_terminal(parsed.params):
+            return None
+        params = json.dumps(parsed.params, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        return (parsed.module, parsed.full_method, params)
+
+    def get(self, key, req_id):
+        """命中时返回替换为当前请求id的响应"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] <= time.monotonic():
+                self.remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            response = entry[2]
+        return response.with_id(req_id)
+
+    def put(self, key, parsed, response):
+        """缓存成功的响应"""
+        if response.is_error:
+            return
+        size = len(response.serialize())
+        if size > self.max_bytes:
+            return
+        policy = self.policy_of(parsed)["cache"]
+        expires_at = time.monotonic() + self.readonly_ttl if policy == "readonly" else None
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (expires_at, policy, response)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self.remove(oldest)
+                self.evictions += 1
+
+    def remove(self, key):
+        entry = self.entries.pop(key)
+        self.total_bytes -= len(entry[2].text)
+
+    def after_execute(self, parsed):
+        """执行了有副作用的请求后，只读命令的结果可能已经过期"""
+        if not self.policy_of(parsed)["side_effects"]:
+            return
+        with self.lock:
+            stale = [key for key, entry in self.entries.items() if entry[1] == "readonly"]
+            for key in stale:
+                self.remove(key)
+            self.invalidations += len(stale)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
+
+# ===================== 对话历史 =====================
+class HistoryEntry:
+    """
+    一条对话历史：role是驻留的字符串，content在内存中时与其他相同内容的条目共用同一个对象，
+    转存到磁盘后只保留在转存文件中的位置，读取时再从文件中取回；按entry["role"]/entry["content"]访问
+    """
+
+    __slots__ = ("role", "text", "offset", "size", "owner")
+
+    def __init__(self, owner, role, text):
+        self.owner = owner
+        self.role = role
+        self.text = text  # 转存到磁盘后为None
+        self.offset = -1
+        self.size = 0
+
+    def __getitem__(self, key):
+        if key == "role":
+            return self.role
+        if key == "content":
+            return self.text if self.text is not None else self.owner.page_in(self)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self):
+        return {"role": self.role, "content": self["content"]}
+
+
+class ChatHistory:
+    """
+    本次会话的对话历史，用法与消息字典列表相同（append/遍历/下标/len）：
+    相同的内容只在内存中保存一份；内存占用超过memory_limit时，从最早的条目开始把内容转存到临时文件
+    （文件中相同的内容也只写一次），需要时再读回，最近读回的内容保留在一个有大小上限的缓存中
+    :param memory_limit: 内容在内存中占用的上限（字节），0表示不限制
+    :param spill_dir: 转存文件所在目录，为空时使用系统临时目录
+    """
+
+    SPILL_TARGET = 0.75  # 超出上限时转存到占用降到上限的该比例，避免每次追加都转存
+
+    def __init__(self, memory_limit=0, spill_dir=""):
+        self.memory_limit = memory_limit
+        self.spill_dir = spill_dir
+        self.entries = []
+        self.lock = threading.Lock()
+        self.contents = {}  # 内存中的内容 -> [共用的字符串, 引用的条目数]
+        self.memory_bytes = 0  # 内存中（去重后）内容的大小
+        self.resident_from = 0  # 该下标之前的条目都已转存
+        self.spill_file = None  # 第一次转存时才创建
+        self.spill_bytes = 0
+        self.spilled = {}  # 已转存内容的摘要 -> (位置, 字节数)
+        self.page_cache = OrderedDict()  # 位置 -> 最近读回的内容
+        self.page_cache_bytes = 0
+        self.page_ins = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        with self.lock:
+            entries = list(self.entries)
+        return iter(entries)
+
+    def __getitem__(self, index):
+        with self.lock:
+            return self.entries[index]
+
+    def __bool__(self):
+        return bool(self.entries)
+
+    def append(self, message):
+        """追加一条消息（{"role": ..., "content": ...}）"""
+        with self.lock:
+            entry = HistoryEntry(self, sys.intern(message["role"]), self.share(message["content"]))
+            self.entries.append(entry)
+            if self.memory_limit > 0 and self.memory_bytes > self.memory_limit:
+                self.spill(int(self.memory_limit * self.SPILL_TARGET))
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    def to_list(self):
+        """返回消息字典列表（会读回已转存的内容）"""
+        return [entry.to_dict() for entry in self]
+
+    def share(self, content):
+        """返回与已有相同内容共用的字符串对象"""
+        shared = self.contents.get(content)
+        if shared is None:
+            shared = self.contents[content] = [content, 0]
+            self.memory_bytes += sys.getsizeof(content)
+        shared[1] += 1
+        return shared[0]
+
+    def release(self, content):
+        shared = self.contents[content]
+        shared[1] -= 1
+        if shared[1] == 0:
+            del self.contents[content]
+            self.memory_bytes -= sys.getsizeof(content)
+
+    def spill(self, target):
+        """从最早仍在内存中的条目开始转存，直到内存占用不超过target（最新的一条始终保留在内存中）"""
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile(prefix="agentcli-history-", dir=self.spill_dir or None)
+        last = len(self.entries) - 1
+        while self.memory_bytes > target and self.resident_from < last:
+            entry = self.entries[self.resident_from]
+            self.resident_from += 1
+            data = entry.text.encode("utf-8")
+            digest = hashlib.blake2b(data, digest_size=16).digest()
+            location = self.spilled.get(digest)
+            if location is None:
+                self.spill_file.seek(0, os.SEEK_END)
+                location = self.spilled[digest] = (self.spill_file.tell(), len(data))
+                self.spill_file.write(data)
+                self.spill_bytes += len(data)
+            self.release(entry.text)
+            entry.offset, entry.size = location
+            entry.text = None
+
+    def page_in(self, entry):
+        """从转存文件中读回条目的内容"""
+        with self.lock:
+            cached = self.page_cache.get(entry.offset)
+            if cached is not None:
+                self.page_cache.move_to_end(entry.offset)
+                return cached
+            if self.spill_file is None:
+                raise ValueError("对话历史已关闭，已转存到磁盘的内容不再可读")
+            self.spill_file.seek(entry.offset)
+            content = self.spill_file.read(entry.size).decode("utf-8")
+            self.page_ins += 1
+            # 读回的内容最多占用内存上限的四分之一
+            self.page_cache[entry.offset] = content
+            self.page_cache_bytes += sys.getsizeof(content)
+            while self.page_cache and self.page_cache_bytes > self.memory_limit // 4:
+                _, evicted = self.page_cache.popitem(last=False)
+                self.page_cache_bytes -= sys.getsizeof(evicted)
+            return content
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "unique_contents": len(self.contents),
+                "memory_bytes": self.memory_bytes,
+                "spilled_entries": self.resident_from,
+                "spill_bytes": self.spill_bytes,
+                "page_ins": self.page_ins
+            }
+
+    def close(self):
+        """关闭并删除转存文件，已转存的条目不再可读"""
+        with self.lock:
+            if self.spill_file is not None:
+                self.spill_file.close()
+                self.spill_file = None
+            self.page_cache.clear()
+            self.page_cache_bytes = 0
+
+# ===================== 上下文组装 =====================
+def get_token_counter(tokenizer):
+    """返回计算token数的函数，tiktoken不可用时回退为本地估算"""
+    if tokenizer == "tiktoken":
+        try:
+            import tiktoken
+            encoding = tiktoken.get_encoding("cl100k_base")
+            return lambda text: len(encoding.encode(text, disallowed_special=())) if text else 0
+        except Exception:
+            pass
+    return estimate_tokens
+
+
+class ContextAssembler:
+    """
+    按token预算组装发送给API的消息，优先级：system提示词 > 当前输入 > 最近的对话 > 更早的对话 > 已保存的历史
+    放不下的旧对话先替换为摘要，摘要也放不下时丢弃；token数和摘要按内容缓存
+    """
+
+    MESSAGE_OVERHEAD = 4  # 每条消息的格式开销（role等）
+    CACHE_SIZE = 4096
+    KEY_MAX_CHARS = 4096  # 更长的内容按摘要缓存，缓存不会让已转存的长内容一直留在内存中
+
+    def __init__(self, budget, summary_chars, count_tokens):
+        self.budget = budget
+        self.summary_chars = summary_chars
+        self.count_tokens = count_tokens
+        # 内容 -> token数 / 摘要（str的哈希值会缓存在对象上，重复查找很便宜）
+        self.token_cache = OrderedDict()
+        self.summary_cache = OrderedDict()
+
+    def cache_key(self, content):
+        if len(content) <= self.KEY_MAX_CHARS:
+            return content
+        return len(content), hashlib.blake2b(content.encode("utf-8"), digest_size=16).digest()
+
+    def tokens_of(self, content):
+        key = self.cache_key(content)
+        cached = self.token_cache.get(key)
+        if cached is None:
+            cached = self.count_tokens(content) + self.MESSAGE_OVERHEAD
+            self.token_cache[key] = cached
+            if len(self.token_cache) > self.CACHE_SIZE:
+                self.token_cache.popitem(last=False)
+        return cached
+
+    def summary_of(self, content):
+        key = self.cache_key(content)
+        cached = self.summary_cache.get(key)
+        if cached is None:
+            text = " ".join(content.split())
+            if len(text) > self.summary_chars:
+                text = f"{text[:self.summary_chars]}…（摘要，原文共{len(content)}字）"
+            cached = text
+            self.summary_cache[key] = cached
+            if len(self.summary_cache) > self.CACHE_SIZE:
+                self.summary_cache.popitem(last=False)
+        return cached
+
+    @staticmethod
+    def group_turns(entries):
+        """把历史记录按轮次分组（每组以user消息开头），保证不会只留下半轮对话"""
+        turns = []
+        for entry in entries:
+            if entry["role"] == "user" or not turns:
+                turns.append([])
+            turns[-1].append(entry)
+        return turns
+
+    def fit_turns(self, turns, remaining):
+        """
+        从新到旧为每轮对话选择完整/摘要/丢弃
+        :return: (选中的轮次[(轮次, 是否为摘要)]（按时间顺序）, 剩余预算, 统计)
+        """
+        selected = []
+        stats = {"total": len(turns), "full": 0, "summarized": 0, "dropped": 0, "tokens": 0}
+        full_allowed = True
+        summary_allowed = self.summary_chars > 0
+        for turn in reversed(turns):
+            if full_allowed:
+                cost = sum(self.tokens_of(entry["content"]) for entry in turn)
+                if remaining is None or cost <= remaining:
+                    selected.append((turn, False))
+                    stats["full"] += 1
+                    stats["tokens"] += cost
+                    if remaining is not None:
+                        remaining -= cost
+                    continue
+                # 保证上下文连续：一旦某轮放不下，更早的轮次都不再完整发送
+                full_allowed = False
+            if summary_allowed:
+                cost = sum(self.tokens_of(self.summary_of(entry["content"])) for entry in turn)
+                if cost <= remaining:
+                    selected.append((turn, True))
+                    stats["summarized"] += 1
+                    stats["tokens"] += cost
+                    remaining -= cost
+                    continue
+                # 摘要同样保持连续：更早的轮次直接丢弃，不必再读取它们（可能已转存到磁盘）的内容
+                summary_allowed = False
+            stats["dropped"] += 1
+        selected.reverse()
+        return selected, remaining, stats
+
+    def assemble(self, system_content, user_message, chat_history=None, saved_history=None):
+        """
+        组装消息列表
+        :return: (messages, report)，report记录每部分使用的token数和保留情况
+        """
+        limited = self.budget > 0
+        system_tokens = self.tokens_of(system_content)
+        user_tokens = self.tokens_of(user_message)
+        remaining = max(self.budget - system_tokens - user_tokens, 0) if limited else None
+        report = {"budget": self.budget, "system_tokens": system_tokens, "input_tokens": user_tokens}
+        used_tokens = system_tokens + user_tokens
+
+        chat_selected = []
+        if chat_history is not None:
+            chat_selected, remaining, report["chat_history"] = self.fit_turns(self.group_turns(chat_history), remaining)
+            used_tokens += report["chat_history"]["tokens"]
+
+        saved_lines = []
+        if saved_history is not None:
+            saved_selected, remaining, report["saved_history"] = self.fit_turns(self.group_turns(saved_history), remaining)
+            used_tokens += report["saved_history"]["tokens"]
+            for turn, summarized in saved_selected:
+                for entry in turn:
+                    content = self.summary_of(entry["content"]) if summarized else entry["content"]
+                    saved_lines.append(f"\n{entry['role']}: {content}")
+
+        messages = [{"role": "system", "content": system_content + "".join(saved_lines)}]
+        for turn, summarized in chat_selected:
+            for entry in turn:
+                content = self.summary_of(entry["content"]) if summarized else entry["content"]
+                messages.append({"role": entry["role"], "content": content})
+        messages.append({"role": "user", "content": user_message})
+
+        report["used_tokens"] = used_tokens
+        return messages, report
+
+# ===================== 回复缓存 =====================
+class CompletionCache:
+    """
+    磁盘上的模型回复缓存（SQLite），按(api_url, 模型, 消息列表)的哈希精确匹配：
+      on      命中且未过期时直接使用缓存的回复，总大小超过上限时淘汰最久未使用的记录
+      record  总是请求API，记录所有回复（不过期也不淘汰）
+      replay  只使用记录的回复，不访问网络，用于离线回放整个会话；哈希未命中视为错误，
+              开启replay_fallback时改为按记录顺序返回下一条（返回值中fallback为True）
+    """
+
+    def __init__(self, path, mode="on", max_bytes=0, ttl=0.0, replay_fallback=False):
+        self.path = path
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.replay_fallback = replay_fallback
+        self.conn = None
+        self.lock = threading.Lock()
+        self.total_bytes = 0
+        self.replay_cursor = 0  # 回放模式下最后返回的记录序号
+        self.hits = 0
+        self.misses = 0
+        self.fallbacks = 0
+
+    def connect(self):
+        """首次使用时打开数据库"""
+        if self.conn is not None:
+            return self.conn
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS completions (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                key TEXT NOT NULL UNIQUE,
+                model TEXT NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL,
+                size INTEGER NOT NULL,
+                content TEXT NOT NULL,
+                usage TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS completions_accessed ON completions (accessed);
+        """)
+        self.total_bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+        self.conn = conn
+        return conn
+
+    @staticmethod
+    def make_key(api_url, model, messages):
+        return hashlib.sha256(dumps_json([api_url, model, messages], as_bytes=True)).hexdigest()
+
+    def get(self, key):
+        """
+        :return: {"content": 回复, "usage": usage字典, "fallback": 是否为按记录顺序回放的回复, "seq": 记录序号,
+                  "model": 记录时的模型}，未命中时返回None
+        """
+        with self.lock:
+            conn = self.connect()
+            row = conn.execute(
+                "SELECT seq, created, content, usage, model FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+            fallback = False
+            if self.mode == "replay":
+                if row is None and self.replay_fallback:
+                    # 请求内容和记录时不同（如工具输出包含时间），按记录顺序继续回放；回复不一定对应本次的问题
+                    row = conn.execute(
+                        "SELECT seq, created, content, usage, model FROM completions WHERE seq > ? ORDER BY seq LIMIT 1",
+                        (self.replay_cursor,)
+                    ).fetchone()
+                    fallback = row is not None
+                if row is not None:
+                    self.replay_cursor = row[0]
+            elif row is not None and self.ttl > 0 and time.time() - row[1] > self.ttl:
+                with conn:
+                    self.delete(conn, "seq = ?", (row[0],))
+                row = None
+            elif row is not None and self.mode == "on":
+                with conn:
+                    conn.execute("UPDATE completions SET accessed = ? WHERE seq = ?", (time.time(), row[0]))
+
+            if row is None:
+                self.misses += 1
+                return None
+            if fallback:
+                self.fallbacks += 1
+            else:
+                self.hits += 1
+            return {"content": row[2], "usage": json.loads(row[3]), "fallback": fallback, "seq": row[0],
+                    "model": row[4]}
+
+    def put(self, key, model, content, usage):
+        usage_text = dumps_json(usage or {})
+        size = len(content.encode("utf-8")) + len(usage_text)
+        now = time.time()
+        with self.lock:
+            conn = self.connect()
+            with conn:
+                self.delete(conn, "key = ?", (key,))
+                conn.execute(
+                    "INSERT INTO completions (key, model, created, accessed, size, content, usage) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, model, now, now, size, content, usage_text)
+                )
+                self.total_bytes += size
+                if self.mode == "on" and self.max_bytes > 0 and self.total_bytes > self.max_bytes:
+                    self.evict(conn)
+
+    def delete(self, conn, where, args):
+        removed = conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM completions WHERE {where}", args).fetchone()[0]
+        conn.execute(f"DELETE FROM completions WHERE {where}", args)
+        self.total_bytes -= removed
+
+    def evict(self, conn):
+        """按最近使用时间从旧到新淘汰，直到总大小不超过上限"""
+        # 其他进程（如服务模式的其他会话）也可能写入，淘汰前重新统计
+        self.total_bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+        over = self.total_bytes - self.max_bytes
+        if over <= 0:
+            return
+        freed = 0
+        stale = []
+        for seq, size in conn.execute("SELECT seq, size FROM completions ORDER BY accessed"):
+            stale.append((seq,))
+            freed += size
+            if freed >= over:
+                break
+        conn.executemany("DELETE FROM completions WHERE seq = ?", stale)
+        self.total_bytes -= freed
+
+    def stats(self):
+        with self.lock:
+            entries = self.connect().execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+            return {"mode": self.mode, "hits": self.hits, "misses": self.misses, "replay_fallbacks": self.fallbacks,
+                    "entries": entries, "bytes": self.total_bytes}
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+# ===================== 历史记录存储 =====================
+SEARCH_TOKEN_PATTERN = re.compile(r"[0-9a-z_]+|[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]+")
+
+
+def tokenize_for_search(text):
+    """检索用分词：英文数字按单词切分，中日韩文本按相邻两字切分"""
+    tokens = []
+    for word in SEARCH_TOKEN_PATTERN.findall(text.lower()):
+        if word[0] < "\u3040":
+            tokens.append(word)
+        elif len(word) == 1:
+            tokens.append(word)
+        else:
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+
+class HistoryStore:
+    """
+    追加写入的历史记录库（SQLite，WAL模式）：每轮对话一条记录，
+    启动时不读取任何记录，最近N轮和时间范围查询都只读取需要的记录；
+    同时维护一份增量更新的倒排索引，用BM25检索与问题相关的历史
+    """
+
+    BM25_K1 = 1.2
+    BM25_B = 0.75
+
+    def __init__(self, path=HISTORY_DB_FILE, legacy_path=LEGACY_HISTORY_FILE):
+        self.path = path
+        self.legacy_path = legacy_path
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        """首次使用时打开数据库，必要时导入旧版history.hty"""
+        if self.conn is not None:
+            return self.conn
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        # WAL + NORMAL：每次追加都是一个事务，进程崩溃不会损坏已写入的记录
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS turns (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ts REAL NOT NULL,
+                user_name TEXT NOT NULL,
+                user_message TEXT NOT NULL,
+                ai_name TEXT NOT NULL,
+                ai_response TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS turns_ts ON turns (ts);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS terms (id INTEGER PRIMARY KEY, term TEXT NOT NULL UNIQUE, df INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS postings (
+                term_id INTEGER NOT NULL,
+                turn_id INTEGER NOT NULL,
+                tf INTEGER NOT NULL,
+                PRIMARY KEY (term_id, turn_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS doc_lengths (turn_id INTEGER PRIMARY KEY, length INTEGER NOT NULL);
+        """)
+        self.conn = conn
+        self.import_legacy()
+        return conn
+
+    def import_legacy(self):
+        """把旧版history.hty（每两行一轮）导入数据库，只执行一次"""
+        if not self.legacy_path or not os.path.exists(self.legacy_path):
+            return 0
+        if self.conn.execute("SELECT 1 FROM meta WHERE key = 'legacy_imported'").fetchone():
+            return 0
+        timestamp = os.path.getmtime(self.legacy_path)
+        with open(self.legacy_path, "r", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+
+        def split_line(line):
+            # 旧格式为 "名称: 内容"
+            name, sep, content = line.partition(": ")
+            return (name, content) if sep else ("", line)
+
+        rows = []
+        for i in range(0, len(lines), 2):
+            user_name, user_message = split_line(lines[i])
+            ai_name, ai_response = split_line(lines[i + 1]) if i + 1 < len(lines) else ("", "")
+            rows.append((timestamp, user_name, user_message, ai_name, ai_response))
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO turns (ts, user_name, user_message, ai_name, ai_response) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            self.conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('legacy_imported', ?)",
+                (json.dumps({"file": self.legacy_path, "turns": len(rows)}, ensure_ascii=False),)
+            )
+        return len(rows)
+
+    def append(self, user_name, user_message, ai_name, ai_response, timestamp=None):
+        """追加一轮对话并更新索引，返回记录id"""
+        with self.lock:
+            conn = self.connect()
+            with conn:
+                cursor = conn.execute(
+                    "INSERT INTO turns (ts, user_name, user_message, ai_name, ai_response) VALUES (?, ?, ?, ?, ?)",
+                    (timestamp if timestamp is not None else time.time(), user_name, user_message, ai_name, ai_response)
+                )
+            self.index_pending()
+            return cursor.lastrowid
+
+    # ---------- 倒排索引 ----------
+    def get_meta_int(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return int(row[0]) if row else 0
+
+    def index_pending(self, batch_size=5000):
+        """为尚未索引的记录（新追加的记录、导入的旧记录）建立索引"""
+        conn = self.conn
+        while True:
+            indexed_upto = self.get_meta_int("index_upto")
+            rows = conn.execute(
+                "SELECT id, user_message, ai_response FROM turns WHERE id > ? ORDER BY id LIMIT ?",
+                (indexed_upto, batch_size)
+            ).fetchall()
+            if not rows:
+                return
+            doc_count = self.get_meta_int("index_docs")
+            total_length = self.get_meta_int("index_length")
+            # 先在内存中汇总整批记录的词频，再批量写入，避免逐条记录读写词表
+            documents = []
+            df_increments = Counter()
+            for turn_id, user_message, ai_response in rows:
+                counts = Counter(tokenize_for_search(f"{user_message}\n{ai_response}"))
+                documents.append((turn_id, counts))
+                df_increments.update(counts.keys())
+            with conn:
+                conn.executemany(
+                    "INSERT INTO terms (term, df) VALUES (?, ?) ON CONFLICT(term) DO UPDATE SET df = df + excluded.df",
+                    df_increments.items()
+                )
+                term_ids = self.lookup_terms(list(df_increments))
+                # 按主键顺序写入倒排表，B树插入更集中
+                conn.executemany(
+                    "INSERT OR REPLACE INTO postings (term_id, turn_id, tf) VALUES (?, ?, ?)",
+                    sorted(
+                        (term_ids[term][0], turn_id, tf)
+                        for turn_id, counts in documents
+                        for term, tf in counts.items()
+                    )
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO doc_lengths (turn_id, length) VALUES (?, ?)",
+                    [(turn_id, sum(counts.values())) for turn_id, counts in documents]
+                )
+                doc_count += len(documents)
+                total_length += sum(sum(counts.values()) for _, counts in documents)
+                conn.executemany(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                    [("index_upto", str(rows[-1][0])), ("index_docs", str(doc_count)), ("index_length", str(total_length))]
+                )
+
+    def lookup_terms(self, terms):
+        """查询词项的(id, 文档频率)"""
+        found = {}
+        # SQLite对单条语句的参数个数有限制，分批查询
+        for start in range(0, len(terms), 500):
+            chunk = terms[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for term, term_id, df in self.conn.execute(
+                f"SELECT term, id, df FROM terms WHERE term IN ({placeholders})", chunk
+            ):
+                found[term] = (term_id, df)
+        return found
+
+    def search(self, query, limit, max_id=None, max_df_ratio=0.5):
+        """
+        用BM25检索与query最相关的对话
+        :param max_id: 只检索id小于该值的记录
+        :param max_df_ratio: 出现在超过该比例记录中的词区分度很低，跳过以保证检索速度
+        :return: 按相关度从高到低排列的记录（带score字段）
+        """
+        terms = list(set(tokenize_for_search(query)))
+        if not terms or limit <= 0:
+            return []
+        with self.lock:
+            self.connect()
+            self.index_pending()
+            doc_count = self.get_meta_int("index_docs")
+            if doc_count == 0:
+                return []
+            average_length = max(self.get_meta_int("index_length") / doc_count, 1.0)
+            term_info = sorted(self.lookup_terms(terms).values(), key=lambda item: item[1])
+            if len(term_info) > 1:
+                term_info = [item for item in term_info if item[1] <= doc_count * max_df_ratio] or term_info[:1]
+
+            k1, b = self.BM25_K1, self.BM25_B
+            scores = {}
+            for term_id, df in term_info:
+                idf = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+                for turn_id, tf, length in self.conn.execute(
+                    "SELECT p.turn_id, p.tf, d.length FROM postings p JOIN doc_lengths d ON d.turn_id = p.turn_id "
+                    "WHERE p.term_id = ?",
+                    (term_id,)
+                ):
+                    if max_id is not None and turn_id >= max_id:
+                        continue
+                    score = idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / average_length))
+                    scores[turn_id] = scores.get(turn_id, 0.0) + score
+
+        top = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+        records = self.get([turn_id for turn_id, _ in top])
+        for record, (_, score) in zip(records, top):
+            record["score"] = round(score, 4)
+        return records
+
+    @staticmethod
+    def to_record(row):
+        return {
+            "id": row[0],
+            "ts": row[1],
+            "user_name": row[2],
+            "user_message": row[3],
+            "ai_name": row[4],
+            "ai_response": row[5]
+        }
+
+    def recent(self, limit, before=None):
+        """最近limit轮对话（按时间顺序），before为时间戳上限（不含）"""
+        with self.lock:
+            conn = self.connect()
+            if before is None:
+                rows = conn.execute("SELECT * FROM turns ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+            else:
+                rows = conn.execute(
+                    "SELECT * FROM turns WHERE ts < ? ORDER BY id DESC LIMIT ?", (before, limit)
+                ).fetchall()
+        return [self.to_record(row) for row in reversed(rows)]
+
+    def between(self, start_ts, end_ts, limit=None):
+        """时间范围[start_ts, end_ts)内的对话（按时间顺序）"""
+        with self.lock:
+            conn = self.connect()
+            rows = conn.execute(
+                "SELECT * FROM turns WHERE ts >= ? AND ts < ? ORDER BY ts, id LIMIT ?",
+                (start_ts, end_ts, -1 if limit is None else limit)
+            ).fetchall()
+        return [self.to_record(row) for row in rows]
+
+    def get(self, ids):
+        """按id读取多条记录（保持ids的顺序）"""
+        if not ids:
+            return []
+        with self.lock:
+            conn = self.connect()
+            placeholders = ",".join("?" * len(ids))
+            rows = conn.execute(f"SELECT * FROM turns WHERE id IN ({placeholders})", list(ids)).fetchall()
+        records = {row[0]: self.to_record(row) for row in rows}
+        return [records[turn_id] for turn_id in ids if turn_id in records]
+
+    def count(self):
+        with self.lock:
+            return self.connect().execute("SELECT COUNT(*) FROM turns").fetchone()[0]
+
+    @staticmethod
+    def to_messages(records):
+        """转换为上下文组装使用的role/content列表"""
+        messages = []
+        for record in records:
+            messages.append({"role": "user", "content": record["user_message"]})
+            messages.append({"role": "assistant", "content": record["ai_response"]})
+        return messages
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+# ===================== Python内核 =====================
+class PythonKernelError(Exception):
+    """Python内核返回的执行错误（错误信息已格式化）"""
+
+def new_kernel_namespace():
+    """创建Python内核的全局命名空间"""
+    return {"__name__": "__agent__", "__builtins__": __builtins__}
+
+
+def to_kernel_result(value, head_bytes, tail_bytes):
+    """
+    把eval的返回值转换为可以放进MCP响应的值（无法JSON序列化时使用repr），
+    与输出一样只保留开头head_bytes字节和末尾tail_bytes字节
+    :return: (转换后的值, 记录返回值大小的BoundedOutput)
+    """
+    try:
+        text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+    except (TypeError, ValueError):
+        value = text = repr(value)
+    returned = BoundedOutput(head_bytes, tail_bytes)
+    returned.write(text.encode("utf-8", errors="replace"))
+    if returned.truncated:
+        # 截断后只能以文本形式返回
+        value = returned.getvalue()
+    return value, returned
+
+
+def python_kernel_main(conn, preload_modules):
+    """
+    Python内核进程入口：命名空间在多次执行之间保留，编译结果按源码哈希缓存
+    通过conn接收 {"op": "exec"/"reset"/"stop", ...} 请求，exec的输出按请求中的head_bytes/tail_bytes截断
+    """
+    import importlib
+
+    # Ctrl+C只用于中断Agent，不应杀死内核
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for module_name in preload_modules:
+        try:
+            importlib.import_module(module_name)
+        except Exception:
+            pass
+
+    namespace = new_kernel_namespace()
+    code_cache = OrderedDict()  # 源码哈希 -> (是否为表达式, 代码对象)
+    max_cached = 256
+
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, OSError):
+            break
+        op = request.get("op")
+        if op == "stop":
+            break
+        if op == "reset":
+            namespace = new_kernel_namespace()
+            conn.send({"result": "命名空间已重置", "error": "", "truncation": None})
+            continue
+
+        mode = request.get("mode", "script")
+        source = request.get("source", "")
+        cache_key = hashlib.sha256(f"{mode}\0{source}".encode("utf-8")).hexdigest()
+        head_bytes = request.get("head_bytes", 16384)
+        tail_bytes = request.get("tail_bytes", 16384)
+        output = BoundedOutput(head_bytes, tail_bytes)
+        try:
+            cached = code_cache.get(cache_key)
+            if cached is None:
+                is_expression = False
+                code = None
+                if mode == "command":
+                    # 单行命令优先按表达式编译，以便返回表达式的值
+                    try:
+                        code = compile(source, "<agent>", "eval")
+                        is_expression = True
+                    except SyntaxError:
+                        pass
+                if code is None:
+                    code = compile(source, "<agent>", "exec")
+                cached = (is_expression, code)
+                code_cache[cache_key] = cached
+                if len(code_cache) > max_cached:
+                    code_cache.popitem(last=False)
+            else:
+                code_cache.move_to_end(cache_key)
+
+            is_expression, code = cached
+            with contextlib.redirect_stdout(BoundedTextWriter(output)):
+                value = eval(code, namespace)
+            output_text = output.getvalue().strip()
+            outputs = {"stdout": output}
+            if is_expression:
+                value, outputs["result"] = to_kernel_result(value, head_bytes, tail_bytes)
+                result = f"{output_text}\n返回值: {value}" if output_text else value
+            else:
+                result = output_text
+            conn.send({"result": result, "error": "", "truncation": collect_truncation(outputs)})
+        except BaseException as e:
+            conn.send({"result": None, "error": f"{type(e).__name__}: {str(e)}", "truncation": None})
+
+
+class PythonKernel:
+    """持久的Python内核：在独立进程中执行代码，首次使用时启动"""
+
+    def __init__(self, preload_modules=None, timeout=0.0, head_bytes=16384, tail_bytes=16384):
+        self.preload_modules = list(preload_modules or [])
+        self.timeout = timeout
+        self.head_bytes = head_bytes
+        self.tail_bytes = tail_bytes
+        self.process = None
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """启动内核进程（使用spawn，避免在多线程进程中fork）"""
+        import multiprocessing
+        context = multiprocessing.get_context("spawn")
+        parent_conn, child_conn = context.Pipe()
+        process = context.Process(
+            target=python_kernel_main,
+            args=(child_conn, self.preload_modules),
+            name="agent-python-kernel",
+            daemon=True
+        )
+        try:
+            process.start()
+        except BaseException:
+            parent_conn.close()
+            raise
+        finally:
+            child_conn.close()
+        # 进程启动成功后才记录，启动失败时kill/stop不会操作不存在的进程和连接
+        self.process = process
+        self.conn = parent_conn
+
+    def kill(self):
+        """强制结束内核进程"""
+        if self.process is not None:
+            self.process.kill()
+            self.process.join()
+        if self.conn is not None:
+            self.conn.close()
+        self.process = None
+        self.conn = None
+
+    def request(self, message):
+        """向内核发送请求并等待回复，超时或内核退出时重启内核"""
+        with self.lock:
+            if self.process is None or not self.process.is_alive():
+                self.kill()
+                self.start()
+            try:
+                self.conn.send(message)
+                timeout = self.timeout if self.timeout > 0 else None
+                if not self.conn.poll(timeout):
+                    self.kill()
+                    return {
+                        "result": None,
+                        "error": f"执行超时（超过{self.timeout}秒），Python内核已重启，之前定义的变量已丢失",
+                        "truncation": None
+                    }
+                return self.conn.recv()
+            except (EOFError, OSError):
+                self.kill()
+                return {"result": None, "error": "Python内核进程意外退出，已重启，之前定义的变量已丢失", "truncation": None}
+
+    def execute(self, mode, source):
+        """
+        执行Python代码
+        :param mode: command（单行命令，表达式会返回值）或 script（多行脚本）
+        :return: (执行结果, 错误信息, 输出截断信息)
+        """
+        reply = self.request({
+            "op": "exec",
+            "mode": mode,
+            "source": source,
+            "head_bytes": self.head_bytes,
+            "tail_bytes": self.tail_bytes
+        })
+        return reply["result"], reply["error"], reply["truncation"]
+
+    def reset(self):
+        """清空内核的命名空间，已导入的模块和编译缓存保留"""
+        reply = self.request({"op": "reset"})
+        return reply["result"], reply["error"]
+
+    def restart(self):
+        """重启内核进程"""
+        with self.lock:
+            self.kill()
+            self.start()
+
+    def stop(self):
+        """结束内核进程"""
+        with self.lock:
+            if self.process is None or self.conn is None:
+                self.kill()
+                return
+            try:
+                self.conn.send({"op": "stop"})
+                self.process.join(timeout=1)
+            except (EOFError, OSError):
+                pass
+            self.kill()
+
+# ===================== 持久shell会话 =====================
+class ShellSession:
+    """
+    持久的shell会话：cd、export和激活的环境在多次命令之间保留
+    每条命令后输出带随机标记的结束行，据此切分每条命令的stdout、stderr和退出码
+    """
+
+    def __init__(self, timeout=0.0, head_bytes=16384, tail_bytes=16384):
+        self.timeout = timeout
+        self.head_bytes = head_bytes
+        self.tail_bytes = tail_bytes
+        self.process = None
+        self.output_queue = None
+        self.token = ""
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def is_supported():
+        """仅在类Unix系统上使用持久会话，Windows回退为每条命令启动新进程"""
+        return os.name == "posix"
+
+    def start(self):
+        """启动shell进程和两个读取线程"""
+        shell = "/bin/bash" if os.path.exists("/bin/bash") else "/bin/sh"
+        self.process = subprocess.Popen(
+            [shell],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            bufsize=0,
+            start_new_session=True  # 独立进程组：Ctrl+C不会杀死会话，超时时可整组结束
+        )
+        self.output_queue = queue.Queue()
+        self.token = secrets.token_hex(8)
+        self.sequence = 0
+        for name, stream in (("stdout", self.process.stdout), ("stderr", self.process.stderr)):
+            threading.Thread(
+                target=self.read_stream,
+                args=(name, stream, self.output_queue),
+                name=f"shell-{name}",
+                daemon=True
+            ).start()
+
+    @staticmethod
+    def read_stream(name, stream, output_queue):
+        """持续读取shell的输出，读到EOF时放入None"""
+        try:
+            while True:
+                chunk = os.read(stream.fileno(), 65536)
+                if not chunk:
+                    break
+                output_queue.put((name, chunk))
+        except OSError:
+            pass
+        output_queue.put((name, None))
+
+    def kill(self):
+        """结束shell及其启动的所有子进程"""
+        if self.process is not None:
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            self.process.wait()
+            for stream in (self.process.stdin, self.process.stdout, self.process.stderr):
+                stream.close()
+        self.process = None
+
+    def run(self, command):
+        """
+        在会话中执行一条命令
+        :return: (stdout, stderr, 退出码, 输出截断信息)，会话异常时退出码为None
+        """
+        with self.lock:
+            if self.process is None or self.process.poll() is not None:
+                self.kill()
+                self.start()
+            # 丢弃上一条命令结束后后台进程产生的输出
+            while not self.output_queue.empty():
+                self.output_queue.get_nowait()
+
+            self.sequence += 1
+            marker = f"__AGENT_END_{self.token}_{self.sequence}__"
+            # eval使语法错误只影响本条命令；stdin重定向避免命令读取会话的控制流
+            script = (
+                f"eval {shlex.quote(command)} </dev/null\n"
+                f"printf '\\n{marker} %d\\n' \"$?\"\n"
+                f"printf '\\n{marker}\\n' >&2\n"
+            )
+            try:
+                self.process.stdin.write(script.encode("utf-8"))
+                self.process.stdin.flush()
+            except OSError as e:
+                self.kill()
+                return "", f"shell会话写入失败: {str(e)}", None, None
+            return self.collect_output(marker)
+
+    def collect_output(self, marker):
+        """读取输出直到stdout和stderr都出现结束标记，输出写入有界缓冲"""
+        stdout_end = re.compile(rb"\n" + marker.encode("ascii") + rb" (-?\d+)\n")
+        stderr_end = re.compile(rb"\n" + marker.encode("ascii") + rb"\n")
+        end_patterns = {"stdout": stdout_end, "stderr": stderr_end}
+        outputs = {
+            "stdout": BoundedOutput(self.head_bytes, self.tail_bytes),
+            "stderr": BoundedOutput(self.head_bytes, self.tail_bytes)
+        }
+        # 末尾可能是不完整的结束标记，先暂存在pending中
+        pending = {"stdout": bytearray(), "stderr": bytearray()}
+        keep = len(marker) + 32
+        done = {"stdout": False, "stderr": False}
+        exit_code = None
+        deadline = time.monotonic() + self.timeout if self.timeout > 0 else None
+
+        def finish(error=None):
+            for name in outputs:
+                outputs[name].write(bytes(pending[name]))
+            stdout_text = outputs["stdout"].getvalue()
+            stderr_text = error or outputs["stderr"].getvalue()
+            return stdout_text, stderr_text, exit_code, collect_truncation(outputs)
+
+        while not (done["stdout"] and done["stderr"]):
+            try:
+                wait = None if deadline is None else max(0.0, deadline - time.monotonic())
+                name, chunk = self.output_queue.get(timeout=wait)
+            except queue.Empty:
+                self.kill()
+                return finish(f"命令执行超时（超过{self.timeout}秒），shell会话已重启")
+            if chunk is None:
+                # shell已退出（例如命令中执行了exit）
+                done[name] = True
+                if self.process is not None and self.process.poll() is None:
+                    continue
+                self.kill()
+                if not outputs["stderr"].total_bytes and not pending["stderr"]:
+                    return finish("shell会话已退出，下一条命令将启动新的会话")
+                return finish()
+            if done[name]:
+                continue
+
+            buffer = pending[name]
+            buffer += chunk
+            match = end_patterns[name].search(buffer)
+            if match:
+                if name == "stdout":
+                    exit_code = int(match.group(1))
+                outputs[name].write(bytes(buffer[:match.start()]))
+                buffer.clear()
+                done[name] = True
+            elif len(buffer) > keep:
+                outputs[name].write(bytes(buffer[:-keep]))
+                del buffer[:-keep]
+
+        return finish()
+
+    def stop(self):
+        """结束会话"""
+        with self.lock:
+            self.kill()
 
 # ===================== Agent类（包含MCP处理逻辑） =====================
 class Agent:
-    def __init__(self):
-        """初始化Agent，加载并校验配置"""
+    def __init__(self, config=None, output=None, http_session=None, tool_executors=None, log=None, tracer=None):
+        """
+        初始化Agent，加载并校验配置
+        :param config: 直接使用的配置实例，为None时从config.json加载
+        :param output: AI回复的输出流，为None时输出到标准输出
+        :param http_session: 多个Agent共用的HTTP会话（连接池），为None时自行创建
+        :param tool_executors: 多个Agent共用的(MCP请求线程池, 终端命令线程池)，为None时自行创建
+        :param log: 多个Agent共用的结构化日志（同一个日志文件只能由一个AgentLog轮转），为None时按log_file自行创建
+        :param tracer: 多个Agent共用的耗时追踪，为None时按trace_file自行创建
+        """
         # 加载配置并获取错误信息
-        self.config, self.config_errors = Config.load_and_validate()
-        self.prompt_files = self.get_prompt_files()
-        self.chat_history = []
-        self.saved_history = self.load_saved_history()
+        if config is None:
+            self.config, self.config_errors = Config.load_and_validate()
+        else:
+            self.config, self.config_errors = config, []
+        # 结构化日志（控制台渲染和日志文件写入都在后台线程中进行）
+        self.owns_log = log is None
+        self.log = AgentLog(self.config) if log is None else log
+        # 各阶段耗时追踪（trace_file为空时不记录）
+        self.owns_tracer = tracer is None
+        self.tracer = Tracer(self.config.trace_file) if tracer is None else tracer
+        # 运行指标（;;stats命令查看，可定时写入文件）
+        self.metrics = MetricsRegistry()
+        self.metrics_dumper = None
+        if self.config.metrics_dump_file and self.config.metrics_dump_interval > 0:
+            self.metrics_dumper = MetricsDumper(
+                self.metrics_snapshot, self.config.metrics_dump_file, self.config.metrics_dump_interval
+            )
+            self.metrics_dumper.start()
+        self.prompt_file_list = None  # 提示词文件列表在第一次使用时才扫描
+        self.chat_history = ChatHistory(self.config.history_memory_limit, self.config.history_spill_dir)
+        # 历史记录库在首次读写时才打开；本次启动之后保存的记录已在chat_history中，不再作为已保存历史发送
+        self.history_store = HistoryStore()
+        self.started_at = time.time()
+        self.session_first_history_id = None  # 本次启动后保存的第一条历史记录id
+        self.output = output
+        # 长连接HTTP客户端（整个Agent生命周期内复用连接池，第一次请求或预热时才创建）
+        self.http_session = http_session
+        self.owns_http_session = http_session is None
+        self.http_session_lock = threading.Lock()
+        self.api_endpoints = self.parse_api_endpoints()
+        if self.config.http_warmup:
+            self.warmup_connection()
+        # 工具执行线程池：MCP请求与终端命令分开，避免互相等待造成死锁
+        self.owns_tool_executors = tool_executors is None
+        if tool_executors is None:
+            tool_workers = 1 if self.config.tool_sequential else max(1, self.config.tool_workers)
+            tool_executors = (
+                ThreadPoolExecutor(max_workers=tool_workers, thread_name_prefix="mcp"),
+                ThreadPoolExecutor(max_workers=tool_workers, thread_name_prefix="command")
+            )
+        self.mcp_executor, self.command_executor = tool_executors
+        # 持久Python内核（首次执行Python代码时才启动进程）
+        self.python_kernel = PythonKernel(
+            self.config.python_preload_modules,
+            self.config.python_timeout,
+            self.config.python_output_head,
+            self.config.python_output_tail
+        )
+        # MCP方法注册表（插件在第一次生成提示词或分发请求时才查找，插件代码在第一次调用时才导入）
+        self.mcp_registry = self.create_mcp_registry()
+        self.mcp_plugin_state = None
+        self.mcp_plugin_names = {}  # 插件来源 -> 已注册的模块名
+        self.mcp_plugin_lock = threading.Lock()
+        # 幂等MCP方法的结果缓存
+        self.mcp_cache = McpResultCache(
+            self.mcp_registry,
+            self.config.mcp_cache_max_bytes,
+            self.config.mcp_cache_ttl,
+            self.config.mcp_cache_readonly_commands
+        )
+        # 按token预算组装上下文
+        self.context_assembler = ContextAssembler(
+            self.config.context_token_budget,
+            self.config.context_summary_chars,
+            get_token_counter(self.config.context_tokenizer)
+        )
+        self.last_context_report = None
+        self.last_stop_reason = None  # 上一轮对话因超出预算而停止的原因
+        # 模型回复缓存（首次使用时才打开数据库）
+        self.completion_cache = CompletionCache(
+            self.config.completion_cache_file,
+            self.config.completion_cache,
+            self.config.completion_cache_max_bytes,
+            self.config.completion_cache_ttl,
+            self.config.completion_cache_replay_fallback
+        )
+        # system提示词及提示词文件的缓存
+        self.system_prompt_cache = None
+        self.prompt_file_cache = None
+        # 持久shell会话（首次执行终端命令时才启动）
+        self.shell_session = ShellSession(
+            self.config.terminal_timeout,
+            self.config.terminal_output_head,
+            self.config.terminal_output_tail
+        )
         
         # 打印配置错误提示（如果有）
         self.print_config_errors()
@@ -202,511 +2894,1067 @@ class Agent:
         print("-" * 60)
         print("💡 你可以使用 ;;config 命令重新配置这些项\n")
 
-    def get_prompt_files(self):
-        """获取根目录下的所有 .txt 文件"""
-        files = [f for f in os.listdir() if f.endswith('.txt')]
-        return ["无"] + files
+    @property
+    def prompt_files(self):
+        """根目录下的提示词文件（第一次访问时扫描）"""
+        if self.prompt_file_list is None:
+            self.prompt_file_list = self.get_prompt_files()
+        return self.prompt_file_list
+
+    def get_prompt_files(self):
+        """获取根目录下的所有 .txt 文件"""
+        files = [f for f in os.listdir() if f.endswith('.txt')]
+        return ["无"] + files
+
+    def save_config(self):
+        """保存配置（仅当通过config命令设置合法值时）"""
+        self.config.save_to_file()
+        print("✅ 配置已保存！")
+    
+    def log_ai_message(self, message):
+        """统一的AI日志打印函数"""
+        self.log.emit("ai_message", name=self.config.ai_name, message=message)
+
+    # ===================== HTTP客户端 =====================
+    def get_http_session(self):
+        """返回HTTP会话，第一次调用时才导入requests并创建"""
+        if self.http_session is None:
+            with self.http_session_lock:
+                if self.http_session is None:
+                    self.http_session = self.create_http_session(self.config)
+        return self.http_session
+
+    @staticmethod
+    def create_http_session(config):
+        """创建带连接池的HTTP会话，避免每次请求重新进行TCP/TLS握手"""
+        import requests
+        from requests.adapters import HTTPAdapter
+        session = requests.Session()
+        pool_size = max(1, config.http_pool_size)
+        # 重试由调用方决定，这里不让urllib3静默重试
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers.update({
+            "Authorization": f"Bearer {config.api_key}",
+            "Connection": "keep-alive" if config.http_keep_alive else "close"
+        })
+        return session
+
+    @staticmethod
+    def create_shared_pools(config, concurrent_turns, tool_workers):
+        """
+        创建多个Agent共用的HTTP连接池和工具线程池（服务模式和批处理模式使用，由调用方负责关闭）
+        :param config: 基础配置
+        :param concurrent_turns: 同时进行的对话数，每个对话需要一个连接，对冲请求再多占一个
+        :param tool_workers: MCP请求和终端命令线程池各自的线程数
+        :return: (HTTP会话, (MCP请求线程池, 终端命令线程池))
+        """
+        pool_config = Config(**config.model_dump())
+        pool_config.http_pool_size = max(config.http_pool_size, concurrent_turns * 2)
+        tool_workers = max(1, tool_workers)
+        tool_executors = (
+            ThreadPoolExecutor(max_workers=tool_workers, thread_name_prefix="mcp"),
+            ThreadPoolExecutor(max_workers=tool_workers, thread_name_prefix="command")
+        )
+        return Agent.create_http_session(pool_config), tool_executors
+
+    def get_http_timeout(self):
+        """返回requests使用的(连接超时, 读取超时)"""
+        read_timeout = self.config.http_read_timeout if self.config.http_read_timeout > 0 else None
+        return (self.config.http_connect_timeout, read_timeout)
+
+    def warmup_connection(self):
+        """在后台线程中预先建立到api_url的连接，首条消息无需等待握手"""
+        def _warmup():
+            try:
+                # HEAD请求没有响应体，连接会直接归还到连接池
+                response = self.get_http_session().head(
+                    self.config.api_url,
+                    timeout=(self.config.http_connect_timeout, self.config.http_connect_timeout)
+                )
+                response.close()
+            except Exception:
+                # 预热失败不影响正常请求
+                pass
+
+        if not urlsplit(self.config.api_url).hostname:
+            return None
+        thread = threading.Thread(target=_warmup, name="http-warmup", daemon=True)
+        thread.start()
+        return thread
+
+    def parse_api_endpoints(self):
+        """
+        主API和备用API列表，按失败后尝试的顺序排列
+        :return: [{"url": 地址, "model": 模型, "api_key": 密钥或None（使用api_key）}, ...]
+        """
+        endpoints = [{"url": self.config.api_url, "model": self.config.model, "api_key": None}]
+        for item in self.config.api_fallbacks:
+            parts = [part.strip() for part in item.split("|")]
+            if not parts[0]:
+                continue
+            endpoints.append({
+                "url": parts[0],
+                "model": parts[1] if len(parts) > 1 and parts[1] else self.config.model,
+                "api_key": parts[2] if len(parts) > 2 and parts[2] else None
+            })
+        return endpoints
+
+    def request_api(self, payload, stream=False):
+        """
+        发送API请求：连接失败、超时和可重试的状态码按指数退避（带随机抖动，遵守Retry-After）重试，
+        重试用完后依次改用备用API；启用对冲时，主API响应过慢会同时向第一个备用API发送请求
+        :return: (状态码为200的响应, 返回该响应的API)；全部失败时返回最后一个失败的响应
+        """
+        endpoints = self.api_endpoints
+        retries = max(0, self.config.api_retries)
+        last_response = None
+        last_endpoint = None
+        for index, endpoint in enumerate(endpoints):
+            for attempt in range(retries + 1):
+                if index == 0 and attempt == 0 and self.config.api_hedge_after > 0 and len(endpoints) > 1:
+                    response, error, answered = self.post_api_hedged(payload, stream, endpoints[0], endpoints[1])
+                else:
+                    response, error = self.try_post_api(payload, stream, endpoint)
+                    answered = endpoint
+                if response is not None and response.status_code == 200:
+                    if last_response is not None:
+                        last_response.close()
+                    return response, answered
+                if response is not None:
+                    if last_response is not None:
+                        last_response.close()
+                    last_response = response
+                    last_endpoint = answered
+                    error = f"HTTP {response.status_code}"
+
+                retryable = response is None or response.status_code in RETRYABLE_STATUS_CODES
+                if retryable and attempt < retries:
+                    next_endpoint = endpoint
+                    delay = self.get_retry_delay(attempt, response)
+                elif index + 1 < len(endpoints):
+                    next_endpoint = endpoints[index + 1]
+                    delay = 0.0
+                else:
+                    break
+                self.metrics.increment("api.retries" if next_endpoint is endpoint else "api.failovers")
+                self.log.emit("api_retry", logging.WARNING, url=endpoint["url"], error=str(error), delay=delay,
+                              next_url=next_endpoint["url"])
+                if delay > 0:
+                    time.sleep(delay)
+                if next_endpoint is not endpoint:
+                    break
+        if last_response is None:
+            raise error
+        return last_response, last_endpoint
+
+    def try_post_api(self, payload, stream, endpoint):
+        """发送一次请求，连接失败和超时（requests的异常都是OSError的子类）作为错误返回而不抛出"""
+        try:
+            return self.post_api(payload, stream, endpoint), None
+        except OSError as e:
+            return None, e
+
+    def post_api_hedged(self, payload, stream, primary, secondary):
+        """
+        对冲请求：主API超过api_hedge_after秒没有响应时，向备用API发送相同请求，采用先成功的响应，
+        另一个响应到达后直接关闭
+        :return: (响应, 错误, 返回该响应的API)
+        """
+        futures = [self.start_api_leg(payload, stream, primary)]
+        done, _ = wait(futures, timeout=self.config.api_hedge_after)
+        if not done:
+            self.metrics.increment("api.hedged")
+            self.log.emit("api_hedge", url=primary["url"], hedge_url=secondary["url"], after=self.config.api_hedge_after)
+            futures.append(self.start_api_leg(payload, stream, secondary))
+
+        results = {}
+        pending = set(futures)
+        winner = None
+        while pending and winner is None:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[future] = future.result()
+                response = results[future][0]
+                if winner is None and response is not None and response.status_code == 200:
+                    winner = future
+        for future in pending:
+            future.add_done_callback(close_hedged_response)
+        if winner is None:
+            # 都失败时按主API的结果处理重试
+            return (*results[futures[0]], primary)
+        if winner is not futures[0]:
+            self.metrics.increment("api.hedge_wins")
+        for future, (response, _) in results.items():
+            if future is not winner and response is not None:
+                response.close()
+        return (*results[winner], primary if winner is futures[0] else secondary)
+
+    def start_api_leg(self, payload, stream, endpoint):
+        """
+        在单独的短期线程中发送对冲的一路请求：输掉的请求可能一直挂起到读取超时，
+        不能占用固定大小的线程池，否则之后的对冲请求会排在它们后面
+        """
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(self.try_post_api(payload, stream, endpoint))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, name="api-hedge", daemon=True).start()
+        return future
+
+    def get_retry_delay(self, attempt, response):
+        """第attempt次重试前的等待秒数：服务端给出Retry-After时遵守，否则在指数增长的上限内随机取值"""
+        max_delay = max(0.0, self.config.api_retry_max_delay)
+        retry_after = parse_retry_after(response.headers.get("Retry-After")) if response is not None else None
+        if retry_after is not None:
+            return min(retry_after, max_delay)
+        return random.uniform(0, min(max_delay, self.config.api_retry_base_delay * 2 ** attempt))
+
+    def post_api(self, payload, stream=False, endpoint=None):
+        """通过连接池发送API请求，请求体较大时按配置进行gzip压缩"""
+        endpoint = endpoint or self.api_endpoints[0]
+        if endpoint["model"] != payload.get("model"):
+            payload = dict(payload, model=endpoint["model"])
+        body = dumps_json(payload, as_bytes=True)
+        headers = {"Content-Type": "application/json"}
+        if endpoint["api_key"]:
+            headers["Authorization"] = f"Bearer {endpoint['api_key']}"
+        gzip_min_bytes = self.config.http_gzip_min_bytes
+        if gzip_min_bytes > 0 and len(body) >= gzip_min_bytes:
+            body = gzip.compress(body, compresslevel=5)
+            headers["Content-Encoding"] = "gzip"
+        self.metrics.observe("api.request_bytes", len(body))
+        return self.get_http_session().post(
+            endpoint["url"],
+            data=body,
+            headers=headers,
+            timeout=self.get_http_timeout(),
+            stream=stream
+        )
+
+    def close(self):
+        """释放Agent持有的资源（共用的HTTP会话、线程池、日志和追踪由创建方负责关闭）"""
+        if self.owns_tool_executors:
+            self.mcp_executor.shutdown(wait=False)
+            self.command_executor.shutdown(wait=False)
+        self.python_kernel.stop()
+        self.shell_session.stop()
+        self.history_store.close()
+        self.chat_history.close()
+        self.completion_cache.close()
+        if self.http_session is not None and self.owns_http_session:
+            self.http_session.close()
+        if self.metrics_dumper is not None:
+            self.metrics_dumper.stop()
+        if self.owns_tracer:
+            self.tracer.close()
+        if self.owns_log:
+            self.log.close()
+        else:
+            self.log.flush()
+
+    def send_message(self, user_message, use_cache=True):
+        """
+        发送用户消息
+        :param use_cache: 为False时本轮的请求不使用回复缓存
+        :return: AI的最终回复，请求失败或超出预算时返回None
+        """
+        if not user_message:
+            return None
+        try:
+            with self.tracer.span("turn"):
+                return self.run_agent_loop(user_message, use_cache)
+        finally:
+            self.tracer.flush()
+
+    def run_agent_loop(self, user_message, use_cache=True):
+        """
+        单轮对话的状态机：request（请求API）-> dispatch（执行MCP请求）-> request ... -> done
+        同一条回复中的所有MCP响应合并为一次后续请求，并受步数、token和时间预算限制
+        :return: AI的最终回复（请求失败或超出预算时为None）
+        """
+        state = "request"
+        current_input = user_message
+        completion = None
+        final_response = None
+        steps = 0
+        used_tokens = 0
+        start_time = time.monotonic()
+        self.last_stop_reason = None
+
+        while state != "done":
+            if state == "request":
+                stop_reason = self.check_turn_budget(steps, used_tokens, start_time)
+                if stop_reason:
+                    self.last_stop_reason = stop_reason
+                    self.log.flush()
+                    print(f"⚠️  {stop_reason}，已停止本轮的工具调用", file=self.output)
+                    state = "done"
+                    continue
+                steps += 1
+                with self.tracer.span("call_api", step=steps):
+                    completion = self.call_api(current_input, query=user_message, use_cache=use_cache)
+                if completion is None:
+                    state = "done"
+                    continue
+                used_tokens += completion["tokens"]
+                state = "dispatch"
+
+            elif state == "dispatch":
+                with self.tracer.span("handle_ai_response", step=steps):
+                    mcp_responses = self.handle_ai_response(
+                        completion["content"], completion["early_results"], completion["streamed"]
+                    )
+                self.chat_history.append({"role": "user", "content": current_input})
+                self.chat_history.append({"role": "assistant", "content": completion["content"]})
+                if mcp_responses:
+                    # 本轮所有MCP响应合并为一条消息，只需一次后续请求
+                    current_input = "\n".join(response.serialize() for response in mcp_responses)
+                    state = "request"
+                else:
+                    final_response = completion["content"]
+                    if self.config.save_history:
+                        with self.tracer.span("save_history"):
+                            self.save_chat_history(user_message, final_response)
+                    state = "done"
+
+        return final_response
+
+    def check_turn_budget(self, steps, used_tokens, start_time):
+        """检查本轮对话是否超出预算，超出时返回原因"""
+        if steps >= max(1, self.config.max_agent_steps):
+            return f"已达到单轮最大请求次数（{self.config.max_agent_steps}）"
+        if self.config.turn_token_budget > 0 and used_tokens >= self.config.turn_token_budget:
+            return f"已用完单轮token预算（{used_tokens}/{self.config.turn_token_budget}）"
+        if self.config.turn_time_budget > 0 and time.monotonic() - start_time >= self.config.turn_time_budget:
+            return f"已用完单轮时间预算（{self.config.turn_time_budget}秒）"
+        return None
+
+    def call_api(self, user_message, query=None, use_cache=True):
+        """
+        调用API获取AI响应
+        :param query: 检索已保存历史时使用的问题（MCP后续请求时为用户的原始问题）
+        :param use_cache: 为False时跳过回复缓存
+        :return: {"content": 回复内容, "early_results": 流式模式下提前执行的MCP请求,
+                  "streamed": 是否已流式打印, "tokens": 本次消耗的token数}，失败时返回None
+        """
+        try:
+            with self.tracer.span("build_context"):
+                system_content = self.build_system_prompt()
+
+                # 按预算依次放入system提示词、当前输入、最近的对话和更早的历史
+                messages, context_report = self.context_assembler.assemble(
+                    system_content,
+                    user_message,
+                    self.chat_history if self.config.send_history else None,
+                    self.load_saved_history(query or user_message) if self.config.send_saved_history else None
+                )
+            self.last_context_report = context_report
+            self.log_context_report(context_report)
+
+            cache_key = None
+            if self.config.completion_cache != "off" and use_cache:
+                cache_key = CompletionCache.make_key(self.config.api_url, self.config.model, messages)
+            # record模式总是请求API，只写入缓存
+            if cache_key is not None and self.config.completion_cache != "record":
+                with self.tracer.span("completion_cache"):
+                    cached = self.completion_cache.get(cache_key)
+                if cached is not None:
+                    # 命中缓存不消耗token，也不计入本轮的token预算
+                    if cached["fallback"]:
+                        self.metrics.increment("completion_cache.replay_fallbacks")
+                        self.log.emit("cache_replay_fallback", logging.WARNING, seq=cached["seq"], model=cached["model"])
+                    else:
+                        self.metrics.increment("completion_cache.hits")
+                    return {"content": cached["content"], "early_results": [], "streamed": False, "tokens": 0}
+                self.metrics.increment("completion_cache.misses")
+                if self.config.completion_cache == "replay":
+                    if self.config.completion_cache_replay_fallback:
+                        self.log_ai_message("错误: 回放记录中没有更多的回复（completion_cache为replay）")
+                    else:
+                        self.log_ai_message(
+                            "错误: 回放记录中没有与本次请求相同的记录（completion_cache为replay）；"
+                            "需要按记录顺序回放时开启completion_cache_replay_fallback"
+                        )
+                    return None
+
+            payload = {"model": self.config.model, "messages": messages}
+            if self.config.stream:
+                payload["stream"] = True
+            request_started = time.perf_counter()
+            # 流式模式下http_request只到收到响应头为止，之后的接收计入read_response
+            with self.tracer.span("http_request", stream=self.config.stream):
+                response, endpoint = self.request_api(payload, stream=self.config.stream)
+
+            if response.status_code != 200:
+                self.metrics.increment("api.errors")
+                self.log_ai_message(f"错误: {response.text}")
+                return None
+            with self.tracer.span("read_response"):
+                if self.config.stream:
+                    ai_response, early_results = self.read_stream_response(response)
+                    usage = {}
+                else:
+                    self.metrics.observe("api.response_bytes", len(response.content))
+                    response_json = response.json()
+                    ai_response = response_json.get("choices", [{}])[0].get("message", {}).get("content", "未获取到回复")
+                    early_results = []
+                    usage = response_json.get("usage") or {}
+            self.metrics.observe("api.latency_ms", (time.perf_counter() - request_started) * 1000)
+            self.metrics.increment("api.requests")
+
+            # 服务端未返回usage时按文本长度估算
+            tokens = usage.get("total_tokens")
+            if not isinstance(tokens, int):
+                tokens = context_report["used_tokens"] + self.context_assembler.count_tokens(ai_response)
+                self.metrics.increment("tokens.estimated_requests")
+            self.record_token_usage(usage, tokens)
+            if cache_key is not None:
+                self.store_completion(cache_key, endpoint, ai_response, usage)
+            return {
+                "content": ai_response,
+                "early_results": early_results,
+                "streamed": self.config.stream,
+                "tokens": tokens
+            }
+        except Exception as e:
+            self.metrics.increment("api.errors")
+            self.log_ai_message(f"请求失败: {str(e)}")
+            return None
+
+    def store_completion(self, cache_key, endpoint, ai_response, usage):
+        """
+        把API的回复写入回复缓存：缓存键对应主API，由备用API（重试切换或对冲）返回的回复不写入；
+        写入失败（例如数据库被锁定）只记录日志，不影响已经收到的回复
+        """
+        if endpoint is not self.api_endpoints[0]:
+            self.metrics.increment("completion_cache.fallback_skips")
+            return
+        try:
+            self.completion_cache.put(cache_key, self.config.model, ai_response, usage)
+        except sqlite3.Error as e:
+            self.metrics.increment("completion_cache.write_errors")
+            self.log.error("cache_write_error", error=str(e))
+
+    def record_token_usage(self, usage, total_tokens):
+        """按completion的usage字段记录token数（未返回usage时只记录估算的总数）"""
+        for key in ("prompt_tokens", "completion_tokens"):
+            if isinstance(usage.get(key), int):
+                self.metrics.observe(f"tokens.{key[:-7]}", usage[key])
+                self.metrics.increment(f"tokens.{key[:-7]}_total", usage[key])
+        self.metrics.observe("tokens.total", total_tokens)
+        self.metrics.increment("tokens.total", total_tokens)
+
+    def metrics_snapshot(self):
+        """运行指标快照，附带MCP结果缓存和对话历史的统计"""
+        snapshot = self.metrics.snapshot()
+        snapshot["mcp_cache"] = self.mcp_cache.stats()
+        snapshot["chat_history"] = self.chat_history.stats()
+        if self.config.completion_cache != "off":
+            snapshot["completion_cache"] = self.completion_cache.stats()
+        return snapshot
 
-    def save_config(self):
-        """保存配置（仅当通过config命令设置合法值时）"""
-        self.config.save_to_file()
-        print("✅ 配置已保存！")
-    
-    def log_ai_message(self, message):
-        """统一的AI日志打印函数"""
-        logger_mode = self.config.logger
-        # lite模式下不打印AI消息日志
-        if logger_mode in ["all", "format"]:
-            if isinstance(message, str) and message.startswith(";;") and message.endswith(";;"):
-                json_str = message[2:-2]
-                try:
-                    json_data = json.loads(json_str)
-                    if logger_mode == "all":
-                        print(f"[日志] {self.config.ai_name}: {json.dumps(json_data, ensure_ascii=False, separators=(',', ':'))}")
-                    elif logger_mode == "format":
-                        print(f"[日志] {self.config.ai_name}:")
-                        print(format_json_for_log(json_data, "  "))
-                except json.JSONDecodeError:
-                    print(f"[日志] {self.config.ai_name}: {message}")
-            else:
-                print(f"[日志] {self.config.ai_name}: {message}")
+    def build_system_prompt(self):
+        """
+        返回system提示词：只在相关配置、提示词文件（修改时间/大小）变化时重新生成，
+        其余情况下每次请求的提示词逐字节相同，便于服务端命中前缀缓存
+        """
+        prompt_file_state, prompt_content = self.read_prompt_file()
+        cache_key = (
+            self.config.ai_name,
+            self.config.user_name,
+            self.use_shell_session(),
+            self.config.prompt_file,
+            prompt_file_state,
+            self.get_mcp_registry().version
+        )
+        if self.system_prompt_cache is not None and self.system_prompt_cache[0] == cache_key:
+            return self.system_prompt_cache[1]
 
-    def send_message(self, user_message):
-        """发送用户消息"""
-        if not user_message:
-            return
-        self.call_api(user_message)
+        system_content = f"你是一个名为{self.config.ai_name}的AI助手，正在与用户{self.config.user_name}对话。"
+        system_content += f"\n当前系统类型是：{platform.system()}"
+        system_content += "\n你只能使用MCP协议格式进行操作，格式如下："
+        for line in self.mcp_registry.render_prompt():
+            system_content += f"\n{line}"
+        system_content += "\n注意：收到MCP响应后，不需要再次生成MCP请求，直接用自然语言回复用户即可"
 
-    def call_api(self, user_message):
-        """调用API获取AI响应"""
-        try:
-            system_content = f"你是一个名为{self.config.ai_name}的AI助手，正在与用户{self.config.user_name}对话。"
-            system_content += f"\n当前系统类型是：{platform.system()}"
-            system_content += "\n你只能使用MCP协议格式进行操作，格式如下："
-            system_content += "\n1. 执行终端命令："
-            system_content += "\n;;{\"mcp\":\"request\",\"id\":\"001\",\"module\":\"system\",\"method\":\"terminal.run\",\"params\":{\"command1\":\"echo hello\",\"command2\":\"echo world\"}};;"
-            system_content += "\n2. 执行Python代码："
-            system_content += "\n- 单行命令：;;{\"mcp\":\"request\",\"id\":\"002\",\"module\":\"python\",\"method\":\"run.execute\",\"params\":{\"command\":\"print('hello')\"}};;"
-            system_content += "\n- 多行脚本：;;{\"mcp\":\"request\",\"id\":\"003\",\"module\":\"python\",\"method\":\"run.execute\",\"params\":{\"script\":[\"print('hello')\",\"print('world')\",\"x=1+1\",\"print(x)\"]}};;"
-            system_content += "\n3. 获取时间：;;{\"mcp\":\"request\",\"id\":\"004\",\"module\":\"system\",\"method\":\"time.get\",\"params\":{\"type\":\"date\"}};;"
-            system_content += "\n4. 获取系统信息：;;{\"mcp\":\"request\",\"id\":\"005\",\"module\":\"system\",\"method\":\"info.get\",\"params\":{}};;"
-            system_content += "\n注意：收到MCP响应后，不需要再次生成MCP请求，直接用自然语言回复用户即可"
-
-            if self.config.prompt_file != "None":
-                try:
-                    with open(self.config.prompt_file, "r", encoding="utf-8") as f:
-                        prompt_content = f.read()
-                    system_content += f"\n{prompt_content}"
-                except Exception as e:
-                    self.log_ai_message(f"读取提示词文件失败: {str(e)}")
+        if prompt_content is not None:
+            system_content += f"\n{prompt_content}"
+        elif prompt_file_state is not None:
+            self.log_ai_message(f"读取提示词文件失败: {prompt_file_state[1]}")
 
-            if self.config.send_saved_history:
-                for entry in self.saved_history:
-                    system_content += f"\n{entry['role']}: {entry['content']}"
+        self.system_prompt_cache = (cache_key, system_content)
+        return system_content
+
+    def read_prompt_file(self):
+        """
+        读取提示词文件，文件的修改时间和大小不变时直接使用缓存的内容
+        :return: (文件状态, 文件内容)，未设置提示词文件时为(None, None)，读取失败时内容为None
+        """
+        path = self.config.prompt_file
+        if path == "None":
+            return None, None
+        try:
+            stat = os.stat(path)
+            state = (path, stat.st_mtime_ns, stat.st_size)
+            if self.prompt_file_cache is not None and self.prompt_file_cache[0] == state:
+                return state, self.prompt_file_cache[1]
+            with open(path, "r", encoding="utf-8") as f:
+                prompt_content = f.read()
+            self.prompt_file_cache = (state, prompt_content)
+            return state, prompt_content
+        except Exception as e:
+            return ("error", str(e)), None
 
-            messages = [{"role": "system", "content": system_content}]
+    def log_context_report(self, report):
+        """打印本次请求的上下文组装情况"""
+        self.log.emit("context", report=report)
 
-            if self.config.send_history:
-                for entry in self.chat_history:
-                    messages.append({"role": entry["role"], "content": entry["content"]})
+    def read_stream_response(self, response):
+        """
+        读取SSE流式响应，边接收边打印，MCP请求块一旦完整就立即开始执行
+        :return: (完整回复文本, [(MCP块字符串, Future或None), ...])
+        """
+        renderer = StreamRenderer(self.config.ai_name, output=self.output, before_write=self.log.flush)
+        early_results = []
+        received = 0
+        try:
+            for line in response.iter_lines():
+                received += len(line)
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    break
+                chunk = json.loads(data)
+                choices = chunk.get("choices") or [{}]
+                content = (choices[0].get("delta") or {}).get("content")
+                if not content:
+                    continue
+                for mcp_str in renderer.feed(content):
+                    early_results.append((mcp_str, self.dispatch_mcp_early(mcp_str)))
+        finally:
+            response.close()
+            renderer.finish()
+            self.metrics.observe("api.response_bytes", received)
+        return renderer.text, early_results
 
-            messages.append({"role": "user", "content": user_message})
+    def dispatch_mcp_early(self, mcp_str):
+        """在生成过程中提前提交MCP请求，无法解析的块留给handle_ai_response报告错误"""
+        try:
+            mcp_json = json.loads(mcp_str)
+        except json.JSONDecodeError:
+            return None
+        if not isinstance(mcp_json, dict) or mcp_json.get("mcp") != "request":
+            return None
+        if not self.can_run_in_parallel(mcp_json):
+            return None
+        return self.mcp_executor.submit(self.handle_mcp_request, mcp_json)
 
-            response = requests.post(
-                self.config.api_url,
-                headers={"Authorization": f"Bearer {self.config.api_key}"},
-                json={"model": self.config.model, "messages": messages}
-            )
+    def can_run_in_parallel(self, mcp_json):
+        """
+        未启用Python内核时，python模块会重定向全局stdout，只能在没有其他工具运行时执行；
+        声明了parallel为False的插件方法同样串行执行
+        """
+        module = mcp_json.get("module")
+        if module == "python" and not self.config.python_kernel:
+            return False
+        method = self.get_mcp_registry().lookup(module, mcp_json.get("method"))
+        return method is None or method.parallel
 
-            if response.status_code == 200:
-                ai_response = response.json().get("choices", [{}])[0].get("message", {}).get("content", "未获取到回复")
-                self.handle_ai_response(ai_response, user_message)
+    def execute_mcp_requests(self, pending):
+        """
+        执行一批相互独立的MCP请求
+        :param pending: [(MCP请求JSON, 已提交的Future或None), ...]
+        :return: 与pending顺序一致的MCP响应列表
+        """
+        responses = [None] * len(pending)
+        futures = []
+        serial = []
+        for index, (mcp_json, future) in enumerate(pending):
+            if future is None and self.can_run_in_parallel(mcp_json):
+                future = self.mcp_executor.submit(self.handle_mcp_request, mcp_json)
+            if future is None:
+                serial.append(index)
             else:
-                self.log_ai_message(f"错误: {response.text}")
-        except Exception as e:
-            self.log_ai_message(f"请求失败: {str(e)}")
+                futures.append((index, future))
+        for index, future in futures:
+            responses[index] = future.result()
+        # 不能并发的请求等并发请求全部结束后再按顺序执行
+        for index in serial:
+            responses[index] = self.handle_mcp_request(pending[index][0])
+        return responses
 
-    def handle_ai_response(self, ai_response, user_message):
-        """处理AI响应"""
-        mcp_pattern = r";;({.*?});;"
-        mcp_matches = re.findall(mcp_pattern, ai_response, re.DOTALL)
+    def handle_ai_response(self, ai_response, early_results=None, streamed=False):
+        """
+        处理AI响应：执行其中的MCP请求，没有MCP请求时直接显示回复
+        :param early_results: 流式模式下已提前开始执行的MCP请求
+        :param streamed: 回复是否已经在流式输出时打印过
+        :return: 按请求顺序排列的MCP响应列表
+        """
+        mcp_matches = McpScanner.find_all(ai_response)
+        early_results = early_results or []
         
         if mcp_matches:
-            for mcp_str in mcp_matches:
+            pending = []
+            for index, mcp_str in enumerate(mcp_matches):
                 try:
+                    future = None
+                    if index < len(early_results) and early_results[index][0] == mcp_str:
+                        future = early_results[index][1]
                     mcp_json = json.loads(mcp_str)
                     if mcp_json.get("mcp") == "request":
-                        # 直接调用自身的MCP处理方法
-                        mcp_response = self.handle_mcp_request(mcp_json)
-                        self.chat_history.append({"role": "assistant", "content": ai_response})
-                        self.call_api(mcp_response)
+                        pending.append((mcp_json, future))
                 except json.JSONDecodeError as e:
                     error_msg = f"MCP JSON解析错误: {str(e)}"
                     self.log_ai_message(error_msg)
                 except Exception as e:
                     error_msg = f"MCP处理错误: {str(e)}"
                     self.log_ai_message(error_msg)
-        else:
-            print(f"{self.config.ai_name}: {ai_response}")
-            self.chat_history.append({"role": "user", "content": user_message})
-            self.chat_history.append({"role": "assistant", "content": ai_response})
 
-            if self.config.save_history:
-                self.save_chat_history(user_message, ai_response)
+            # 相互独立的请求并发执行，响应按请求出现的顺序返回
+            if pending:
+                return self.execute_mcp_requests(pending)
+
+        # 没有可执行的MCP请求：这就是最终回复
+        if not streamed:
+            self.log.flush()
+            print(f"{self.config.ai_name}: {ai_response}", file=self.output)
+        return []
 
     # ===================== MCP协议处理方法（原mcp类的方法） =====================
-    def parse_mcp_request(self, mcp_json):
-        """解析MCP请求JSON"""
-        try:
-            method_parts = mcp_json.get("method", "").split(".")
-            method_name = method_parts[0] if len(method_parts) > 0 else ""
-            func_name = method_parts[1] if len(method_parts) > 1 else ""
-            
-            return {
-                "id": mcp_json.get("id", ""),
-                "module": mcp_json.get("module", ""),
-                "method": method_name,
-                "func": func_name,
-                "full_method": mcp_json.get("method", ""),
-                "params": mcp_json.get("params", {})
-            }
-        except Exception as e:
-            return {"error": f"解析MCP请求失败: {str(e)}"}
-    
     def handle_mcp_request(self, mcp_json):
-        """处理MCP请求并返回响应"""
-        logger_mode = self.config.logger
-        # lite模式下不打印MCP请求的原始日志
-        if logger_mode in ["all", "format"]:
-            if logger_mode == "all":
-                print(f"[日志] mcp请求:\n{json.dumps(mcp_json, ensure_ascii=False, separators=(',', ':'))}")
-            elif logger_mode == "format":
-                print(f"[日志] mcp请求:")
-                print(format_json_for_log(mcp_json, "  "))
+        """处理MCP请求并返回响应（McpResponse）"""
+        # lite模式下不打印MCP请求和响应的原始日志
+        self.log.emit("mcp_request", request=mcp_json)
         
-        parsed = self.parse_mcp_request(mcp_json)
-        if "error" in parsed:
+        try:
+            parsed = McpRequest.parse(mcp_json)
+        except Exception as e:
             response = self.build_error_response(
-                mcp_json.get("id", "unknown"),
+                mcp_json.get("id", "unknown") if isinstance(mcp_json, dict) else "unknown",
                 {"module": "system", "method": "parse.error", "params": {}},
                 1001,
-                parsed["error"]
+                f"解析MCP请求失败: {str(e)}"
             )
-            # lite模式下不打印MCP响应的原始日志
-            if logger_mode in ["all", "format"]:
-                if logger_mode == "all":
-                    print(f"[日志] mcp返回:\n{json.dumps(json.loads(response[2:-2]), ensure_ascii=False, separators=(',', ':'))}")
-                elif logger_mode == "format":
-                    print(f"[日志] mcp返回:")
-                    if response.startswith(";;") and response.endswith(";;"):
-                        json_str = response[2:-2]
-                        print(format_json_for_log(json_str, "  "))
-                    else:
-                        print(f"  {response}")
+            self.log.emit("mcp_response", response=response)
             return response
         
-        module = parsed["module"]
-        if module == "system":
-            response = self.handle_system_module(parsed)
-        elif module == "python":
-            response = self.handle_python_module(parsed)
-        else:
-            response = self.build_error_response(
-                parsed["id"],
-                {"module": module, "method": parsed.get("full_method", ""), "params": parsed.get("params", {})},
-                1002,
-                f"未知模块: {module}"
-            )
-        
-        # lite模式下不打印MCP响应的原始日志
-        if logger_mode in ["all", "format"]:
-            if logger_mode == "all":
-                print(f"[日志] mcp返回:\n{json.dumps(json.loads(response[2:-2]), ensure_ascii=False, separators=(',', ':'))}")
-            elif logger_mode == "format":
-                print(f"[日志] mcp返回:")
-                if response.startswith(";;") and response.endswith(";;"):
-                    json_str = response[2:-2]
-                    print(format_json_for_log(json_str, "  "))
+        started = time.perf_counter()
+        with self.tracer.span("mcp_request", module=parsed.module, method=parsed.full_method, id=parsed.id) as span:
+            cache_key = self.mcp_cache.make_key(parsed) if self.config.mcp_cache else None
+            response = self.mcp_cache.get(cache_key, parsed.id) if cache_key is not None else None
+            if response is None:
+                response = self.dispatch_mcp_request(parsed)
+                if cache_key is not None:
+                    self.mcp_cache.put(cache_key, parsed, response)
                 else:
-                    print(f"  {response}")
+                    self.mcp_cache.after_execute(parsed)
+            elif span is not None:
+                span.args["cache"] = "hit"
+        # 模块和方法名来自模型的输出，只有已注册的方法单独统计，避免为每个编造的名称创建一个直方图
+        if self.get_mcp_registry().lookup(parsed.module, parsed.full_method) is not None:
+            latency_label = f"{parsed.module}.{parsed.full_method}"
+        else:
+            latency_label = "unknown"
+        self.metrics.observe(f"mcp.latency_ms[{latency_label}]", (time.perf_counter() - started) * 1000)
+        self.metrics.observe("mcp.response_bytes", len(response.serialize()))
+        if response.is_error:
+            self.metrics.increment("mcp.errors")
         
+        self.log.emit("mcp_response", response=response)
         return response
     
-    def handle_system_module(self, parsed):
-        """处理system模块的MCP请求"""
-        method = parsed["method"]
-        func = parsed["func"]
-        full_method = parsed["full_method"]
-        params = parsed["params"]
-        result = {}
-        
-        info = {
-            "module": parsed["module"],
-            "method": full_method,
-            "params": params
-        }
-        
-        try:
-            # 将run方法改为terminal，统一用run函数执行终端命令
-            if method == "terminal" and func == "run":
-                for cmd_key, cmd_value in params.items():
-                    if cmd_value.strip():
-                        output, error = self.run_terminal_command(cmd_value)
-                        if error:
-                            result[cmd_key] = f"错误: {error}"
-                        elif output:
-                            result[cmd_key] = output.strip()
-                        else:
-                            result[cmd_key] = "命令执行成功（无输出）"
-                return self.build_success_response(parsed["id"], info, result)
-            
-            elif method == "time" and func == "get":
-                time_type = list(params.values())[0] if params else ""
-                time_value = self.get_time_raw(time_type)
-                result = {"time": time_value}
-                return self.build_success_response(parsed["id"], info, result)
-            
-            elif method == "info" and func == "get":
-                info_value = self.get_system_info_raw()
-                result = {"system_info": info_value}
-                return self.build_success_response(parsed["id"], info, result)
-            
-            else:
-                return self.build_error_response(
-                    parsed["id"],
-                    info,
-                    1003,
-                    f"未知的方法/函数组合: {method}.{func}"
-                )
-        
-        except Exception as e:
+    def dispatch_mcp_request(self, parsed):
+        """按(模块, 方法)在注册表中查找处理函数并执行"""
+        registry = self.get_mcp_registry()
+        module = registry.modules.get(parsed.module)
+        if module is None:
+            return self.build_error_response(parsed.id, parsed.info, 1002, f"未知模块: {parsed.module}")
+        method = registry.lookup(parsed.module, parsed.full_method)
+        if method is None:
             return self.build_error_response(
-                parsed["id"],
-                info,
-                1004,
-                f"执行命令失败: {str(e)}"
+                parsed.id,
+                parsed.info,
+                module.unknown_code,
+                f"未知的方法/函数组合: {parsed.full_method}，{module.name}模块仅支持 {'/'.join(registry.method_names(module.name))}"
             )
-    
-    def handle_python_module(self, parsed):
-        """处理python模块的MCP请求"""
-        method = parsed["method"]
-        func = parsed["func"]
-        full_method = parsed["full_method"]
-        params = parsed["params"]
-        result = {}
-        
-        info = {
-            "module": parsed["module"],
-            "method": full_method,
-            "params": params
-        }
-        
         try:
-            # Python模块只支持run.execute方法
-            if method == "run" and func == "execute":
-                # 遍历参数执行Python代码
-                for param_key, param_value in params.items():
-                    if param_key == "command":
-                        # 单行Python命令
-                        if not isinstance(param_value, str):
-                            result[param_key] = f"错误: command必须是字符串类型，当前类型: {type(param_value).__name__}"
-                            continue
-                        # 执行单行Python代码
-                        exec_result, exec_error = self.run_python_command(param_value)
-                        if exec_error:
-                            result[param_key] = f"执行错误: {exec_error}"
-                        else:
-                            result[param_key] = exec_result if exec_result is not None else "执行成功（无返回值）"
-                    
-                    elif param_key == "script":
-                        # 多行Python脚本（列表形式）
-                        if not isinstance(param_value, list):
-                            result[param_key] = f"错误: script必须是列表类型，当前类型: {type(param_value).__name__}"
-                            continue
-                        # 检查列表元素是否都是字符串
-                        if not all(isinstance(line, str) for line in param_value):
-                            result[param_key] = "错误: script列表中的所有元素必须是字符串类型"
-                            continue
-                        # 执行多行Python脚本
-                        exec_result, exec_error = self.run_python_script(param_value)
-                        if exec_error:
-                            result[param_key] = f"执行错误: {exec_error}"
-                        else:
-                            result[param_key] = exec_result if exec_result else "脚本执行成功（无输出）"
-                    
-                    else:
-                        # 未知参数键
-                        result[param_key] = f"错误: 不支持的参数键 '{param_key}'，仅支持 command/script"
-                
-                return self.build_success_response(parsed["id"], info, result)
+            return method.handler(parsed)
+        except Exception as e:
+            return self.build_error_response(parsed.id, parsed.info, module.failure_code, f"{module.failure_message}: {str(e)}")
+
+    # ===================== MCP模块注册 =====================
+    def create_mcp_registry(self):
+        """注册内置的system和python模块"""
+        registry = McpRegistry()
+        registry.add_module(McpModule("system", 1003, 1004, "执行命令失败"))
+        registry.add_module(McpModule("python", 2001, 2002, "执行Python代码失败"))
+        registry.register("system", McpMethod(
+            "terminal.run", self.mcp_terminal_run,
+            title="执行终端命令",
+            examples=[(None, {"command1": "echo hello", "command2": "echo world"})],
+            notes=self.terminal_prompt_notes,
+            cache="readonly"
+        ))
+        registry.register("python", McpMethod(
+            "run.execute", self.mcp_python_execute,
+            title="执行Python代码",
+            examples=[
+                ("单行命令", {"command": "print('hello')"}),
+                ("多行脚本", {"script": ["print('hello')", "print('world')", "x=1+1", "print(x)"]})
+            ],
+            notes=["变量和导入的模块在多次执行之间保留；重置命名空间：method为kernel.reset，重启Python进程：method为kernel.restart（params为空）"]
+        ))
+        # 重置/重启会清空解释器状态：和其他请求分开按顺序执行，执行后使缓存的结果失效
+        registry.register("python", McpMethod("kernel.reset", self.mcp_kernel_reset, parallel=False))
+        registry.register("python", McpMethod("kernel.restart", self.mcp_kernel_restart, parallel=False))
+        registry.register("system", McpMethod(
+            "time.get", self.mcp_time_get,
+            title="获取时间",
+            examples=[(None, {"type": "date"})],
+            side_effects=False
+        ))
+        registry.register("system", McpMethod(
+            "info.get", self.mcp_info_get,
+            title="获取系统信息",
+            examples=[(None, {})],
+            cache="session",
+            side_effects=False
+        ))
+        return registry
+
+    def terminal_prompt_notes(self):
+        if self.use_shell_session():
+            return ["命令在同一个持久shell会话中按顺序执行，cd、export等设置会保留到之后的命令"]
+        return ["多条命令默认并发执行，命令之间有先后依赖时在params中加入\"sequential\":true按顺序执行"]
+
+    def get_mcp_registry(self):
+        """返回MCP注册表，插件目录有文件增删时重新读取插件的注册信息"""
+        plugin_dir = self.config.mcp_plugin_dir
+        try:
+            plugin_state = (plugin_dir, os.stat(plugin_dir).st_mtime_ns) if plugin_dir else None
+        except OSError:
+            plugin_state = (plugin_dir, None)
+        if plugin_state == self.mcp_plugin_state:
+            return self.mcp_registry
+        with self.mcp_plugin_lock:
+            if plugin_state != self.mcp_plugin_state:
+                self.load_mcp_plugins(plugin_state is None or self.mcp_plugin_state is None)
+                self.mcp_plugin_state = plugin_state
+        return self.mcp_registry
+
+    def load_mcp_plugins(self, include_entry_points):
+        """
+        重新注册插件目录中的模块，entry point插件只在第一次加载时注册
+        插件只读取注册信息，代码在第一次调用时才导入，因此插件数量对启动速度影响很小
+        """
+        entry_point_group = "agentcli.mcp_modules" if include_entry_points and self.config.mcp_plugin_entry_points else None
+        for name in self.mcp_plugin_names.pop("dir", []):
+            self.mcp_registry.remove_module(name)
+        for name, path, import_name in find_mcp_plugins(self.config.mcp_plugin_dir, entry_point_group):
+            kind = "entry_point" if import_name else "dir"
+            try:
+                registered = load_mcp_plugin(self.mcp_registry, name, path, import_name)
+            except Exception as e:
+                self.log.error("mcp_plugin_error", name=name, path=path, error=f"{type(e).__name__}: {str(e)}")
+                continue
+            self.mcp_plugin_names.setdefault(kind, []).append(registered)
+            self.log.emit("mcp_plugin", name=registered, path=path)
+
+    # ===================== 内置MCP方法 =====================
+    def mcp_terminal_run(self, parsed):
+        """system.terminal.run：执行终端命令"""
+        params = parsed.params
+        # sequential为保留参数：命令之间有依赖时按顺序执行
+        sequential = params.get("sequential") is True or self.config.tool_sequential
+        commands = [
+            (cmd_key, cmd_value) for cmd_key, cmd_value in params.items()
+            if cmd_key != "sequential" and cmd_value.strip()
+        ]
+        result = self.run_terminal_commands(commands, sequential)
+        return self.build_success_response(parsed.id, parsed.info, result)
+
+    def mcp_time_get(self, parsed):
+        """system.time.get：获取时间"""
+        params = parsed.params
+        time_type = list(params.values())[0] if params else ""
+        return self.build_success_response(parsed.id, parsed.info, {"time": self.get_time_raw(time_type)})
+
+    def mcp_info_get(self, parsed):
+        """system.info.get：获取系统信息"""
+        return self.build_success_response(parsed.id, parsed.info, {"system_info": self.get_system_info_raw()})
+
+    def mcp_python_execute(self, parsed):
+        """python.run.execute：执行单行Python命令（command）或多行脚本（script）"""
+        result = {}
+        # 遍历参数执行Python代码
+        for param_key, param_value in parsed.params.items():
+            if param_key == "command":
+                # 单行Python命令
+                if not isinstance(param_value, str):
+                    result[param_key] = f"错误: command必须是字符串类型，当前类型: {type(param_value).__name__}"
+                    continue
+                # 执行单行Python代码
+                exec_result, exec_error, truncation = self.run_python_command(param_value)
+                if exec_error:
+                    result[param_key] = f"执行错误: {exec_error}"
+                else:
+                    result[param_key] = exec_result if exec_result is not None else "执行成功（无返回值）"
+                if truncation:
+                    result.setdefault("truncation", {})[param_key] = truncation
+            
+            elif param_key == "script":
+                # 多行Python脚本（列表形式）
+                if not isinstance(param_value, list):
+                    result[param_key] = f"错误: script必须是列表类型，当前类型: {type(param_value).__name__}"
+                    continue
+                # 检查列表元素是否都是字符串
+                if not all(isinstance(line, str) for line in param_value):
+                    result[param_key] = "错误: script列表中的所有元素必须是字符串类型"
+                    continue
+                # 执行多行Python脚本
+                exec_result, exec_error, truncation = self.run_python_script(param_value)
+                if exec_error:
+                    result[param_key] = f"执行错误: {exec_error}"
+                else:
+                    result[param_key] = exec_result if exec_result else "脚本执行成功（无输出）"
+                if truncation:
+                    result.setdefault("truncation", {})[param_key] = truncation
             
             else:
-                return self.build_error_response(
-                    parsed["id"],
-                    info,
-                    2001,
-                    f"Python模块未知的方法/函数组合: {method}.{func}，仅支持 run.execute"
-                )
+                # 未知参数键
+                result[param_key] = f"错误: 不支持的参数键 '{param_key}'，仅支持 command/script"
         
-        except Exception as e:
-            return self.build_error_response(
-                parsed["id"],
-                info,
-                2002,
-                f"执行Python代码失败: {str(e)}"
-            )
+        return self.build_success_response(parsed.id, parsed.info, result)
+
+    def mcp_kernel_reset(self, parsed):
+        """python.kernel.reset：清空内核命名空间"""
+        if not self.config.python_kernel:
+            return self.build_error_response(parsed.id, parsed.info, 2003, "未启用Python内核（python_kernel配置为False）")
+        reset_result, reset_error = self.python_kernel.reset()
+        if reset_error:
+            return self.build_error_response(parsed.id, parsed.info, 2002, f"重置Python内核失败: {reset_error}")
+        return self.build_success_response(parsed.id, parsed.info, {"kernel": reset_result})
+
+    def mcp_kernel_restart(self, parsed):
+        """python.kernel.restart：重启内核进程"""
+        if not self.config.python_kernel:
+            return self.build_error_response(parsed.id, parsed.info, 2003, "未启用Python内核（python_kernel配置为False）")
+        self.python_kernel.restart()
+        return self.build_success_response(parsed.id, parsed.info, {"kernel": "Python内核已重启"})
     
     def build_success_response(self, req_id, info, result):
         """构建成功的MCP响应"""
-        response = {
-            "mcp": "response",
-            "id": req_id,
-            "info": info,
-            "result": result
-        }
-        return f";;{json.dumps(response, ensure_ascii=False, separators=(',', ':'))};;"
+        return McpResponse.success(req_id, info, result)
     
     def build_error_response(self, req_id, info, error_code, error_msg):
         """构建错误的MCP响应"""
-        response = {
-            "mcp": "response",
-            "id": req_id,
-            "info": info,
-            "error": {
-                "code": error_code,
-                "message": error_msg
-            }
-        }
-        return f";;{json.dumps(response, ensure_ascii=False, separators=(',', ':'))};;"
+        return McpResponse.failure(req_id, info, error_code, error_msg)
 
     # ===================== 命令执行方法 =====================
+    def run_terminal_commands(self, commands, sequential=False):
+        """
+        执行一组终端命令，互不依赖的命令并发执行
+        :param commands: [(参数键, 命令), ...]
+        :return: 按参数键原有顺序排列的结果字典
+        """
+        command_values = [cmd_value for _, cmd_value in commands]
+        # 持久会话中的命令共享工作目录和环境变量，只能按顺序执行
+        if sequential or len(commands) <= 1 or self.use_shell_session():
+            outcomes = [self.run_terminal_command(cmd_value) for cmd_value in command_values]
+        else:
+            outcomes = list(self.command_executor.map(self.run_terminal_command, command_values))
+
+        result = {}
+        truncations = {}
+        for (cmd_key, _), (output, error, truncation) in zip(commands, outcomes):
+            if truncation:
+                truncations[cmd_key] = truncation
+            if error:
+                result[cmd_key] = f"错误: {error}"
+            elif output:
+                result[cmd_key] = output.strip()
+            else:
+                result[cmd_key] = "命令执行成功（无输出）"
+        # 输出被截断时告知AI总量和截断限制
+        if truncations:
+            result["truncation"] = truncations
+        return result
+
+    def use_shell_session(self):
+        """是否使用持久shell会话执行终端命令"""
+        return self.config.terminal_mode == "session" and ShellSession.is_supported()
+
     def run_terminal_command(self, command):
         """统一执行终端命令（移除powershell，仅保留通用shell）"""
-        try:
-            original_command = command
-            os_type = platform.system()
-            
-            # 平台适配
-            if os_type == "Windows":
-                # Windows下使用cmd.exe执行
-                if command.startswith("start "):
-                    command = f"start /b {command[6:]}"
-            elif os_type in ["Linux", "Darwin"]:
-                # Linux/macOS下使用系统默认shell执行
-                if not command.endswith("&"):
-                    command = f"{command} &"
-
-            # 打印要执行的命令日志（根据logger模式判断）
-            logger_mode = self.config.logger
-            if logger_mode in ["all", "format", "lite"]:
-                print(f"[system@terminal:run] 执行终端命令: {original_command}")
-
-            # 执行命令（统一使用shell=True）
-            result = subprocess.run(
-                command, 
-                shell=True, 
-                text=True, 
-                capture_output=True,
-                encoding='utf-8',
-                errors='ignore'
-            )
-
-            output = result.stdout.strip()
-            error = result.stderr.strip()
-
-            # 打印命令执行结果日志（根据logger模式展示不同格式）
-            if logger_mode in ["all", "format", "lite"]:
-                if logger_mode == "all":
-                    if output:
-                        print(f"[system@terminal:run] 命令输出: {output}")
-                    if error:
-                        print(f"[system@terminal:run] 命令错误: {error}")
-                elif logger_mode == "format":
-                    print(f"[system@terminal:run] 终端命令执行结果:")
-                    if output:
-                        print(f"  输出: {output}")
-                    if error:
-                        print(f"  错误: {error}")
-                elif logger_mode == "lite":
-                    # lite模式只显示简洁的执行结果
-                    if error:
-                        print(f"[system@terminal:run] 执行结果: 错误: {error}")
-                    elif output:
-                        print(f"[system@terminal:run] 执行结果: {output}")
-                    else:
-                        print(f"[system@terminal:run] 执行结果: 命令执行成功（无输出）")
+        with self.tracer.span("terminal_command", command=command):
+            try:
+                original_command = command
+                self.log.emit("terminal_command", command=original_command)
 
-            return output, error
-        except Exception as e:
-            # 异常信息根据logger模式显示
-            logger_mode = self.config.logger
-            if logger_mode in ["all", "format", "lite"]:
-                if logger_mode == "lite":
-                    print(f"[system@terminal:run] 执行结果: 错误: {str(e)}")
+                if self.use_shell_session():
+                    output, error, exit_code, truncation = self.shell_session.run(command)
+                    output = output.strip()
+                    error = error.strip()
+                    if not error and exit_code:
+                        error = f"命令退出码: {exit_code}"
                 else:
-                    print(f"[system@terminal:run] 终端命令执行错误: {str(e)}")
-            return "", str(e)
-    
+                    output, error, truncation = self.run_terminal_command_oneshot(command)
+
+                self.log.emit("terminal_result", output=output, error=error)
+                return output, error, truncation
+            except Exception as e:
+                self.log.error("terminal_error", error=str(e))
+                return "", str(e), None
+
+    def run_terminal_command_oneshot(self, command):
+        """为每条命令启动新的shell进程执行"""
+        os_type = platform.system()
+        
+        # 平台适配
+        if os_type == "Windows":
+            # Windows下使用cmd.exe执行
+            if command.startswith("start "):
+                command = f"start /b {command[6:]}"
+        elif os_type in ["Linux", "Darwin"]:
+            # Linux/macOS下使用系统默认shell执行
+            if not command.endswith("&"):
+                command = f"{command} &"
+
+        # 执行命令（统一使用shell=True），输出以流的方式读入有界缓冲
+        process = subprocess.Popen(
+            command,
+            shell=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=(os.name == "posix")
+        )
+        outputs = {
+            "stdout": BoundedOutput(self.config.terminal_output_head, self.config.terminal_output_tail),
+            "stderr": BoundedOutput(self.config.terminal_output_head, self.config.terminal_output_tail)
+        }
+        readers = [
+            threading.Thread(target=drain_stream, args=(process.stdout, outputs["stdout"]), daemon=True),
+            threading.Thread(target=drain_stream, args=(process.stderr, outputs["stderr"]), daemon=True)
+        ]
+        for reader in readers:
+            reader.start()
+
+        # 后台进程会一直占用输出管道，因此等待读取线程结束而不是shell进程结束
+        deadline = time.monotonic() + self.config.terminal_timeout if self.config.terminal_timeout > 0 else None
+        timed_out = False
+        for reader in readers:
+            reader.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+            if reader.is_alive():
+                timed_out = True
+                break
+        if timed_out:
+            if os.name == "posix":
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            else:
+                process.kill()
+            for reader in readers:
+                reader.join(1)
+        process.wait()
+        process.stdout.close()
+        process.stderr.close()
+
+        output = outputs["stdout"].getvalue().strip()
+        error = outputs["stderr"].getvalue().strip()
+        if timed_out:
+            error = f"命令执行超时（超过{self.config.terminal_timeout}秒）"
+        return output, error, collect_truncation(outputs)
+
     def run_python_command(self, command):
         """执行单行Python命令"""
-        try:
-            # 打印Python命令执行日志（根据logger模式判断）
-            logger_mode = self.config.logger
-            if logger_mode in ["all", "format", "lite"]:
-                print(f"[python@run:execute] 执行Python命令: {command}")
+        with self.tracer.span("python_command"):
+            try:
+                self.log.emit("python_command", command=command)
             
-            # 捕获标准输出
-            output_buffer = io.StringIO()
-            with contextlib.redirect_stdout(output_buffer):
-                try:
-                    # 先尝试用eval执行（有返回值的表达式）
-                    result = eval(command)
+                if self.config.python_kernel:
+                    # 在持久内核中执行，命名空间在多次调用之间保留
+                    final_result, kernel_error, truncation = self.python_kernel.execute("command", command)
+                    if kernel_error:
+                        raise PythonKernelError(kernel_error)
+                else:
+                    # 捕获标准输出
+                    output_buffer = BoundedOutput(self.config.python_output_head, self.config.python_output_tail)
+                    outputs = {"stdout": output_buffer}
+                    with contextlib.redirect_stdout(BoundedTextWriter(output_buffer)):
+                        try:
+                            # 先尝试用eval执行（有返回值的表达式）
+                            result = eval(command)
+                            is_expression = True
+                        except SyntaxError:
+                            # eval执行失败，用exec执行（无返回值的语句）
+                            exec(command)
+                            is_expression = False
+                        except:
+                            # 其他错误，再次尝试exec
+                            exec(command)
+                            is_expression = False
                     output = output_buffer.getvalue().strip()
-                    # 如果有stdout输出，返回输出+返回值；否则只返回返回值
-                    if output:
-                        final_result = f"{output}\n返回值: {result}"
+                    if is_expression:
+                        # 返回值和输出一样按head/tail截断
+                        result, outputs["result"] = to_kernel_result(
+                            result, self.config.python_output_head, self.config.python_output_tail
+                        )
+                        # 如果有stdout输出，返回输出+返回值；否则只返回返回值
+                        final_result = f"{output}\n返回值: {result}" if output else result
                     else:
-                        final_result = result
-                except SyntaxError:
-                    # eval执行失败，用exec执行（无返回值的语句）
-                    exec(command)
-                    final_result = output_buffer.getvalue().strip()
-                except:
-                    # 其他错误，再次尝试exec
-                    exec(command)
-                    final_result = output_buffer.getvalue().strip()
-            
-            # 打印执行结果日志（根据logger模式展示不同格式）
-            if logger_mode in ["all", "format", "lite"]:
-                if logger_mode == "all":
-                    print(f"[python@run:execute] Python命令执行结果: {final_result if final_result else '无输出'}")
-                elif logger_mode == "format":
-                    print(f"[python@run:execute] Python命令执行结果:")
-                    print(f"  输出: {final_result if final_result else '无输出'}")
-                elif logger_mode == "lite":
-                    # lite模式只显示简洁的执行结果
-                    print(f"[python@run:execute] 执行结果: {final_result if final_result else '执行成功（无输出）'}")
+                        final_result = output
+                    truncation = collect_truncation(outputs)
             
-            return final_result, ""
+                self.log_python_result("命令", final_result)
+                return final_result, "", truncation
         
-        except Exception as e:
-            error_msg = f"{type(e).__name__}: {str(e)}"
-            # 打印错误日志（根据logger模式显示）
-            logger_mode = self.config.logger
-            if logger_mode in ["all", "format", "lite"]:
-                if logger_mode == "lite":
-                    print(f"[python@run:execute] 执行结果: 错误: {error_msg}")
-                else:
-                    print(f"[python@run:execute] Python命令执行错误: {error_msg}")
-            return None, error_msg
+            except Exception as e:
+                error_msg = str(e) if isinstance(e, PythonKernelError) else f"{type(e).__name__}: {str(e)}"
+                self.log.error("python_error", kind="命令", error=error_msg)
+                return None, error_msg, None
     
     def run_python_script(self, script_lines):
         """执行多行Python脚本（从列表还原为脚本）"""
-        try:
-            # 将列表还原为完整的Python脚本
-            script = "\n".join(script_lines)
-            
-            # 打印Python脚本执行日志（根据logger模式判断）
-            logger_mode = self.config.logger
-            if logger_mode in ["all", "format", "lite"]:
-                if logger_mode == "lite":
-                    print(f"[python@run:execute] 执行Python脚本（共{len(script_lines)}行）")
-                else:
-                    print(f"[python@run:execute] 执行Python脚本:")
-                    print(f"  脚本内容:")
-                    for i, line in enumerate(script_lines, 1):
-                        print(f"    {i}: {line}")
-            
-            # 捕获标准输出
-            output_buffer = io.StringIO()
-            with contextlib.redirect_stdout(output_buffer):
-                exec(script)
+        with self.tracer.span("python_script", lines=len(script_lines)):
+            try:
+                # 将列表还原为完整的Python脚本
+                script = "\n".join(script_lines)
             
-            final_result = output_buffer.getvalue().strip()
+                self.log.emit("python_script", lines=script_lines)
             
-            # 打印执行结果日志（根据logger模式展示不同格式）
-            if logger_mode in ["all", "format", "lite"]:
-                if logger_mode == "all":
-                    print(f"[python@run:execute] Python脚本执行结果: {final_result if final_result else '无输出'}")
-                elif logger_mode == "format":
-                    print(f"[python@run:execute] Python脚本执行结果:")
-                    print(f"  输出: {final_result if final_result else '无输出'}")
-                elif logger_mode == "lite":
-                    # lite模式只显示简洁的执行结果
-                    print(f"[python@run:execute] 执行结果: {final_result if final_result else '执行成功（无输出）'}")
+                if self.config.python_kernel:
+                    # 在持久内核中执行，编译结果按源码哈希缓存
+                    final_result, kernel_error, truncation = self.python_kernel.execute("script", script)
+                    if kernel_error:
+                        raise PythonKernelError(kernel_error)
+                else:
+                    # 捕获标准输出
+                    output_buffer = BoundedOutput(self.config.python_output_head, self.config.python_output_tail)
+                    with contextlib.redirect_stdout(BoundedTextWriter(output_buffer)):
+                        exec(script)
+                    final_result = output_buffer.getvalue().strip()
+                    truncation = collect_truncation({"stdout": output_buffer})
             
-            return final_result, ""
+                self.log_python_result("脚本", final_result)
+                return final_result, "", truncation
         
-        except Exception as e:
-            error_msg = f"{type(e).__name__}: {str(e)}"
-            # 打印错误日志（根据logger模式显示）
-            logger_mode = self.config.logger
-            if logger_mode in ["all", "format", "lite"]:
-                if logger_mode == "lite":
-                    print(f"[python@run:execute] 执行结果: 错误: {error_msg}")
-                else:
-                    print(f"[python@run:execute] Python脚本执行错误: {error_msg}")
-            return None, error_msg
+            except Exception as e:
+                error_msg = str(e) if isinstance(e, PythonKernelError) else f"{type(e).__name__}: {str(e)}"
+                self.log.error("python_error", kind="脚本", error=error_msg)
+                return None, error_msg, None
+
+    def log_python_result(self, kind, final_result):
+        """打印Python代码执行结果日志"""
+        self.log.emit("python_result", kind=kind, result=final_result)
 
     # ===================== 辅助方法 =====================
     def get_time_raw(self, time_type):
@@ -728,32 +3976,81 @@ class Agent:
 
     def save_chat_history(self, user_message, ai_response):
         """保存聊天记录"""
-        history_file = "history.hty"
-        with open(history_file, "a", encoding="utf-8") as f:
-            f.write(f"{self.config.user_name}: {user_message}\n")
-            f.write(f"{self.config.ai_name}: {ai_response}\n")
-
-    def load_saved_history(self):
-        """加载已保存的历史记录"""
-        history_file = "history.hty"
-        saved_history = []
-        if os.path.exists(history_file):
-            with open(history_file, "r", encoding="utf-8") as f:
-                lines = f.readlines()
-                for i in range(0, len(lines), 2):
-                    user_message = lines[i].strip()
-                    ai_response = lines[i + 1].strip() if i + 1 < len(lines) else ""
-                    saved_history.append({"role": "user", "content": user_message})
-                    saved_history.append({"role": "assistant", "content": ai_response})
-        return saved_history
+        turn_id = self.history_store.append(self.config.user_name, user_message, self.config.ai_name, ai_response)
+        if self.session_first_history_id is None:
+            self.session_first_history_id = turn_id
+
+    def load_saved_history(self, query=None):
+        """
+        读取本次启动之前保存的历史记录：relevant模式检索与query最相关的若干轮，recent模式读取最近若干轮
+        """
+        if self.config.saved_history_select == "relevant" and query:
+            records = self.history_store.search(
+                query, self.config.saved_history_top_k, max_id=self.session_first_history_id
+            )
+            # 最相关的放在最后：上下文预算不足时优先保留
+            records.reverse()
+        else:
+            records = self.history_store.recent(self.config.saved_history_turns, before=self.started_at)
+        return HistoryStore.to_messages(records)
 
 # ===================== 辅助函数 =====================
 def clear():
-    """清空屏幕"""
-    os.system('cls' if os.name == 'nt' else 'clear')
+    """清空屏幕（类Unix终端直接输出控制序列，不再启动clear进程）"""
+    if os.name == 'nt':
+        os.system('cls')
+    elif sys.stdout.isatty():
+        sys.stdout.write("\033[H\033[2J\033[3J")
+        sys.stdout.flush()
+
+def print_startup_profile(imported_at, initialized_at):
+    """打印启动耗时分析：各阶段耗时，以及python -X importtime统计的导入最慢的模块"""
+    prompt_at = time.perf_counter()
+    print("⏱️  启动耗时分析（从开始导入本模块计时，不含解释器自身启动）：")
+    print(f"   模块导入: {(imported_at - STARTUP_TIME) * 1000:.1f} ms")
+    print(f"   Agent初始化: {(initialized_at - imported_at) * 1000:.1f} ms")
+    print(f"   到达输入提示: {(prompt_at - STARTUP_TIME) * 1000:.1f} ms")
+
+    # 在子进程中重新导入本模块，按累计耗时列出直接导入的模块
+    module_dir, module_file = os.path.split(os.path.abspath(__file__))
+    module_name = os.path.splitext(module_file)[0]
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import sys; sys.path.insert(0, {module_dir!r}); import {module_name}"],
+        capture_output=True,
+        text=True
+    )
+    process_ms = (time.perf_counter() - started) * 1000
+    # importtime先输出被导入的子模块，再输出导入它们的模块
+    imports = []
+    children = []
+    for line in result.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2]
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        if depth == 1:
+            children.append((int(parts[1]), name.strip()))
+        elif depth == 0:
+            if name.strip() == module_name:
+                imports = children
+                print(f"   导入{module_name}（含依赖）: {int(parts[1]) / 1000:.1f} ms，启动新进程并导入共 {process_ms:.1f} ms")
+            children = []
+    print("   导入耗时最多的模块：")
+    for cumulative, name in sorted(imports, reverse=True)[:10]:
+        print(f"     {name:<28} {cumulative / 1000:>7.1f} ms")
+    print("   requests、pydantic等模块在第一次使用时才导入，不计入启动时间")
+    print()
 
 # ===================== 主程序 =====================
 if __name__ == "__main__":
+    imported_at = time.perf_counter()
+    import argparse
+    parser = argparse.ArgumentParser(description="AgentCLI")
+    parser.add_argument("--profile-startup", action="store_true", help="打印启动耗时分析")
+    args = parser.parse_args()
+
     clear()
     # 启动LOGO
     print("""
@@ -767,8 +4064,9 @@ if __name__ == "__main__":
 
     # 初始化Agent（自动校验并修复配置）
     app = Agent()
+    initialized_at = time.perf_counter()
     
-    print("✅ Agent 已启动，输入消息开始对话，输入 ';;exit' 退出。")
+    print("✅ Agent 已启动，输入消息开始对话，输入 ';;exit' 退出，输入 ';;stats' 查看运行指标。")
     print("📚 支持的MCP操作：")
     print("   - 终端命令：system.terminal.run")
     print("   - Python单行命令：python.run.execute (command参数)")
@@ -781,12 +4079,19 @@ if __name__ == "__main__":
     print("   - lite: 仅显示模块执行结果（简洁模式），格式为 [模块名@方法名:函数名] 执行结果: 内容")
     print("   - None: 不显示任何日志")
     print()
+    if args.profile_startup:
+        print_startup_profile(imported_at, initialized_at)
     
     while True:
+        app.log.flush()
         send_message = input(f"{app.config.user_name}: ")
         if send_message.lower() == ';;exit':
+            app.close()
             clear()
             break
+        elif send_message.strip() == ";;stats":
+            print(format_metrics(app.metrics_snapshot()))
+            print()
         elif send_message.strip() == ";;config":
             clear()
             print("""
@@ -905,7 +4210,7 @@ if __name__ == "__main__":
                             "合法值": "True/False"
                         },
                         "save_history": {
-                            "作用": "是否保存聊天记录到history.hty文件",
+                            "作用": "是否保存聊天记录到history.db文件（旧版的history.hty会在首次使用时自动导入）",
                             "类型": "布尔值",
                             "默认值": "False",
                             "合法值": "True/False"
@@ -926,6 +4231,319 @@ if __name__ == "__main__":
   - format: 格式化显示所有日志
   - lite: 仅显示模块执行结果（简洁模式）
   - None: 不显示任何日志"""
+                        },
+                        "http_pool_size": {
+                            "作用": "HTTP连接池大小（长连接复用）",
+                            "类型": "整数",
+                            "默认值": "10"
+                        },
+                        "http_keep_alive": {
+                            "作用": "是否与API服务器保持长连接",
+                            "类型": "布尔值",
+                            "默认值": "True",
+                            "合法值": "True/False"
+                        },
+                        "http_connect_timeout": {
+                            "作用": "建立连接的超时时间（秒）",
+                            "类型": "数字",
+                            "默认值": "10.0"
+                        },
+                        "http_read_timeout": {
+                            "作用": "等待API响应的超时时间（秒）",
+                            "类型": "数字",
+                            "默认值": "300.0",
+                            "说明": "小于等于0表示不限制"
+                        },
+                        "http_gzip_min_bytes": {
+                            "作用": "请求体达到该字节数时使用gzip压缩",
+                            "类型": "整数",
+                            "默认值": "0",
+                            "说明": "0表示不压缩，需API服务器支持Content-Encoding: gzip"
+                        },
+                        "http_warmup": {
+                            "作用": "启动时是否在后台预先建立到api_url的连接",
+                            "类型": "布尔值",
+                            "默认值": "True",
+                            "合法值": "True/False"
+                        },
+                        "stream": {
+                            "作用": "是否使用流式输出（边生成边显示，MCP请求完整后立即执行）",
+                            "类型": "布尔值",
+                            "默认值": "False",
+                            "合法值": "True/False"
+                        },
+                        "tool_workers": {
+                            "作用": "并发执行MCP请求和终端命令的线程数",
+                            "类型": "整数",
+                            "默认值": "4"
+                        },
+                        "tool_sequential": {
+                            "作用": "是否强制按顺序逐个执行MCP请求和终端命令",
+                            "类型": "布尔值",
+                            "默认值": "False",
+                            "合法值": "True/False"
+                        },
+                        "max_agent_steps": {
+                            "作用": "每轮对话最多请求API的次数（包括MCP响应后的后续请求）",
+                            "类型": "整数",
+                            "默认值": "8"
+                        },
+                        "turn_token_budget": {
+                            "作用": "每轮对话最多消耗的token数",
+                            "类型": "整数",
+                            "默认值": "0",
+                            "说明": "0表示不限制，服务端未返回usage时按文本长度估算"
+                        },
+                        "turn_time_budget": {
+                            "作用": "每轮对话最长耗时（秒）",
+                            "类型": "数字",
+                            "默认值": "0.0",
+                            "说明": "0表示不限制"
+                        },
+                        "python_kernel": {
+                            "作用": "是否在独立的持久Python内核进程中执行Python代码",
+                            "类型": "布尔值",
+                            "默认值": "True",
+                            "合法值": "True/False",
+                            "说明": "开启后变量和导入的模块在多次执行之间保留，关闭则在Agent进程内直接执行"
+                        },
+                        "python_preload_modules": {
+                            "作用": "Python内核启动时预先导入的模块",
+                            "类型": "字符串列表",
+                            "默认值": "[]",
+                            "示例": "set python_preload_modules numpy,pandas"
+                        },
+                        "python_timeout": {
+                            "作用": "单次Python代码执行的超时时间（秒），超时后重启内核",
+                            "类型": "数字",
+                            "默认值": "0.0",
+                            "说明": "0表示不限制"
+                        },
+                        "terminal_mode": {
+                            "作用": "终端命令的执行方式",
+                            "类型": "字符串",
+                            "默认值": "session",
+                            "合法值": "session/oneshot",
+                            "说明": """
+  - session: 在持久shell会话中执行，cd、export等设置会保留（Windows下自动使用oneshot）
+  - oneshot: 每条命令启动新的shell进程执行"""
+                        },
+                        "terminal_timeout": {
+                            "作用": "单条终端命令的超时时间（秒）",
+                            "类型": "数字",
+                            "默认值": "0.0",
+                            "说明": "0表示不限制，session模式下超时会重启shell会话"
+                        },
+                        "terminal_output_head": {
+                            "作用": "终端命令输出（stdout/stderr各自）保留开头的字节数",
+                            "类型": "整数",
+                            "默认值": "16384",
+                            "说明": "超出head+tail的部分会被省略，并在MCP响应的truncation中注明"
+                        },
+                        "terminal_output_tail": {
+                            "作用": "终端命令输出（stdout/stderr各自）保留末尾的字节数",
+                            "类型": "整数",
+                            "默认值": "16384"
+                        },
+                        "python_output_head": {
+                            "作用": "Python代码输出保留开头的字节数",
+                            "类型": "整数",
+                            "默认值": "16384"
+                        },
+                        "python_output_tail": {
+                            "作用": "Python代码输出保留末尾的字节数",
+                            "类型": "整数",
+                            "默认值": "16384"
+                        },
+                        "context_token_budget": {
+                            "作用": "每次请求发送的上下文token预算",
+                            "类型": "整数",
+                            "默认值": "32000",
+                            "说明": "按system提示词、当前输入、最近对话、更早对话、已保存历史的优先级填充，0表示不限制"
+                        },
+                        "context_summary_chars": {
+                            "作用": "超出预算的旧对话压缩为摘要时保留的字符数",
+                            "类型": "整数",
+                            "默认值": "200",
+                            "说明": "0表示超出预算的旧对话直接丢弃"
+                        },
+                        "context_tokenizer": {
+                            "作用": "计算token数的方式",
+                            "类型": "字符串",
+                            "默认值": "estimate",
+                            "合法值": "estimate/tiktoken",
+                            "说明": "tiktoken需要额外安装tiktoken库，不可用时自动使用estimate"
+                        },
+                        "saved_history_turns": {
+                            "作用": "开启send_saved_history时最多读取的已保存历史轮数",
+                            "类型": "整数",
+                            "默认值": "50",
+                            "说明": "仅在saved_history_select为recent时使用"
+                        },
+                        "saved_history_select": {
+                            "作用": "开启send_saved_history时如何选择已保存的历史",
+                            "类型": "字符串",
+                            "默认值": "relevant",
+                            "合法值": "relevant/recent",
+                            "说明": """
+  - relevant: 用BM25检索与当前问题最相关的若干轮
+  - recent: 发送最近的若干轮"""
+                        },
+                        "saved_history_top_k": {
+                            "作用": "relevant模式下最多发送的已保存历史轮数",
+                            "类型": "整数",
+                            "默认值": "5"
+                        },
+                        "mcp_cache": {
+                            "作用": "是否缓存幂等MCP方法的结果",
+                            "类型": "布尔值",
+                            "默认值": "True",
+                            "合法值": "True/False",
+                            "说明": "系统信息在整个会话内缓存，时间和Python代码从不缓存，终端命令只缓存只读命令"
+                        },
+                        "mcp_cache_max_bytes": {
+                            "作用": "MCP结果缓存的总大小上限（字节），超出时淘汰最久未使用的结果",
+                            "类型": "整数",
+                            "默认值": "4194304"
+                        },
+                        "mcp_cache_ttl": {
+                            "作用": "只读终端命令结果的缓存时间（秒）",
+                            "类型": "数字",
+                            "默认值": "30.0",
+                            "说明": "执行任何可能修改文件的命令或Python代码后，只读命令的缓存会立即失效"
+                        },
+                        "mcp_cache_readonly_commands": {
+                            "作用": "结果可以缓存的只读终端命令",
+                            "类型": "字符串列表",
+                            "默认值": "ls,cat,head,tail,wc,pwd,grep,find,stat,file,du,df,uname,whoami,hostname,which,echo,tree,dir,type",
+                            "说明": "命令中含有; & | < > ` $ 或换行时不会缓存"
+                        },
+                        "log_file": {
+                            "作用": "日志文件路径，以JSONL格式（每行一条JSON）记录所有日志事件",
+                            "类型": "字符串",
+                            "默认值": "空（不写日志文件）",
+                            "说明": "日志文件不受logger模式影响，总是记录完整的MCP请求/响应和模块执行日志",
+                            "示例": "set log_file agent.log.jsonl"
+                        },
+                        "log_file_max_bytes": {
+                            "作用": "日志文件达到该大小（字节）后轮转",
+                            "类型": "整数",
+                            "默认值": "10485760",
+                            "说明": "0表示不轮转"
+                        },
+                        "log_file_backups": {
+                            "作用": "轮转后保留的旧日志文件个数",
+                            "类型": "整数",
+                            "默认值": "3"
+                        },
+                        "mcp_plugin_dir": {
+                            "作用": "MCP插件模块目录，目录中的每个.py文件（或包）是一个模块",
+                            "类型": "字符串",
+                            "默认值": "mcp_modules",
+                            "说明": "插件通过MCP_MODULE字典声明方法，启动时只读取声明，插件代码在方法第一次被调用时才导入；为空时不加载目录插件",
+                            "示例": "set mcp_plugin_dir my_plugins"
+                        },
+                        "mcp_plugin_entry_points": {
+                            "作用": "是否加载通过agentcli.mcp_modules入口点（entry point）安装的插件包",
+                            "类型": "布尔值",
+                            "默认值": "True",
+                            "合法值": "True/False"
+                        },
+                        "trace_file": {
+                            "作用": "性能追踪文件路径，记录每轮对话中各阶段（组装上下文、HTTP请求、读取回复、MCP请求、命令执行等）的耗时",
+                            "类型": "字符串",
+                            "默认值": "空（不追踪）",
+                            "说明": "文件为Chrome trace事件格式，可以直接在chrome://tracing或ui.perfetto.dev中打开，按线程查看每个阶段的耗时",
+                            "示例": "set trace_file agent.trace.json"
+                        },
+                        "metrics_dump_file": {
+                            "作用": "定时把运行指标（API耗时、各MCP方法耗时、请求/响应大小、token数的分位数和累计值）写入的JSON文件路径",
+                            "类型": "字符串",
+                            "默认值": "空（不写入）",
+                            "说明": "适合长时间运行的进程；对话中输入;;stats可以随时查看同样的指标",
+                            "示例": "set metrics_dump_file metrics.json"
+                        },
+                        "metrics_dump_interval": {
+                            "作用": "写入运行指标文件的间隔（秒）",
+                            "类型": "浮点数",
+                            "默认值": "60.0",
+                            "说明": "<=0时不写入；程序退出时会再写入一次最终的指标"
+                        },
+                        "api_retries": {
+                            "作用": "每个API地址请求失败后的重试次数",
+                            "类型": "整数",
+                            "默认值": "2",
+                            "说明": "连接失败、超时以及408/409/425/429/5xx状态码会重试；重试用完或遇到其他错误时改用下一个备用API"
+                        },
+                        "api_retry_base_delay": {
+                            "作用": "第一次重试前的最长等待时间（秒）",
+                            "类型": "浮点数",
+                            "默认值": "0.5",
+                            "说明": "之后每次重试上限翻倍，实际等待在0到上限之间随机取值，避免多个客户端同时重试；服务端返回Retry-After时按其等待"
+                        },
+                        "api_retry_max_delay": {
+                            "作用": "单次重试等待时间的上限（秒）",
+                            "类型": "浮点数",
+                            "默认值": "20.0",
+                            "说明": "同样限制Retry-After要求的等待时间"
+                        },
+                        "api_fallbacks": {
+                            "作用": "备用API列表，主API失败时按顺序改用",
+                            "类型": "字符串列表",
+                            "默认值": "[]",
+                            "说明": "每项格式为 地址 或 地址|模型 或 地址|模型|密钥，省略的模型和密钥使用model和api_key",
+                            "示例": "set api_fallbacks https://backup.example.com/v1/chat/completions|backup_model,https://other.example.com/v1/chat/completions"
+                        },
+                        "api_hedge_after": {
+                            "作用": "对冲请求：主API超过该秒数仍未响应时，向第一个备用API发送相同请求，采用先返回的结果",
+                            "类型": "浮点数",
+                            "默认值": "0.0（不启用）",
+                            "说明": "需要配置api_fallbacks；可以降低偶发的慢请求造成的长尾延迟，代价是被对冲的请求会重复消耗token"
+                        },
+                        "completion_cache": {
+                            "作用": "模型回复缓存：完全相同的请求（api_url、模型和消息列表都相同）直接使用保存的回复",
+                            "类型": "字符串",
+                            "默认值": "off",
+                            "合法值": "off/on/record/replay",
+                            "说明": "on：命中且未过期时使用缓存；record：总是请求API并记录所有回复；replay：只回放记录的回复，不访问网络，请求不在记录中时报错（见completion_cache_replay_fallback），适合离线测试。对话中输入 ;;nocache <消息> 可以让单条消息跳过缓存",
+                            "示例": "set completion_cache on"
+                        },
+                        "completion_cache_file": {
+                            "作用": "回复缓存文件路径（SQLite数据库）",
+                            "类型": "字符串",
+                            "默认值": "completion_cache.db"
+                        },
+                        "completion_cache_max_bytes": {
+                            "作用": "回复缓存的总大小上限（字节），超出时淘汰最久未使用的回复",
+                            "类型": "整数",
+                            "默认值": "104857600（100MB）",
+                            "说明": "0表示不限制；record模式下不淘汰"
+                        },
+                        "completion_cache_ttl": {
+                            "作用": "缓存回复的有效期（秒）",
+                            "类型": "浮点数",
+                            "默认值": "86400.0（1天）",
+                            "说明": "0表示不过期；record/replay模式下不过期"
+                        },
+                        "completion_cache_replay_fallback": {
+                            "作用": "replay模式下请求不在记录中时，按记录顺序使用下一条回复",
+                            "类型": "布尔值",
+                            "默认值": "False（视为错误，停止本轮对话）",
+                            "说明": "请求内容和记录时略有不同（如工具输出中包含时间）时使用；回放的回复可能对应不同的问题，每次这样回放都会记录警告日志，并计入;;stats中的replay_fallbacks",
+                            "示例": "set completion_cache_replay_fallback True"
+                        },
+                        "history_memory_limit": {
+                            "作用": "本次会话的对话历史在内存中占用的上限（字节）",
+                            "类型": "整数",
+                            "默认值": "67108864（64MB）",
+                            "说明": "超出时从最早的消息开始把内容转存到临时文件，发送历史时再按需读回；相同的内容只保存一份。0表示不限制",
+                            "示例": "set history_memory_limit 16777216"
+                        },
+                        "history_spill_dir": {
+                            "作用": "对话历史转存文件所在的目录",
+                            "类型": "字符串",
+                            "默认值": "空（使用系统临时目录）",
+                            "说明": "转存文件在程序退出时自动删除"
                         }
                     }
                     
@@ -948,9 +4566,9 @@ if __name__ == "__main__":
                         
                         _, key, value = parts
                         # 严格校验配置值合法性
-                        if key == "logger":
-                            # 校验logger取值范围
-                            valid_values = ["all", "format", "lite", "None"]
+                        if key in CHOICE_CONFIG_KEYS:
+                            # 校验取值范围
+                            valid_values = CHOICE_CONFIG_KEYS[key]
                             if value not in valid_values:
                                 print(f"❌ 错误：{key} 只能设置为 {', '.join(valid_values)}")
                                 continue
@@ -958,7 +4576,7 @@ if __name__ == "__main__":
                             setattr(app.config, key, value)
                             app.save_config()
                         
-                        elif key in ["send_history", "save_history", "send_saved_history"]:
+                        elif key in BOOL_CONFIG_KEYS:
                             if value.lower() == "true":
                                 valid_value = True
                             elif value.lower() == "false":
@@ -969,11 +4587,41 @@ if __name__ == "__main__":
                             setattr(app.config, key, valid_value)
                             app.save_config()
                         
-                        elif key in ["api_url", "api_key", "model", "user_name", "ai_name", "prompt_file"]:
+                        elif key in STR_CONFIG_KEYS:
                             # 字符串类型直接保存
                             setattr(app.config, key, value)
                             app.save_config()
                         
+                        elif key in INT_CONFIG_KEYS:
+                            try:
+                                valid_value = int(value)
+                            except ValueError:
+                                print(f"❌ 错误：{key} 必须是非负整数")
+                                continue
+                            if valid_value < 0:
+                                print(f"❌ 错误：{key} 必须是非负整数")
+                                continue
+                            setattr(app.config, key, valid_value)
+                            app.save_config()
+                        
+                        elif key in FLOAT_CONFIG_KEYS:
+                            try:
+                                valid_value = float(value)
+                            except ValueError:
+                                print(f"❌ 错误：{key} 必须是数字")
+                                continue
+                            setattr(app.config, key, valid_value)
+                            app.save_config()
+                        
+                        elif key in LIST_CONFIG_KEYS:
+                            # 列表类型用英文逗号分隔，输入[]表示清空
+                            if value.strip() == "[]":
+                                valid_value = []
+                            else:
+                                valid_value = [item.strip() for item in value.split(",") if item.strip()]
+                            setattr(app.config, key, valid_value)
+                            app.save_config()
+                        
                         else:
                             print(f"❌ 未知的配置项: {key}")
                             print(f"💡 输入 cfghelp 查看所有可用配置项")
@@ -984,10 +4632,14 @@ if __name__ == "__main__":
                     except Exception as e:
                         print(f"❌ 配置更新失败: {str(e)}")
                 elif config_input.lower() == 'exit':
+                    app.close()
                     clear()
                     sys.exit()
                 else:
                     print("❌ 未知命令！输入 help 查看所有可用命令")
+        elif send_message.startswith(";;nocache "):
+            # 本条消息不使用回复缓存
+            app.send_message(send_message[len(";;nocache "):].strip(), use_cache=False)
         else:
             user_message = send_message.strip()
             app.send_message(user_message)
@@ -0,0 +1,282 @@
+"""
+AgentCLI批处理模式：从JSONL文件（或标准输入）读取提示词，并发地跑完整的对话流程，结果逐条写入JSONL
+
+输入每行一个JSON对象：
+  {"id": "q1", "prompt": "..."}                         单条消息
+  {"id": "q2", "prompts": ["...", "..."]}               同一会话中依次发送多条消息
+  {"id": "q3", "prompt": "...", "config": {"model": "..."}}   覆盖该条的配置项
+  {"id": "q4", "prompt": "...", "cache": false}          该条不使用回复缓存（completion_cache）
+  没有id时使用行号（line-N）
+
+输出每行一条结果：id、status（ok/error）、最终回复、每条消息的耗时、MCP调用记录和运行指标；
+每条结果完成后立即写入并刷新，中断后用同样的参数重新运行会跳过已成功的id，从中断处继续
+各对话同时运行，不写配置中的日志、追踪和指标文件，也不保存到交互模式的历史记录库（这些内容都已包含在结果中）
+
+用法：
+  python batch.py prompts.jsonl -o results.jsonl --concurrency 8
+  cat prompts.jsonl | python batch.py - -o results.jsonl
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import agent
+
+
+class BatchAgent(agent.Agent):
+    """记录MCP调用和错误信息的Agent，用于写入批处理结果"""
+
+    def __init__(self, *args, trace_results=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.trace_results = trace_results
+        self.tool_trace = []
+        self.messages = []  # 请求失败等提示信息
+        self.trace_lock = threading.Lock()
+
+    def handle_mcp_request(self, mcp_json):
+        started = time.perf_counter()
+        response = super().handle_mcp_request(mcp_json)
+        entry = {
+            "id": response.id,
+            "module": response.info.get("module"),
+            "method": response.info.get("method"),
+            "params": response.info.get("params"),
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 3),
+            "response_bytes": len(response.serialize())
+        }
+        if response.is_error:
+            entry["error"] = response.error
+        elif self.trace_results:
+            entry["result"] = response.result
+        with self.trace_lock:
+            self.tool_trace.append(entry)
+        return response
+
+    def log_ai_message(self, message):
+        self.messages.append(message)
+        super().log_ai_message(message)
+
+
+class BatchRunner:
+    """
+    批处理执行器
+    :param base_config: 基础配置
+    :param output_file: 结果文件（追加写入），为None时写到标准输出
+    :param concurrency: 同时进行的对话数
+    :param trace_results: 结果中是否包含每个MCP调用的完整返回值
+    """
+
+    def __init__(self, base_config, output_file, concurrency=4, trace_results=False):
+        self.base_config = base_config
+        self.concurrency = max(1, concurrency)
+        self.trace_results = trace_results
+        self.output_file = output_file
+        self.output = None
+        self.write_lock = threading.Lock()
+        self.counts = {"ok": 0, "error": 0, "skipped": 0}
+        # 所有对话共用连接池和工具线程池；每个对话有独立的历史、Python内核和shell会话
+        self.http_session, self.tool_executors = agent.Agent.create_shared_pools(
+            base_config, self.concurrency, self.concurrency * max(1, base_config.tool_workers)
+        )
+        self.devnull = open(os.devnull, "w", encoding="utf-8")
+
+    def completed_ids(self):
+        """已有结果文件中成功完成的id（出错的会重新执行）"""
+        done = set()
+        if self.output_file is None or not os.path.exists(self.output_file):
+            return done
+        with open(self.output_file, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 上次中断时写了一半的行
+                    continue
+                if isinstance(record, dict) and record.get("status") == "ok":
+                    done.add(str(record.get("id")))
+        return done
+
+    def open_output(self):
+        if self.output_file is None:
+            return sys.stdout
+        # 上次中断时最后一行可能没有写完，补一个换行避免和新结果连在一起
+        needs_newline = False
+        if os.path.exists(self.output_file) and os.path.getsize(self.output_file) > 0:
+            with open(self.output_file, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b"\n"
+        output = open(self.output_file, "a", encoding="utf-8")
+        if needs_newline:
+            output.write("\n")
+        return output
+
+    def write_result(self, record):
+        line = agent.dumps_json(record)
+        with self.write_lock:
+            self.output.write(line + "\n")
+            self.output.flush()
+            self.counts[record["status"]] += 1
+
+    def run_item(self, item_id, item):
+        """在当前线程中执行一个输入项，返回结果记录"""
+        record = {"id": item_id, "status": "error"}
+        started = time.perf_counter()
+        prompts = item.get("prompts", [item.get("prompt")])
+        if not isinstance(prompts, list) or not prompts or not all(isinstance(p, str) and p for p in prompts):
+            record["error"] = "缺少prompt（非空字符串）或prompts（非空字符串列表）"
+            return record
+
+        values = self.base_config.model_dump()
+        for key, value in (item.get("config") or {}).items():
+            value, error_reason = agent.Config.validate_item(key, value)
+            if error_reason:
+                record["error"] = f"配置项 {key} 不合法: {error_reason}"
+                return record
+            values[key] = value
+        # 批处理不向控制台输出日志，也不预热连接（连接池由所有对话共用）；
+        # 各对话同时运行，不写日志、追踪和指标文件（否则会互相覆盖同一个文件），
+        # 也不保存到交互模式的历史记录库，对话内容和运行指标都已记录在结果中
+        values.update(logger="None", http_warmup=False, log_file="", trace_file="", metrics_dump_file="",
+                      save_history=False)
+
+        app = BatchAgent(
+            config=agent.Config(**values),
+            output=self.devnull,
+            http_session=self.http_session,
+            tool_executors=self.tool_executors,
+            trace_results=self.trace_results
+        )
+        use_cache = item.get("cache", True) is not False
+        try:
+            replies = []
+            turns = []
+            for prompt in prompts:
+                turn_started = time.perf_counter()
+                reply = app.send_message(prompt, use_cache=use_cache)
+                turns.append(round(time.perf_counter() - turn_started, 3))
+                replies.append(reply)
+                if reply is None:
+                    record["error"] = app.last_stop_reason or (app.messages[-1] if app.messages else "没有得到最终回复")
+                    break
+            else:
+                record["status"] = "ok"
+            record["reply"] = replies[-1]
+            if len(prompts) > 1:
+                record["replies"] = replies
+            record["turn_seconds"] = turns
+            record["tools"] = app.tool_trace
+            snapshot = app.metrics.snapshot()
+            record["metrics"] = {"counters": snapshot["counters"], "histograms": snapshot["histograms"]}
+        except Exception as e:
+            record["error"] = f"{type(e).__name__}: {e}"
+        finally:
+            app.close()
+            record["elapsed_seconds"] = round(time.perf_counter() - started, 3)
+        return record
+
+    def read_items(self, lines):
+        """逐行解析输入，返回(id, 输入项或None, 解析错误)"""
+        for line_number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+                if not isinstance(item, dict):
+                    raise ValueError("每行必须是JSON对象")
+            except ValueError as e:
+                yield f"line-{line_number}", None, f"输入不是合法的JSON对象: {e}"
+                continue
+            yield str(item.get("id", f"line-{line_number}")), item, None
+
+    def run(self, lines):
+        """
+        执行所有输入项：输入按需读取，同时只保留有限个待执行的项，输入文件再大也不会全部读入内存
+        """
+        done_ids = self.completed_ids()
+        self.output = self.open_output()
+        started = time.perf_counter()
+        executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="batch")
+        running = set()
+        try:
+            for item_id, item, error in self.read_items(lines):
+                if item_id in done_ids:
+                    self.counts["skipped"] += 1
+                    continue
+                if item is None:
+                    self.write_result({"id": item_id, "status": "error", "error": error})
+                    continue
+                if len(running) >= self.concurrency * 2:
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        self.write_result(future.result())
+                        running.discard(future)
+                running.add(executor.submit(self.run_item, item_id, item))
+            self.drain(running)
+        except KeyboardInterrupt:
+            print("\n⏹️  已中断：不再开始新的对话，等待正在进行的对话结束…", file=sys.stderr)
+            raise
+        finally:
+            # 中断时不再启动新的对话，等正在进行的对话结束并写入结果后再释放共用的连接池和线程池；
+            # 已写入的结果在下次运行时跳过
+            executor.shutdown(wait=False, cancel_futures=True)
+            try:
+                self.drain(running)
+            finally:
+                self.close()
+        return time.perf_counter() - started
+
+    def drain(self, running):
+        """等待并写入所有未取消的对话的结果，写入后从running中移除"""
+        for future in list(running):
+            if not future.cancelled():
+                self.write_result(future.result())
+            running.discard(future)
+
+    def close(self):
+        for executor in self.tool_executors:
+            executor.shutdown(wait=False)
+        self.http_session.close()
+        self.devnull.close()
+        if self.output is not None and self.output is not sys.stdout:
+            self.output.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AgentCLI批处理模式")
+    parser.add_argument("input", help="输入JSONL文件，-表示从标准输入读取")
+    parser.add_argument("-o", "--output", help="结果JSONL文件（追加写入，重新运行时跳过已成功的id），默认输出到标准输出")
+    parser.add_argument("--config", default="config.json", help="基础配置文件")
+    parser.add_argument("--concurrency", type=int, default=4, help="同时进行的对话数（默认4）")
+    parser.add_argument("--trace-results", action="store_true", help="结果中包含每个MCP调用的完整返回值")
+    parser.add_argument("--restart", action="store_true", help="清空已有的结果文件，从头开始")
+    args = parser.parse_args()
+
+    base_config, config_errors = agent.Config.load_and_validate(args.config)
+    for error in config_errors:
+        print(f"⚠️  {error.get('message') or error.get('item')}: {error.get('error_reason', error.get('action', ''))}",
+              file=sys.stderr)
+    if args.restart and args.output and os.path.exists(args.output):
+        os.remove(args.output)
+
+    runner = BatchRunner(base_config, args.output, args.concurrency, args.trace_results)
+    input_stream = sys.stdin if args.input == "-" else open(args.input, "r", encoding="utf-8")
+    try:
+        elapsed = runner.run(input_stream)
+    except KeyboardInterrupt:
+        print("⏹️  正在进行的对话已结束，结果已写入，重新运行即可继续", file=sys.stderr)
+        return 130
+    finally:
+        if input_stream is not sys.stdin:
+            input_stream.close()
+    counts = runner.counts
+    print(f"✅ 完成 {counts['ok']} 条，失败 {counts['error']} 条，跳过已完成 {counts['skipped']} 条，"
+          f"用时 {elapsed:.1f} 秒", file=sys.stderr)
+    return 1 if counts["error"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
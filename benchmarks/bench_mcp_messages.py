@@ -0,0 +1,83 @@
+"""
+MCP消息序列化的微基准：对比旧的字符串流程和McpResponse对象流程在大工具输出下的CPU时间和内存分配
+
+旧流程：构建响应时序列化 -> 日志再解析并序列化一次 -> 拼接为下一次请求的输入
+新流程：构建McpResponse对象 -> 日志复用序列化结果 -> 拼接时序列化一次
+
+用法：python benchmarks/bench_mcp_messages.py [--sizes 10000,1000000] [--repeat 20]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import agent  # noqa: E402
+
+
+def make_result(size):
+    """模拟终端命令的大输出（混合中英文和换行，需要转义）"""
+    line = "drwxr-xr-x  2 user user 4096 文件名_example.txt\n"
+    return {"c1": (line * (size // len(line) + 1))[:size]}
+
+
+def legacy_pipeline(info, result):
+    # 旧实现：build_success_response生成字符串，日志（all模式）再json.loads/json.dumps一次
+    response = {"mcp": "response", "id": "1", "info": info, "result": result}
+    text = f";;{json.dumps(response, ensure_ascii=False, separators=(',', ':'))};;"
+    log_line = json.dumps(json.loads(text[2:-2]), ensure_ascii=False, separators=(',', ':'))
+    return "\n".join([text]), log_line
+
+
+def object_pipeline(info, result):
+    response = agent.McpResponse.success("1", info, result)
+    text = "\n".join([response.serialize()])
+    log_line = response.serialize()[2:-2]
+    return text, log_line
+
+
+def measure(pipeline, info, result, repeat):
+    """返回 (每次平均毫秒, 单次执行的内存分配峰值字节)"""
+    pipeline(info, result)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        pipeline(info, result)
+    elapsed = (time.perf_counter() - start) / repeat * 1000
+    tracemalloc.start()
+    pipeline(info, result)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MCP消息序列化微基准")
+    parser.add_argument("--sizes", default="10000,1000000,8000000", help="工具输出大小（字符），逗号分隔")
+    parser.add_argument("--repeat", type=int, default=20, help="每种情况重复次数")
+    args = parser.parse_args()
+
+    backends = [("json", None)]
+    if agent.orjson is not None:
+        backends.append(("orjson", agent.orjson))
+    info = {"module": "system", "method": "terminal.run", "params": {"c1": "ls -la /"}}
+
+    print(f"{'输出大小':>10} {'流程':<16} {'耗时(ms)':>10} {'分配峰值(KB)':>14}")
+    for size in (int(value) for value in args.sizes.split(",")):
+        result = make_result(size)
+        rows = [("legacy", legacy_pipeline, None)]
+        rows += [(f"object+{name}", object_pipeline, backend) for name, backend in backends]
+        for name, pipeline, backend in rows:
+            agent.orjson = backend
+            elapsed, peak = measure(pipeline, info, result, args.repeat)
+            print(f"{size:>10} {name:<16} {elapsed:>10.2f} {peak / 1024:>14.1f}")
+            # 确认两种流程生成的请求内容和日志内容都一致，不一致时断言失败
+            text, log_line = pipeline(info, result)
+            legacy_text, legacy_log_line = legacy_pipeline(info, result)
+            assert json.loads(text[2:-2]) == json.loads(legacy_text[2:-2]), f"{name}：请求内容与旧流程不一致"
+            assert json.loads(log_line) == json.loads(legacy_log_line), f"{name}：日志内容与旧流程不一致"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""
+MCP请求块扫描器的模糊测试和吞吐量基准
+
+模糊测试：随机生成包含MCP块的回复（字符串中带"};;"、转义引号、嵌套括号，以及不完整的块、零散的分号和
+带有不成对引号、会把后面真正的块吞进去的错误写法），
+检查扫描器找出的块与生成时的期望、参考解析器（在每个";;{"处用json.JSONDecoder.raw_decode解析）一致，
+任意分段喂入与整段喂入的结果相同，以及流式渲染器输出的文本等于去掉所有块之后的回复；不一致时断言失败
+吞吐量：数MB的回复分别整段和按16字符分段扫描，与旧的非贪婪正则对比；
+另有一组包含大量未闭合";;{"的输入，旧正则在这种输入上的耗时随长度平方增长
+
+用法：python benchmarks/bench_mcp_scanner.py [--cases 2000] [--sizes 1000000,8000000] [--seed 1]
+"""
+import argparse
+import io
+import json
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import agent  # noqa: E402
+
+LEGACY_PATTERN = re.compile(r";;({.*?});;", re.DOTALL)
+JSON_DECODER = json.JSONDecoder()
+
+TRICKY_STRINGS = ["};;", ";;{", "}}", "{[", "\\", "\"", ";", "\\\"};;", "中文", "\n", "print('};;')"]
+PLAIN_WORDS = ["普通文本", "hello", " ", "\n", "{", "}", ";", "a;b", "{x}", "；"]
+# 不是JSON的";;{"开头：其中不成对的引号会一直延续到后面真正的块里
+MALFORMED_PREFIXES = [';;{ "oops ', ';;{"', ';;{"a": "', ';;{"x\\"', ';;{"a": 1, "b']
+
+
+def reference_find_all(text):
+    """参考解析器：从左到右在每个";;{"处尝试解析一个完整的JSON对象，后面紧跟";;"时即为一个块（速度慢，但结果容易验证）"""
+    blocks = []
+    position = 0
+    while True:
+        start = text.find(";;{", position)
+        if start == -1:
+            return blocks
+        try:
+            _, end = JSON_DECODER.raw_decode(text, start + 2)
+        except ValueError:
+            end = None
+        if end is not None and text.startswith(";;", end):
+            blocks.append(text[start + 2:end])
+            position = end + 2
+        else:
+            position = start + 1
+
+
+def random_string(rng):
+    return "".join(rng.choice(TRICKY_STRINGS + ["abc", "x y"]) for _ in range(rng.randint(0, 6)))
+
+
+def random_value(rng, depth=0):
+    kind = rng.randint(0, 5 if depth < 3 else 2)
+    if kind == 0:
+        return random_string(rng)
+    if kind == 1:
+        return rng.randint(-1000, 1000)
+    if kind == 2:
+        return rng.choice([True, False, None, 1.5])
+    if kind == 3:
+        return [random_value(rng, depth + 1) for _ in range(rng.randint(0, 3))]
+    return {random_string(rng): random_value(rng, depth + 1) for _ in range(rng.randint(0, 3))}
+
+
+def random_block(rng):
+    request = {"mcp": "request", "id": str(rng.randint(1, 99)), "module": "python", "method": "run.execute",
+               "params": {"command": random_string(rng), "extra": random_value(rng)}}
+    return json.dumps(request, ensure_ascii=rng.random() < 0.5, indent=rng.choice([None, 2]))
+
+
+def random_plain(rng):
+    """不会自己或和前后的块组成MCP块的普通文本（不含";;"，开头不是";"或"{"，结尾不是";"）"""
+    text = "".join(rng.choice(PLAIN_WORDS) for _ in range(rng.randint(0, 8))).replace(";;", "; ")
+    if text.startswith((";", "{")):
+        text = "x" + text
+    return text.rstrip(";")
+
+
+def random_reply(rng, malformed=True):
+    """
+    :param malformed: 是否在块前面插入不是JSON的";;{"开头
+    :return: (回复文本, 期望的块JSON列表, 去掉块之后的文本)
+    """
+    pieces = []
+    blocks = []
+    visible = []
+    for _ in range(rng.randint(0, 6)):
+        plain = random_plain(rng)
+        pieces.append(plain)
+        visible.append(plain)
+        if malformed and rng.random() < 0.2:
+            prefix = rng.choice(MALFORMED_PREFIXES) + random_plain(rng)
+            pieces.append(prefix)
+            visible.append(prefix)
+        if rng.random() < 0.7:
+            block = random_block(rng)
+            pieces.append(f";;{block};;")
+            blocks.append(block)
+    if rng.random() < 0.3:
+        # 结尾是一个不完整的块，按普通文本处理
+        tail = ";;" + random_block(rng)[:rng.randint(1, 20)]
+        tail = tail.rstrip(";")
+        if tail.count("{") and ";" not in tail[2:]:
+            pieces.append(tail)
+            visible.append(tail)
+    return "".join(pieces), blocks, "".join(visible)
+
+
+def random_chunks(rng, text):
+    chunks = []
+    position = 0
+    while position < len(text):
+        size = rng.choice([1, 1, 2, 3, 5, 16, 64])
+        chunks.append(text[position:position + size])
+        position += size
+    return chunks
+
+
+def scan_chunks(chunks):
+    scanner = agent.McpScanner()
+    found = []
+    for chunk in chunks:
+        found.extend(scanner.feed(chunk))
+    found.extend(scanner.finish())
+    return found
+
+
+def render(chunks):
+    output = io.StringIO()
+    renderer = agent.StreamRenderer("AI", output=output)
+    renderer.started = True  # 不输出名字前缀，也不去掉开头的空白
+    for chunk in chunks:
+        renderer.feed(chunk)
+    renderer.finish()
+    return output.getvalue()[:-1], renderer.text
+
+
+def fuzz(cases, seed):
+    rng = random.Random(seed)
+    legacy_mismatches = 0
+    for case in range(cases):
+        text, blocks, visible = random_reply(rng)
+        found = agent.McpScanner.find_all(text)
+        assert found == blocks, f"第{case}个用例的块不一致:\n{text!r}\n{found!r}\n{blocks!r}"
+        assert found == reference_find_all(text), f"第{case}个用例与参考解析器不一致:\n{text!r}"
+        for block in found:
+            json.loads(block)
+        chunks = random_chunks(rng, text)
+        assert scan_chunks(chunks) == scan_chunks([text]), f"第{case}个用例分段结果不一致:\n{chunks!r}"
+        rendered, joined = render(chunks)
+        assert joined == text
+        assert rendered == visible, f"第{case}个用例渲染结果不一致:\n{text!r}\n{rendered!r}\n{visible!r}"
+        if LEGACY_PATTERN.findall(text) != blocks:
+            legacy_mismatches += 1
+    print(f"模糊测试：{cases}个用例全部通过（旧正则在其中{legacy_mismatches}个用例中找错了块）")
+
+
+def make_large_reply(size):
+    """由大段普通文本和包含长脚本的MCP块组成的回复"""
+    script = "for i in range(10):\n    print(\"};; {\", i)  # 注释;;\n" * 40
+    block = ";;" + json.dumps({"mcp": "request", "id": "1", "module": "python", "method": "run.script",
+                               "params": {"script": script}}, ensure_ascii=False) + ";;"
+    paragraph = "这是一段很长的说明文字，其中有分号; 大括号{和} 以及代码 x = {'a': 1};\n" * 50
+    unit = paragraph + block
+    return (unit * (size // len(unit) + 1))[:size]
+
+
+def make_unclosed_reply(size):
+    """大量没有闭合的";;{"：旧正则从每一处开始都要扫描到文本末尾，耗时随长度平方增长"""
+    unit = "示例写法 ;;{ 这里省略\n"
+    return (unit * (size // len(unit) + 1))[:size]
+
+
+def throughput(inputs, repeat):
+    print(f"\n{'输入':<8} {'回复大小':>10} {'方式':<16} {'耗时(ms)':>10} {'吞吐(MB/s)':>11} {'块数':>6}")
+    for kind, size, text in inputs:
+        chunks = [text[i:i + 16] for i in range(0, len(text), 16)]
+        # 吞吐量测试的输入同样要求结果正确
+        found = agent.McpScanner.find_all(text)
+        assert found == reference_find_all(text), f"{kind} {size}：与参考解析器不一致"
+        assert [block for _, _, block in scan_chunks(chunks)] == found, f"{kind} {size}：分段结果不一致"
+        rows = [
+            ("legacy regex", lambda: LEGACY_PATTERN.findall(text)),
+            ("scanner", lambda: agent.McpScanner.find_all(text)),
+            ("scanner 16字符", lambda: scan_chunks(chunks)),
+        ]
+        for name, run in rows:
+            count = len(run())
+            started = time.perf_counter()
+            for _ in range(repeat):
+                run()
+            elapsed = (time.perf_counter() - started) / repeat
+            megabytes = len(text.encode("utf-8")) / 1024 / 1024
+            print(f"{kind:<8} {size:>10} {name:<16} {elapsed * 1000:>10.2f} {megabytes / elapsed:>11.1f} {count:>6}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MCP请求块扫描器的模糊测试和吞吐量基准")
+    parser.add_argument("--cases", type=int, default=2000, help="模糊测试用例数")
+    parser.add_argument("--seed", type=int, default=1, help="随机种子")
+    parser.add_argument("--sizes", default="1000000,8000000", help="吞吐量测试的回复大小（字符），逗号分隔")
+    parser.add_argument("--unclosed-sizes", default="20000,100000", help="未闭合块输入的大小（字符），逗号分隔")
+    parser.add_argument("--repeat", type=int, default=3, help="每种情况重复次数")
+    args = parser.parse_args()
+
+    fuzz(args.cases, args.seed)
+    inputs = [("normal", size, make_large_reply(size)) for size in map(int, args.sizes.split(","))]
+    inputs += [("unclosed", size, make_unclosed_reply(size)) for size in map(int, args.unclosed_sizes.split(","))]
+    throughput(inputs, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
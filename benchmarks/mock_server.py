@@ -0,0 +1,134 @@
+"""
+本地的模拟chat completions服务（兼容OpenAI格式），用于离线基准测试
+
+回复由responder函数按请求内容生成，可以配置首字节延迟、流式输出的分块大小和每块之间的间隔；
+服务端记录每个请求的处理耗时，基准测试用它把模型耗时从单轮总耗时中扣除
+"""
+import gzip
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockChatHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # 响应头和响应体分两次写出，不关闭Nagle算法时会和客户端的延迟ACK叠加出约40ms的等待
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        # 预热连接使用HEAD请求
+        self.send_response(405)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        started = time.perf_counter()
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        request = json.loads(body)
+        server = self.server
+        reply = server.responder(request)
+        if server.delay > 0:
+            time.sleep(server.delay)
+        if request.get("stream"):
+            self.send_stream(reply, server.chunk_size, server.chunk_delay)
+        else:
+            self.send_json({
+                "choices": [{"message": {"role": "assistant", "content": reply}}],
+                "usage": {"prompt_tokens": len(body) // 4, "completion_tokens": len(reply) // 4,
+                          "total_tokens": (len(body) + len(reply)) // 4}
+            })
+        server.record(time.perf_counter() - started, len(body))
+
+    def send_json(self, data):
+        out = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def send_stream(self, reply, chunk_size, chunk_delay):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def write_chunk(data):
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+        for start in range(0, len(reply), chunk_size):
+            event = {"choices": [{"delta": {"content": reply[start:start + chunk_size]}}]}
+            write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+            if chunk_delay > 0:
+                self.wfile.flush()
+                time.sleep(chunk_delay)
+        write_chunk(b"data: [DONE]\n\n")
+        write_chunk(b"")
+        self.wfile.flush()
+
+
+class MockChatServer(ThreadingHTTPServer):
+    """
+    模拟服务
+    :param responder: 接收请求JSON，返回回复文本的函数
+    :param delay: 每个请求的首字节延迟（秒），模拟模型耗时
+    :param chunk_size: 流式输出每块的字符数
+    :param chunk_delay: 流式输出每块之间的间隔（秒）
+    """
+
+    daemon_threads = True
+
+    def __init__(self, responder, delay=0.0, chunk_size=16, chunk_delay=0.0, port=0):
+        super().__init__(("127.0.0.1", port), MockChatHandler)
+        self.responder = responder
+        self.delay = delay
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.lock = threading.Lock()
+        self.requests = []  # [(服务端耗时, 请求体字节数), ...]
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1/chat/completions"
+
+    def record(self, seconds, body_bytes):
+        with self.lock:
+            self.requests.append((seconds, body_bytes))
+
+    def server_seconds(self, since=0):
+        """从第since个请求开始的服务端总耗时"""
+        with self.lock:
+            return sum(seconds for seconds, _ in self.requests[since:])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name="mock-chat-server", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == "__main__":
+    # 单独运行时启动一个固定回复的服务，便于手动调试
+    import argparse
+
+    parser = argparse.ArgumentParser(description="模拟chat completions服务")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--reply", default="这是模拟服务的回复")
+    parser.add_argument("--delay", type=float, default=0.0)
+    args = parser.parse_args()
+    server = MockChatServer(lambda request: args.reply, delay=args.delay, port=args.port)
+    print(f"模拟服务已启动: {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,275 @@
+"""
+离线基准测试：用本地模拟服务代替模型，测量Agent自身的开销
+
+场景：
+  plain_chat     普通对话（无工具调用）
+  stream_chat    流式输出的普通对话
+  multi_tool     每轮回复包含多个MCP请求（终端、Python、时间、系统信息），再给出最终回复
+  huge_output    工具输出达到数MB（验证输出截断后的开销）
+  long_history   携带很长的对话历史（验证上下文组装的开销）
+  dispatch       MCP请求分发吞吐量（不经过模型）
+
+每个场景在独立的子进程中运行，报告单轮开销（总耗时减去模拟服务的耗时）的p50/p95、
+分发吞吐量和内存峰值；--save-baseline保存结果，--compare与保存的结果对比并标出退化的指标
+
+用法：
+  python benchmarks/run_benchmarks.py
+  python benchmarks/run_benchmarks.py --scenarios plain_chat,multi_tool --save-baseline benchmarks/baseline.json
+  python benchmarks/run_benchmarks.py --compare benchmarks/baseline.json
+"""
+import argparse
+import contextlib
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from mock_server import MockChatServer  # noqa: E402
+
+SCENARIOS = ["plain_chat", "stream_chat", "multi_tool", "huge_output", "long_history", "dispatch"]
+
+# 对比基准时，这些指标越大越差；吞吐量越小越差
+LOWER_IS_BETTER = ["p50_ms", "p95_ms", "peak_rss_mb"]
+HIGHER_IS_BETTER = ["requests_per_second"]
+
+
+def mcp_request(request_id, module, method, params):
+    request = {"mcp": "request", "id": request_id, "module": module, "method": method, "params": params}
+    return f";;{json.dumps(request, ensure_ascii=False)};;"
+
+
+def last_message(request):
+    return request["messages"][-1]["content"]
+
+
+def plain_responder(size):
+    reply = ("这是一段模拟的回复内容。" * (size // 12 + 1))[:size]
+    return lambda request: reply
+
+
+def tool_responder(tool_calls, final_size=200):
+    """用户消息先得到一批MCP请求，收到MCP响应后给出最终回复"""
+    final_reply = plain_responder(final_size)(None)
+
+    def respond(request):
+        if last_message(request).startswith(";;{"):
+            return final_reply
+        return "需要先调用工具：" + " ".join(tool_calls)
+    return respond
+
+
+def multi_tool_calls():
+    calls = [
+        mcp_request("1", "system", "time.get", {"type": "datetime"}),
+        mcp_request("2", "system", "info.get", {}),
+        mcp_request("3", "python", "run.execute", {"command": "sum(range(1000))"}),
+    ]
+    if os.name == "posix":
+        calls.append(mcp_request("4", "system", "terminal.run", {"c1": "echo hello", "c2": "pwd"}))
+    return calls
+
+
+def huge_output_calls(size):
+    calls = [mcp_request("1", "python", "run.execute", {"command": f"print('x' * {size})"})]
+    if os.name == "posix":
+        calls.append(mcp_request("2", "system", "terminal.run", {"c1": f"head -c {size} /dev/zero | tr '\\0' y"}))
+    return calls
+
+
+def percentile(values, fraction):
+    """最近秩法的分位数（与Histogram.percentile相同）：20个值的p95是第19个"""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+def peak_rss_mb():
+    """本进程和已结束子进程（Python内核等）中最大的内存峰值，Windows上返回None"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Linux上单位是KB，macOS上是字节
+    return round(peak / (1024 * 1024 if platform.system() == "Darwin" else 1024), 1)
+
+
+def make_agent(agent_module, server, **overrides):
+    config = agent_module.Config(
+        api_url=server.url,
+        api_key="benchmark",
+        logger="None",
+        http_warmup=False,
+        save_history=False,
+        send_saved_history=False,
+        mcp_cache=False,
+        **overrides
+    )
+    return agent_module.Agent(config=config)
+
+
+def run_turns(app, server, turns, message="你好，请介绍一下你自己"):
+    """逐轮调用send_message，返回每轮的Agent开销（毫秒，已扣除模拟服务耗时）"""
+    overheads = []
+    with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(turns):
+            since = len(server.requests)
+            started = time.perf_counter()
+            app.send_message(message)
+            elapsed = time.perf_counter() - started
+            overheads.append((elapsed - server.server_seconds(since)) * 1000)
+    return overheads
+
+
+def run_scenario(name, turns, delay):
+    """在当前进程中运行一个场景，返回结果字典"""
+    import agent
+
+    result = {"scenario": name}
+    if name == "dispatch":
+        server = MockChatServer(plain_responder(10)).start()
+        app = make_agent(agent, server, python_kernel=True)
+        pending = [({"mcp": "request", "id": str(i), "module": "system",
+                     "method": "time.get" if i % 2 else "info.get", "params": {}}, None) for i in range(200)]
+        app.execute_mcp_requests(pending)  # 预热线程池
+        rounds = max(1, turns)
+        started = time.perf_counter()
+        for _ in range(rounds):
+            app.execute_mcp_requests(pending)
+        elapsed = time.perf_counter() - started
+        result["requests_per_second"] = round(len(pending) * rounds / elapsed, 1)
+    else:
+        overrides = {}
+        if name == "plain_chat":
+            responder = plain_responder(400)
+        elif name == "stream_chat":
+            responder = plain_responder(2000)
+            overrides["stream"] = True
+        elif name == "multi_tool":
+            responder = tool_responder(multi_tool_calls())
+        elif name == "huge_output":
+            responder = tool_responder(huge_output_calls(5_000_000))
+        elif name == "long_history":
+            responder = plain_responder(400)
+            overrides["send_history"] = True
+        else:
+            raise ValueError(f"未知场景: {name}")
+        server = MockChatServer(responder, delay=delay).start()
+        app = make_agent(agent, server, **overrides)
+        if name == "long_history":
+            # 预先放入500轮、每条约2KB的历史对话
+            for index in range(500):
+                app.chat_history.append({"role": "user", "content": f"第{index}个问题：" + "问题内容" * 250})
+                app.chat_history.append({"role": "assistant", "content": f"第{index}个回答：" + "回答内容" * 250})
+        run_turns(app, server, 1)  # 预热：建立连接、启动Python内核和shell会话
+        overheads = run_turns(app, server, turns)
+        result.update({
+            "turns": turns,
+            "p50_ms": round(percentile(overheads, 0.5), 2),
+            "p95_ms": round(percentile(overheads, 0.95), 2),
+            "mean_ms": round(sum(overheads) / len(overheads), 2),
+            "api_requests": len(server.requests)
+        })
+    app.close()
+    server.stop()
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def run_in_subprocess(name, turns, delay):
+    """每个场景在独立的子进程和临时目录中运行，互不影响内存峰值和配置文件"""
+    with tempfile.TemporaryDirectory(prefix="agent-bench-") as work_dir:
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", name, "--turns", str(turns), "--delay", str(delay)],
+            cwd=work_dir,
+            capture_output=True,
+            text=True
+        )
+    if completed.returncode != 0:
+        return {"scenario": name, "error": completed.stderr.strip().splitlines()[-1:] or ["未知错误"]}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def compare(results, baseline, threshold):
+    """与基准对比，返回退化的指标列表"""
+    regressions = []
+    baseline_by_name = {item["scenario"]: item for item in baseline.get("results", [])}
+    for result in results:
+        old = baseline_by_name.get(result["scenario"])
+        if not old:
+            continue
+        for key in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+            if not old.get(key) or result.get(key) is None:
+                continue
+            change = (result[key] - old[key]) / old[key]
+            worse = change > threshold if key in LOWER_IS_BETTER else change < -threshold
+            marker = "  ⚠️ 退化" if worse else ""
+            print(f"   {result['scenario']:<14} {key:<20} {old[key]:>10} -> {result[key]:>10} ({change:+.1%}){marker}")
+            if worse:
+                regressions.append((result["scenario"], key))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AgentCLI离线基准测试")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="要运行的场景，逗号分隔")
+    parser.add_argument("--turns", type=int, default=20, help="每个场景的对话轮数（dispatch场景为分发轮数）")
+    parser.add_argument("--delay", type=float, default=0.0, help="模拟模型的首字节延迟（秒）")
+    parser.add_argument("--save-baseline", metavar="PATH", help="把结果保存为基准文件")
+    parser.add_argument("--compare", metavar="PATH", help="与基准文件对比")
+    parser.add_argument("--threshold", type=float, default=0.2, help="超过该比例的变化视为退化（默认0.2）")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_scenario(args.child, args.turns, args.delay), ensure_ascii=False))
+        return 0
+
+    results = []
+    print(f"{'场景':<14} {'p50(ms)':>9} {'p95(ms)':>9} {'吞吐(次/秒)':>12} {'内存峰值(MB)':>13}")
+    for name in args.scenarios.split(","):
+        result = run_in_subprocess(name.strip(), args.turns, args.delay)
+        results.append(result)
+        if "error" in result:
+            print(f"{result['scenario']:<14} 运行失败: {result['error'][0]}")
+            continue
+        print(f"{result['scenario']:<14} {result.get('p50_ms', '-'):>9} {result.get('p95_ms', '-'):>9} "
+              f"{result.get('requests_per_second', '-'):>12} {result.get('peak_rss_mb') or '-':>13}")
+
+    report = {
+        "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "turns": args.turns,
+        "delay": args.delay,
+        "results": results
+    }
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"\n基准已保存到 {args.save_baseline}")
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"\n与基准（{baseline.get('created_at', '未知时间')}）对比：")
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n❌ {len(regressions)}项指标退化超过{args.threshold:.0%}")
+            return 1
+        print("\n✅ 没有超过阈值的退化")
+    return 1 if any("error" in result for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
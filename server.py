@@ -0,0 +1,583 @@
+"""
+AgentCLI服务模式：在一个进程中通过HTTP/WebSocket同时服务多个会话
+
+每个会话拥有独立的Agent（对话历史、Python内核、shell会话和配置覆盖项），所有会话共用一个HTTP连接池和
+一组有界的工具线程池。config.json中的log_file、trace_file和metrics_dump_file由服务统一写入：
+所有会话共用一个日志和追踪文件，指标文件中是服务状态和各会话的指标快照。事件循环只负责收发数据，每轮对话在有界的对话线程池中执行，不会阻塞其他会话；
+同一会话的消息按顺序执行，排队的消息数和全局排队的对话数都有上限，超出时返回429/503
+
+接口：
+  GET    /health                        服务状态
+  POST   /sessions                      创建会话，请求体：{"config": {配置覆盖项}}
+  GET    /sessions                      会话列表
+  DELETE /sessions/<id>                 关闭会话
+  POST   /sessions/<id>/messages        发送消息并等待回复，请求体：{"message": "...", "cache": 是否使用回复缓存（可选）}
+  GET    /sessions/<id>/history         会话的对话历史
+  GET    /sessions/<id>/stats           会话的运行指标
+  GET    /sessions/<id>/ws              WebSocket：发送{"message": "..."}，流式收到{"type": "output"}，最后收到{"type": "reply"}
+
+注意：Agent会按模型的要求执行终端命令和Python代码，只应在可信的网络中提供服务
+
+用法：python server.py [--host 127.0.0.1] [--port 8080]
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import secrets
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import urlsplit
+
+import agent
+
+# 会话创建时允许覆盖的配置项（API地址、密钥、文件路径和插件目录等只能在服务端的config.json中设置）
+SESSION_CONFIG_KEYS = [
+    "model", "user_name", "ai_name", "prompt_file", "send_history", "stream", "tool_sequential",
+    "max_agent_steps", "turn_token_budget", "turn_time_budget", "python_timeout", "terminal_mode", "terminal_timeout",
+    "context_token_budget", "context_summary_chars", "context_tokenizer", "mcp_cache"
+]
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+WS_TEXT, WS_BINARY, WS_CLOSE, WS_PING, WS_PONG = 0x1, 0x2, 0x8, 0x9, 0xA
+
+MAX_HEADER_BYTES = 16384
+MAX_BODY_BYTES = 1048576
+
+
+class HttpError(Exception):
+    """直接以对应状态码返回给客户端的错误"""
+
+    def __init__(self, status, message, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after
+
+
+class BoundedExecutor:
+    """
+    限制单个会话在共用线程池中同时占用的线程数：超出时submit阻塞，直到该会话的其他任务完成（背压）
+    """
+
+    def __init__(self, executor, limit):
+        self.executor = executor
+        self.slots = threading.BoundedSemaphore(max(1, limit))
+
+    def submit(self, fn, *args):
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def map(self, fn, *iterables):
+        futures = [self.submit(fn, *args) for args in zip(*iterables)]
+        return (future.result() for future in futures)
+
+    def shutdown(self, wait=True):
+        # 共用线程池由服务统一关闭
+        pass
+
+
+class SessionOutput:
+    """会话的输出流：本轮对话有WebSocket连接时把AI输出转发给它，否则丢弃"""
+
+    def __init__(self):
+        self.sink = None
+
+    def write(self, text):
+        if self.sink is not None and text:
+            self.sink(text)
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+class Session:
+    """一个会话：独立的Agent和消息队列"""
+
+    def __init__(self, session_id, app, output, overrides):
+        self.id = session_id
+        self.app = app
+        self.output = output
+        self.overrides = overrides
+        self.created_at = time.time()
+        self.last_active = self.created_at
+        self.turns = 0
+        self.queued = 0  # 正在执行和排队中的消息数
+        self.lock = asyncio.Lock()  # 同一会话的消息按顺序执行
+
+    def info(self):
+        return {
+            "session_id": self.id,
+            "created_at": self.created_at,
+            "last_active": self.last_active,
+            "turns": self.turns,
+            "queued": self.queued,
+            "config": self.overrides
+        }
+
+
+class AgentServer:
+    """
+    多会话Agent服务
+    :param base_config: 会话的基础配置（config.json）
+    :param max_sessions: 最多同时存在的会话数
+    :param max_turns: 同时执行的对话数（对话线程池大小）
+    :param max_queued_turns: 全局最多排队等待执行的对话数
+    :param session_queue: 每个会话最多排队的消息数（包括正在执行的）
+    :param tool_workers: 所有会话共用的工具线程池大小
+    :param session_tool_workers: 单个会话同时占用的工具线程数
+    :param idle_timeout: 会话空闲超过该秒数后自动关闭，0表示不关闭
+    """
+
+    def __init__(self, base_config, max_sessions=100, max_turns=8, max_queued_turns=32, session_queue=4,
+                 tool_workers=16, session_tool_workers=4, idle_timeout=1800.0):
+        self.base_config = base_config
+        self.max_sessions = max_sessions
+        self.max_turns = max_turns
+        self.max_queued_turns = max_queued_turns
+        self.session_queue = session_queue
+        self.session_tool_workers = session_tool_workers
+        self.idle_timeout = idle_timeout
+        self.sessions = {}
+        self.pending_turns = 0
+        self.turn_executor = ThreadPoolExecutor(max_workers=max_turns, thread_name_prefix="turn")
+        # Agent的关闭（停止内核进程等）可能较慢，放到单独的线程池中，不占用对话线程
+        self.close_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="session-close")
+        # 读取历史可能要从转存文件中读回内容，同样不在事件循环中进行，也不排在对话后面
+        self.read_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="session-read")
+        # 所有会话共用一个连接池和一组工具线程池
+        self.http_session, (self.mcp_executor, self.command_executor) = agent.Agent.create_shared_pools(
+            base_config, max_turns, tool_workers
+        )
+        # 日志、追踪和指标文件是整个进程的：各会话的Agent各自打开同一个文件会互相覆盖，日志轮转也会出错
+        self.log = agent.AgentLog(base_config)
+        self.tracer = agent.Tracer(base_config.trace_file)
+        self.metrics_dumper = None
+        if base_config.metrics_dump_file and base_config.metrics_dump_interval > 0:
+            self.metrics_dumper = agent.MetricsDumper(
+                self.metrics_snapshot, base_config.metrics_dump_file, base_config.metrics_dump_interval
+            )
+            self.metrics_dumper.start()
+        self.started_at = time.time()
+        self.reaper = None
+
+    def metrics_snapshot(self):
+        """服务状态和各会话的指标快照（由指标文件的写入线程调用）"""
+        sessions = list(self.sessions.values())
+        return {
+            "uptime_seconds": round(time.time() - self.started_at, 1),
+            "pending_turns": self.pending_turns,
+            "sessions": {session.id: session.app.metrics_snapshot() for session in sessions}
+        }
+
+    # ===================== 会话管理 =====================
+    def create_session(self, overrides):
+        if not isinstance(overrides, dict):
+            raise HttpError(HTTPStatus.BAD_REQUEST, "config必须是JSON对象")
+        values = self.base_config.model_dump()
+        for key, value in overrides.items():
+            if key not in SESSION_CONFIG_KEYS:
+                raise HttpError(HTTPStatus.BAD_REQUEST, f"不允许覆盖的配置项: {key}，可用: {', '.join(SESSION_CONFIG_KEYS)}")
+            value, error_reason = agent.Config.validate_item(key, value)
+            if error_reason:
+                raise HttpError(HTTPStatus.BAD_REQUEST, f"配置项 {key} 不合法: {error_reason}")
+            values[key] = value
+        if len(self.sessions) >= self.max_sessions:
+            raise HttpError(HTTPStatus.SERVICE_UNAVAILABLE, f"会话数已达上限（{self.max_sessions}）", retry_after=30)
+
+        # 会话之间互相看不到对方的已保存历史；连接池由所有会话共用，不再逐个预热；
+        # 日志和追踪使用服务共用的实例，指标由服务统一写入文件
+        values.update(send_saved_history=False, http_warmup=False, log_file="", trace_file="", metrics_dump_file="")
+        output = SessionOutput()
+        app = agent.Agent(
+            config=agent.Config(**values),
+            output=output,
+            http_session=self.http_session,
+            tool_executors=(
+                BoundedExecutor(self.mcp_executor, self.session_tool_workers),
+                BoundedExecutor(self.command_executor, self.session_tool_workers)
+            ),
+            log=self.log,
+            tracer=self.tracer
+        )
+        session = Session(secrets.token_urlsafe(12), app, output, overrides)
+        self.sessions[session.id] = session
+        return session
+
+    def get_session(self, session_id):
+        session = self.sessions.get(session_id)
+        if session is None:
+            raise HttpError(HTTPStatus.NOT_FOUND, f"会话不存在: {session_id}")
+        return session
+
+    async def close_session(self, session_id):
+        session = self.sessions.pop(session_id, None)
+        if session is None:
+            return False
+        # 等待正在执行的对话结束后再释放资源
+        async with session.lock:
+            await asyncio.get_running_loop().run_in_executor(self.close_executor, session.app.close)
+        return True
+
+    async def reap_idle_sessions(self):
+        """定期关闭空闲超时的会话，释放Python内核和shell进程"""
+        while True:
+            await asyncio.sleep(min(60.0, max(1.0, self.idle_timeout / 4)))
+            deadline = time.time() - self.idle_timeout
+            for session in list(self.sessions.values()):
+                if session.queued == 0 and session.last_active < deadline:
+                    await self.close_session(session.id)
+
+    async def run_turn(self, session, message, sink=None, use_cache=True):
+        """
+        在对话线程池中执行一轮对话（排队超过上限时返回429/503）
+        :param sink: 接收AI输出文本的函数（在事件循环线程中调用）
+        :param use_cache: 为False时本轮不使用回复缓存
+        :return: {"reply": 最终回复, "elapsed_seconds": 耗时}
+        """
+        if not isinstance(message, str) or not message:
+            raise HttpError(HTTPStatus.BAD_REQUEST, "message必须是非空字符串")
+        if session.queued >= self.session_queue:
+            raise HttpError(HTTPStatus.TOO_MANY_REQUESTS, f"该会话排队的消息已达上限（{self.session_queue}）", retry_after=1)
+        if self.pending_turns >= self.max_turns + self.max_queued_turns:
+            raise HttpError(HTTPStatus.SERVICE_UNAVAILABLE, "服务繁忙，请稍后重试", retry_after=1)
+
+        loop = asyncio.get_running_loop()
+        session.queued += 1
+        self.pending_turns += 1
+        try:
+            async with session.lock:
+                if session.id not in self.sessions:
+                    raise HttpError(HTTPStatus.NOT_FOUND, f"会话已关闭: {session.id}")
+                if sink is not None:
+                    session.output.sink = lambda text: loop.call_soon_threadsafe(sink, text)
+                started = time.perf_counter()
+                try:
+                    reply = await loop.run_in_executor(self.turn_executor, session.app.send_message, message, use_cache)
+                finally:
+                    session.output.sink = None
+                session.turns += 1
+                return {"reply": reply, "elapsed_seconds": round(time.perf_counter() - started, 3)}
+        finally:
+            session.queued -= 1
+            self.pending_turns -= 1
+            session.last_active = time.time()
+
+    # ===================== HTTP =====================
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                if headers.get("upgrade", "").lower() == "websocket":
+                    await self.handle_websocket(path, headers, reader, writer)
+                    break
+                keep_alive = headers.get("connection", "").lower() != "close"
+                try:
+                    status, data = await self.route(method, path, body)
+                    extra_headers = {}
+                except HttpError as e:
+                    status, data = e.status, {"error": e.message}
+                    extra_headers = {"Retry-After": str(e.retry_after)} if e.retry_after else {}
+                except Exception as e:
+                    status, data, extra_headers = HTTPStatus.INTERNAL_SERVER_ERROR, {"error": f"{type(e).__name__}: {e}"}, {}
+                write_response(writer, status, data, keep_alive, extra_headers)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except HttpError as e:
+            # 请求格式错误，返回后关闭连接
+            write_response(writer, e.status, {"error": e.message}, False)
+        finally:
+            writer.close()
+
+    async def route(self, method, path, body):
+        parts = [part for part in urlsplit(path).path.split("/") if part]
+        if parts == ["health"] and method == "GET":
+            return HTTPStatus.OK, {
+                "status": "ok",
+                "sessions": len(self.sessions),
+                "pending_turns": self.pending_turns,
+                "max_turns": self.max_turns
+            }
+        if parts == ["sessions"]:
+            if method == "POST":
+                session = self.create_session(parse_json_body(body).get("config", {}))
+                return HTTPStatus.CREATED, session.info()
+            if method == "GET":
+                return HTTPStatus.OK, {"sessions": [session.info() for session in self.sessions.values()]}
+        if len(parts) == 2 and parts[0] == "sessions":
+            if method == "DELETE":
+                if not await self.close_session(parts[1]):
+                    raise HttpError(HTTPStatus.NOT_FOUND, f"会话不存在: {parts[1]}")
+                return HTTPStatus.OK, {"closed": parts[1]}
+            if method == "GET":
+                return HTTPStatus.OK, self.get_session(parts[1]).info()
+        if len(parts) == 3 and parts[0] == "sessions":
+            session = self.get_session(parts[1])
+            if parts[2] == "messages" and method == "POST":
+                data = parse_json_body(body)
+                return HTTPStatus.OK, await self.run_turn(session, data.get("message"), use_cache=data.get("cache") is not False)
+            if parts[2] == "history" and method == "GET":
+                history = await asyncio.get_running_loop().run_in_executor(
+                    self.read_executor, session.app.chat_history.to_list
+                )
+                return HTTPStatus.OK, {"history": history}
+            if parts[2] == "stats" and method == "GET":
+                return HTTPStatus.OK, session.app.metrics_snapshot()
+        raise HttpError(HTTPStatus.NOT_FOUND, f"未知接口: {method} {path}")
+
+    # ===================== WebSocket =====================
+    async def handle_websocket(self, path, headers, reader, writer):
+        parts = [part for part in urlsplit(path).path.split("/") if part]
+        key = headers.get("sec-websocket-key")
+        if len(parts) != 3 or parts[0] != "sessions" or parts[2] != "ws" or not key:
+            write_response(writer, HTTPStatus.NOT_FOUND, {"error": f"未知接口: {path}"}, False)
+            return
+        try:
+            session = self.get_session(parts[1])
+        except HttpError as e:
+            write_response(writer, e.status, {"error": e.message}, False)
+            return
+        accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+        writer.write(
+            "HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+            f"Sec-WebSocket-Accept: {accept}\r\n\r\n".encode()
+        )
+        await writer.drain()
+
+        tasks = set()
+
+        def send(data):
+            if not writer.is_closing():
+                writer.write(encode_ws_frame(WS_TEXT, agent.dumps_json(data, as_bytes=True)))
+
+        async def ws_turn(message, use_cache):
+            # 连接断开后已提交的对话继续执行完，结果保留在会话历史中
+            try:
+                result = await self.run_turn(
+                    session, message, sink=lambda text: send({"type": "output", "text": text}), use_cache=use_cache
+                )
+                send(dict(result, type="reply"))
+            except HttpError as e:
+                send({"type": "error", "status": int(e.status), "error": e.message})
+            if not writer.is_closing():
+                try:
+                    await writer.drain()
+                except ConnectionError:
+                    pass
+
+        try:
+            while True:
+                opcode, payload = await read_ws_message(reader)
+                if opcode == WS_CLOSE:
+                    writer.write(encode_ws_frame(WS_CLOSE, payload[:2]))
+                    break
+                if opcode == WS_PING:
+                    writer.write(encode_ws_frame(WS_PONG, payload))
+                    continue
+                if opcode != WS_TEXT:
+                    continue
+                try:
+                    data = json.loads(payload)
+                    message, use_cache = data.get("message"), data.get("cache") is not False
+                except (ValueError, AttributeError):
+                    send({"type": "error", "status": 400, "error": "消息必须是JSON对象：{\"message\": \"...\"}"})
+                    continue
+                task = asyncio.create_task(ws_turn(message, use_cache))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+
+    # ===================== 启动与关闭 =====================
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_connection, host, port, limit=MAX_HEADER_BYTES)
+        if self.idle_timeout > 0:
+            self.reaper = asyncio.create_task(self.reap_idle_sessions())
+        print(f"✅ AgentCLI服务已启动: http://{host}:{server.sockets[0].getsockname()[1]}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if self.reaper is not None:
+                self.reaper.cancel()
+            if self.metrics_dumper is not None:
+                # 最后一次快照在会话关闭之前写入
+                self.metrics_dumper.stop()
+                self.metrics_dumper = None
+            for session_id in list(self.sessions):
+                await self.close_session(session_id)
+            self.close()
+
+    def close(self):
+        for executor in (self.turn_executor, self.mcp_executor, self.command_executor, self.close_executor,
+                         self.read_executor):
+            executor.shutdown(wait=False)
+        self.http_session.close()
+        if self.metrics_dumper is not None:
+            self.metrics_dumper.stop()
+        self.tracer.close()
+        self.log.close()
+
+
+# ===================== 协议辅助函数 =====================
+async def read_request(reader):
+    """
+    读取一个HTTP请求
+    :return: (方法, 路径, {小写的头名称: 值}, 请求体)，连接已关闭时返回None
+    """
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError as e:
+        if not e.partial.strip():
+            return None
+        raise HttpError(HTTPStatus.BAD_REQUEST, "请求不完整")
+    except asyncio.LimitOverrunError:
+        raise HttpError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, "请求头过大")
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, path, _ = lines[0].split(" ", 2)
+    except ValueError:
+        raise HttpError(HTTPStatus.BAD_REQUEST, "请求行格式错误")
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get("content-length") or 0)
+    except ValueError:
+        length = -1
+    if length < 0:
+        raise HttpError(HTTPStatus.BAD_REQUEST, "Content-Length不是非负整数")
+    if length > MAX_BODY_BYTES:
+        raise HttpError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f"请求体超过{MAX_BODY_BYTES}字节")
+    body = await reader.readexactly(length) if length else b""
+    return method.upper(), path, headers, body
+
+
+def parse_json_body(body):
+    if not body:
+        return {}
+    try:
+        data = json.loads(body)
+    except ValueError as e:
+        raise HttpError(HTTPStatus.BAD_REQUEST, f"请求体不是合法的JSON: {e}")
+    if not isinstance(data, dict):
+        raise HttpError(HTTPStatus.BAD_REQUEST, "请求体必须是JSON对象")
+    return data
+
+
+def write_response(writer, status, data, keep_alive, extra_headers=None):
+    body = agent.dumps_json(data, as_bytes=True)
+    status = HTTPStatus(status)
+    headers = {
+        "Content-Type": "application/json; charset=utf-8",
+        "Content-Length": str(len(body)),
+        "Connection": "keep-alive" if keep_alive else "close"
+    }
+    headers.update(extra_headers or {})
+    head = f"HTTP/1.1 {status.value} {status.phrase}\r\n" + "".join(f"{k}: {v}\r\n" for k, v in headers.items())
+    writer.write(head.encode("latin-1") + b"\r\n" + body)
+
+
+async def read_ws_frame(reader):
+    """读取一个WebSocket帧，返回(fin, opcode, 负载)；客户端发送的帧带掩码"""
+    first, second = await reader.readexactly(2)
+    length = second & 0x7F
+    if length == 126:
+        length = struct.unpack("!H", await reader.readexactly(2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", await reader.readexactly(8))[0]
+    if length > MAX_BODY_BYTES:
+        raise ConnectionError("WebSocket消息过大")
+    mask = await reader.readexactly(4) if second & 0x80 else None
+    payload = await reader.readexactly(length)
+    if mask:
+        payload = bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+    return bool(first & 0x80), first & 0x0F, payload
+
+
+async def read_ws_message(reader):
+    """读取一条完整的WebSocket消息（合并分片），控制帧直接返回"""
+    fin, opcode, payload = await read_ws_frame(reader)
+    if opcode >= 0x8 or fin:
+        return opcode, payload
+    parts = [payload]
+    size = len(payload)
+    while not fin:
+        fin, frame_opcode, payload = await read_ws_frame(reader)
+        if frame_opcode >= 0x8:
+            # 分片之间的控制帧（ping等）忽略，不影响消息内容
+            continue
+        size += len(payload)
+        if size > MAX_BODY_BYTES:
+            raise ConnectionError("WebSocket消息过大")
+        parts.append(payload)
+    return opcode, b"".join(parts)
+
+
+def encode_ws_frame(opcode, payload):
+    """服务端发送的帧不带掩码"""
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return header + payload
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AgentCLI服务模式")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址（默认127.0.0.1）")
+    parser.add_argument("--port", type=int, default=8080, help="监听端口（默认8080）")
+    parser.add_argument("--config", default="config.json", help="会话的基础配置文件")
+    parser.add_argument("--max-sessions", type=int, default=100, help="最多同时存在的会话数")
+    parser.add_argument("--max-turns", type=int, default=8, help="同时执行的对话数")
+    parser.add_argument("--max-queued-turns", type=int, default=32, help="全局最多排队等待执行的对话数")
+    parser.add_argument("--session-queue", type=int, default=4, help="每个会话最多排队的消息数")
+    parser.add_argument("--tool-workers", type=int, default=16, help="所有会话共用的工具线程数")
+    parser.add_argument("--session-tool-workers", type=int, default=4, help="单个会话同时占用的工具线程数")
+    parser.add_argument("--idle-timeout", type=float, default=1800.0, help="会话空闲超时（秒），0表示不关闭")
+    args = parser.parse_args()
+
+    base_config, config_errors = agent.Config.load_and_validate(args.config)
+    for error in config_errors:
+        print(f"⚠️  {error.get('message') or error.get('item')}: {error.get('error_reason', error.get('action', ''))}")
+    server = AgentServer(
+        base_config,
+        max_sessions=args.max_sessions,
+        max_turns=max(1, args.max_turns),
+        max_queued_turns=max(0, args.max_queued_turns),
+        session_queue=max(1, args.session_queue),
+        tool_workers=max(1, args.tool_workers),
+        session_tool_workers=max(1, args.session_tool_workers),
+        idle_timeout=args.idle_timeout
+    )
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
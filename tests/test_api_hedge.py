@@ -0,0 +1,32 @@
+import io
+import time
+
+import agent
+from mock_server import MockChatServer
+
+
+def test_hung_primary_does_not_slow_later_hedged_turns(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    primary = MockChatServer(lambda request: "主API的回复", delay=5.0).start()
+    secondary = MockChatServer(lambda request: "备用API的回复").start()
+    app = agent.Agent(config=agent.Config(
+        api_url=primary.url,
+        api_key="test",
+        api_fallbacks=[secondary.url],
+        api_hedge_after=0.2,
+        api_retries=0,
+        http_read_timeout=30.0,
+        http_warmup=False,
+        python_kernel=False
+    ), output=io.StringIO())
+    try:
+        # 每一轮输掉的主API请求都还挂着，之后的对冲请求不能排在它们后面
+        for turn in range(8):
+            started = time.perf_counter()
+            assert app.send_message(f"问题{turn}") == "备用API的回复"
+            assert time.perf_counter() - started < 2.0, f"第{turn}轮对冲后仍然等待了过长时间"
+        assert app.metrics.snapshot()["counters"]["api.hedge_wins"] == 8
+    finally:
+        app.close()
+        primary.stop()
+        secondary.stop()
@@ -0,0 +1,30 @@
+import json
+import os
+
+import agent
+import batch
+from mock_server import MockChatServer
+
+
+def test_concurrent_items_write_no_shared_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    api = MockChatServer(lambda request: "完成").start()
+    config = agent.Config(
+        api_url=api.url,
+        api_key="test",
+        save_history=True,
+        log_file=str(tmp_path / "agent.log.jsonl"),
+        trace_file=str(tmp_path / "agent.trace.json"),
+        metrics_dump_file=str(tmp_path / "metrics.json"),
+        http_warmup=False
+    )
+    output_file = tmp_path / "results.jsonl"
+    try:
+        runner = batch.BatchRunner(config, str(output_file), concurrency=3)
+        runner.run([json.dumps({"id": f"q{index}", "prompt": f"问题{index}"}) for index in range(6)])
+    finally:
+        api.stop()
+    records = [json.loads(line) for line in output_file.read_text(encoding="utf-8").splitlines()]
+    assert sorted(record["id"] for record in records) == [f"q{index}" for index in range(6)]
+    assert all(record["status"] == "ok" and record["reply"] == "完成" for record in records)
+    assert sorted(os.listdir(tmp_path)) == ["results.jsonl"]
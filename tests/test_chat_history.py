@@ -0,0 +1,42 @@
+import pytest
+
+import agent
+
+
+def fill(history, count, size=1000):
+    messages = []
+    for index in range(count):
+        message = {"role": "user" if index % 2 == 0 else "assistant", "content": f"{index}:" + "内容" * size}
+        history.append(message)
+        messages.append(message)
+    return messages
+
+
+def test_spilled_history_reads_back_unchanged(tmp_path):
+    history = agent.ChatHistory(memory_limit=20000, spill_dir=str(tmp_path))
+    messages = fill(history, 50)
+    stats = history.stats()
+    assert stats["spilled_entries"] > 0 and stats["memory_bytes"] <= 20000
+    assert history.to_list() == messages
+    assert history[0]["content"] == messages[0]["content"]
+    history.close()
+
+
+def test_duplicate_contents_are_shared():
+    history = agent.ChatHistory()
+    for _ in range(10):
+        history.append({"role": "assistant", "content": "".join(["same ", "reply"])})
+    assert history.stats()["unique_contents"] == 1
+    assert history[0].text is history[9].text
+    assert history[0].role is history[9].role
+
+
+def test_reading_spilled_history_after_close_is_a_clear_error():
+    history = agent.ChatHistory(memory_limit=20000)
+    messages = fill(history, 50)
+    history.close()
+    # 仍在内存中的内容照常可读
+    assert history[-1]["content"] == messages[-1]["content"]
+    with pytest.raises(ValueError, match="已关闭"):
+        history.to_list()
+    assert history.stats()["entries"] == 50
@@ -0,0 +1,91 @@
+import io
+import sqlite3
+
+import agent
+from mock_server import MockChatServer
+
+
+def record(path, replies):
+    cache = agent.CompletionCache(path, mode="record")
+    for key, content in replies:
+        cache.put(key, "model-a", content, {"total_tokens": 1})
+    cache.close()
+
+
+def test_replay_returns_exact_matches(tmp_path):
+    path = str(tmp_path / "cache.db")
+    record(path, [("k1", "回复1"), ("k2", "回复2")])
+    cache = agent.CompletionCache(path, mode="replay")
+    cached = cache.get("k2")
+    assert cached["content"] == "回复2" and not cached["fallback"]
+    cache.close()
+
+
+def test_replay_miss_is_an_error_by_default(tmp_path):
+    path = str(tmp_path / "cache.db")
+    record(path, [("k1", "回复1"), ("k2", "回复2")])
+    cache = agent.CompletionCache(path, mode="replay")
+    assert cache.get("unknown") is None
+    assert cache.stats()["misses"] == 1 and cache.stats()["replay_fallbacks"] == 0
+    cache.close()
+
+
+def test_replay_fallback_is_opt_in_and_reported(tmp_path):
+    path = str(tmp_path / "cache.db")
+    record(path, [("k1", "回复1"), ("k2", "回复2")])
+    cache = agent.CompletionCache(path, mode="replay", replay_fallback=True)
+    assert cache.get("k1")["fallback"] is False
+    cached = cache.get("unknown")
+    assert cached["content"] == "回复2" and cached["fallback"] is True and cached["seq"] == 2
+    assert cache.get("unknown") is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["replay_fallbacks"], stats["misses"]) == (1, 1, 1)
+    cache.close()
+
+
+def make_agent(tmp_path, api_url, fallback_url):
+    return agent.Agent(config=agent.Config(
+        api_url=api_url,
+        api_key="test",
+        api_fallbacks=[fallback_url],
+        api_retries=0,
+        completion_cache="on",
+        completion_cache_file=str(tmp_path / "cache.db"),
+        logger="None",
+        http_warmup=False
+    ), output=io.StringIO())
+
+
+def test_fallback_replies_are_not_cached_under_the_primary_key(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    requests = []
+    fallback = MockChatServer(lambda request: requests.append(request) or "备用API的回复").start()
+    # 主API拒绝连接，请求切换到备用API
+    app = make_agent(tmp_path, "http://127.0.0.1:1/v1/chat/completions", fallback.url)
+    try:
+        assert app.send_message("问题") == "备用API的回复"
+        assert app.send_message("问题", use_cache=True) == "备用API的回复"
+        assert len(requests) == 2
+        counters = app.metrics.snapshot()["counters"]
+        assert counters["completion_cache.fallback_skips"] == 2
+        assert "completion_cache.hits" not in counters
+    finally:
+        app.close()
+        fallback.stop()
+
+
+def test_cache_write_errors_keep_the_reply(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    api = MockChatServer(lambda request: "回复").start()
+    app = make_agent(tmp_path, api.url, api.url)
+
+    def locked(*args):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(app.completion_cache, "put", locked)
+    try:
+        assert app.send_message("问题") == "回复"
+        assert app.metrics.snapshot()["counters"]["completion_cache.write_errors"] == 1
+    finally:
+        app.close()
+        api.stop()
@@ -0,0 +1,54 @@
+import pytest
+
+import agent
+
+
+@pytest.fixture
+def cache():
+    return agent.McpResultCache(None, 1024 * 1024, 30.0, agent.DEFAULT_READONLY_COMMANDS)
+
+
+@pytest.mark.parametrize("command", [
+    "ls -la",
+    "cat README.md",
+    "find . -name '*.py'",
+    "tail -n 20 log.txt",
+    "tree -L 2",
+    "hostname",
+    "hostname -f",
+])
+def test_readonly_commands_are_cached(cache, command):
+    assert cache.is_readonly_terminal({"c1": command})
+
+
+@pytest.mark.parametrize("command", [
+    "find . -delete",
+    "find /tmp -name x -exec rm {} +",
+    "find . -execdir rm {} ;",
+    "find . -ok rm {} +",
+    "find . -okdir rm {} +",
+    "find . -fprint out.txt",
+    "find . -fprintf out.txt %p",
+    "find . -fls out.txt",
+    "find . -name x '-delete'",
+    "tail -f log",
+    "tail -F log",
+    "tail -qf log",
+    "tail --follow=name log",
+    "tree -o out.txt",
+    "tree -ao out.txt",
+    "hostname newname",
+    "hostname -F /etc/hostname",
+    "hostname --file /etc/hostname",
+    "hostname -b newname",
+    "ls > out.txt",
+    "cat a | sh",
+    "rm -rf /tmp/x",
+    "cat 'unterminated",
+])
+def test_writing_or_endless_commands_are_not_readonly(cache, command):
+    assert not cache.is_readonly_terminal({"c1": command})
+
+
+def test_any_unsafe_command_disables_caching(cache):
+    assert not cache.is_readonly_terminal({"c1": "ls", "c2": "find . -delete"})
@@ -0,0 +1,48 @@
+import json
+
+import pytest
+
+import agent
+from bench_mcp_messages import legacy_pipeline, make_result, object_pipeline
+
+INFO = {"module": "system", "method": "terminal.run", "params": {"c1": "ls -la /"}}
+RESULTS = [
+    {},
+    {"c1": ""},
+    {"c1": "中文\n\t\"引号\"\\反斜杠;;};;", "c2": "\u0000\u001f"},
+    {"nested": {"list": [1, 2.5, None, True, {"x": "y"}]}},
+    make_result(10000),
+    make_result(1000000),
+]
+BACKENDS = [None] + ([agent.orjson] if agent.orjson is not None else [])
+
+
+@pytest.fixture(params=BACKENDS, ids=lambda backend: "orjson" if backend else "json")
+def backend(request, monkeypatch):
+    monkeypatch.setattr(agent, "orjson", request.param)
+    return request.param
+
+
+@pytest.mark.parametrize("result", RESULTS, ids=range(len(RESULTS)))
+def test_object_pipeline_matches_legacy(backend, result):
+    text, log_line = object_pipeline(INFO, result)
+    legacy_text, legacy_log_line = legacy_pipeline(INFO, result)
+    assert json.loads(text[2:-2]) == json.loads(legacy_text[2:-2])
+    assert json.loads(log_line) == json.loads(legacy_log_line)
+    if backend is None:
+        # 标准库序列化时与旧实现逐字节相同
+        assert (text, log_line) == (legacy_text, legacy_log_line)
+
+
+@pytest.mark.parametrize("new_id", ["2", "长id", 7, None])
+def test_with_id_matches_fresh_serialization(backend, new_id):
+    response = agent.McpResponse.success("1", INFO, RESULTS[2])
+    response.serialize()
+    assert response.with_id(new_id).serialize() == agent.McpResponse.success(new_id, INFO, RESULTS[2]).serialize()
+
+
+def test_failure_serialization():
+    response = agent.McpResponse.failure("3", INFO, 1003, "执行命令失败")
+    assert json.loads(response.serialize()[2:-2]) == {
+        "mcp": "response", "id": "3", "info": INFO, "error": {"code": 1003, "message": "执行命令失败"}
+    }
@@ -0,0 +1,60 @@
+import json
+import random
+
+import pytest
+
+import agent
+from bench_mcp_scanner import (LEGACY_PATTERN, random_chunks, random_reply, reference_find_all, render,
+                               scan_chunks)
+
+
+@pytest.mark.parametrize("text, blocks", [
+    ('前;;{"a": 1};;后', ['{"a": 1}']),
+    (';;{"script": "print(\'};;\')"};;', ['{"script": "print(\'};;\')"}']),
+    (';;{"s": "\\"};;{"};;', ['{"s": "\\"};;{"}']),
+    (';;{"a": {"b": [1, {"c": 2}]}};;', ['{"a": {"b": [1, {"c": 2}]}}']),
+    (';;;{"a": 1};;', ['{"a": 1}']),
+    ('示例 ;;{ 省略; 然后;;{"a": 1};;', ['{"a": 1}']),
+    (';;{"a": 1}; ;;{"b": 2};;', ['{"b": 2}']),
+    (';;{"a": 1', []),
+    ('say ;;{ "oops ;;{"mcp":"request","id":"1"};; done', ['{"mcp":"request","id":"1"}']),
+    (';;{"a": "x ;;{"b": 2};; y";;', ['{"b": 2}']),
+    (';;{"a": 1} ;;{"b": 2};;', ['{"b": 2}']),
+    ('', []),
+])
+def test_known_replies(text, blocks):
+    assert agent.McpScanner.find_all(text) == blocks
+    assert reference_find_all(text) == blocks
+
+
+def test_random_replies_match_reference_parser():
+    rng = random.Random(2024)
+    for _ in range(1000):
+        text, blocks, visible = random_reply(rng)
+        found = agent.McpScanner.find_all(text)
+        assert found == reference_find_all(text) == blocks
+        chunks = random_chunks(rng, text)
+        chunked = scan_chunks(chunks)
+        assert [block for _, _, block in chunked] == found
+        assert all(text[start:end] == f";;{block};;" for start, end, block in chunked)
+        assert render(chunks) == (visible, text)
+
+
+def test_agrees_with_legacy_regex_when_no_string_contains_terminator():
+    rng = random.Random(7)
+    checked = 0
+    for _ in range(1000):
+        text, blocks, _ = random_reply(rng, malformed=False)
+        if any("};;" in block for block in blocks):
+            continue
+        assert agent.McpScanner.find_all(text) == LEGACY_PATTERN.findall(text)
+        checked += 1
+    assert checked > 100
+
+
+def test_every_split_point_gives_the_same_blocks():
+    text = '说明;;{"c": "};;", "d": "\\\\"};;中间;;{"e": [1, 2]};;;'
+    expected = agent.McpScanner.find_all(text)
+    assert [json.loads(block) for block in expected] == [{"c": "};;", "d": "\\"}, {"e": [1, 2]}]
+    for split in range(len(text) + 1):
+        assert [block for _, _, block in scan_chunks([text[:split], text[split:]])] == expected
@@ -0,0 +1,17 @@
+import agent
+
+
+def test_mcp_latency_labels_only_registered_methods():
+    app = agent.Agent(config=agent.Config(logger="None", http_warmup=False, python_kernel=False))
+    try:
+        app.handle_mcp_request({"mcp": "request", "id": "1", "module": "python", "method": "run.execute",
+                                "params": {"command": "1 + 1"}})
+        for index in range(50):
+            app.handle_mcp_request({"mcp": "request", "id": str(index), "module": f"made_up{index}",
+                                    "method": f"method{index}.call", "params": {}})
+        histograms = app.metrics.snapshot()["histograms"]
+        latency = sorted(name for name in histograms if name.startswith("mcp.latency_ms"))
+        assert latency == ["mcp.latency_ms[python.run.execute]", "mcp.latency_ms[unknown]"]
+        assert histograms["mcp.latency_ms[unknown]"]["count"] == 50
+    finally:
+        app.close()
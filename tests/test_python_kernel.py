@@ -0,0 +1,51 @@
+import pytest
+
+import agent
+
+
+class FailingProcess:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def start(self):
+        raise OSError("cannot start")
+
+
+def test_failed_start_leaves_kernel_stoppable(monkeypatch):
+    import multiprocessing
+    context = multiprocessing.get_context("spawn")
+    monkeypatch.setattr(type(context), "Process", FailingProcess)
+    kernel = agent.PythonKernel()
+    with pytest.raises(OSError):
+        kernel.start()
+    assert kernel.process is None and kernel.conn is None
+    kernel.kill()
+    kernel.stop()
+
+
+def test_kernel_reset_and_restart_have_side_effects():
+    app = agent.Agent(config=agent.Config(logger="None", http_warmup=False))
+    try:
+        registry = app.get_mcp_registry()
+        for name in ("kernel.reset", "kernel.restart"):
+            assert registry.policy("python", name)["side_effects"]
+            assert not registry.lookup("python", name).parallel
+    finally:
+        app.close()
+
+
+@pytest.mark.parametrize("python_kernel", [True, False])
+def test_expression_results_are_bounded_like_output(python_kernel):
+    app = agent.Agent(config=agent.Config(
+        logger="None", http_warmup=False, python_kernel=python_kernel, python_output_head=1000,
+        python_output_tail=500
+    ))
+    try:
+        result, error, truncation = app.run_python_command("'x' * 5_000_000")
+        assert error == ""
+        assert len(result) < 2000 and result.startswith("x" * 1000) and result.endswith("x" * 500)
+        assert truncation["result"]["total_bytes"] == 5_000_000
+        result, error, truncation = app.run_python_command("list(range(3))")
+        assert (result, error, truncation) == ([0, 1, 2], "", None)
+    finally:
+        app.close()
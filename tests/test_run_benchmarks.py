@@ -0,0 +1,12 @@
+import pytest
+
+from run_benchmarks import percentile
+
+
+@pytest.mark.parametrize("fraction, expected", [(0.5, 10), (0.9, 18), (0.95, 19), (0.99, 20), (1.0, 20), (0.0, 1)])
+def test_percentile_uses_nearest_rank(fraction, expected):
+    assert percentile(range(20, 0, -1), fraction) == expected
+
+
+def test_percentile_of_nothing_is_zero():
+    assert percentile([], 0.95) == 0.0
@@ -0,0 +1,57 @@
+import asyncio
+import json
+from http import HTTPStatus
+
+import pytest
+
+import agent
+import server
+
+
+def read(raw):
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(raw)
+        reader.feed_eof()
+        return await server.read_request(reader)
+    return asyncio.run(run())
+
+
+def test_read_request_with_body():
+    method, path, headers, body = read(b"POST /sessions HTTP/1.1\r\nContent-Length: 2\r\n\r\n{}")
+    assert (method, path, body) == ("POST", "/sessions", b"{}")
+
+
+@pytest.mark.parametrize("value", [b"abc", b"-1", b"1.5"])
+def test_invalid_content_length_is_bad_request(value):
+    with pytest.raises(server.HttpError) as info:
+        read(b"POST /sessions HTTP/1.1\r\nContent-Length: " + value + b"\r\n\r\n{}")
+    assert info.value.status == HTTPStatus.BAD_REQUEST
+
+
+def test_sessions_share_the_server_log_trace_and_metrics_files(tmp_path):
+    config = agent.Config(
+        log_file=str(tmp_path / "agent.log.jsonl"),
+        trace_file=str(tmp_path / "agent.trace.json"),
+        metrics_dump_file=str(tmp_path / "metrics.json"),
+        metrics_dump_interval=60.0,
+        http_warmup=False
+    )
+    app_server = server.AgentServer(config, idle_timeout=0)
+    try:
+        sessions = [app_server.create_session({}) for _ in range(3)]
+        for session in sessions:
+            app = session.app
+            assert app.log is app_server.log and app.tracer is app_server.tracer
+            assert app.metrics_dumper is None
+            assert (app.config.log_file, app.config.trace_file, app.config.metrics_dump_file) == ("", "", "")
+        with sessions[0].app.tracer.span("turn"):
+            pass
+        app_server.metrics_dumper.dump()
+        snapshot = json.loads((tmp_path / "metrics.json").read_text(encoding="utf-8"))
+        assert set(snapshot["sessions"]) == {session.id for session in sessions}
+        for session in sessions:
+            session.app.close()
+    finally:
+        app_server.close()
+    assert '"name":"turn"' in (tmp_path / "agent.trace.json").read_text(encoding="utf-8").replace(" ", "")